@@ -0,0 +1,320 @@
+"""Benchmarks of the butler hot paths on synthetic repositories.
+
+Run in the same environment as the tests, e.g.
+
+    python bench/benchButler.py --visits 20 --output results.json
+    python bench/benchButler.py --compare results.json
+
+Each run generates a raw repository with the raw_repo template layout and a
+chain of rerun repositories on top of it, times mapper startup, unpickling
+and opening from a snapshot, mapping, partial-dataId enumeration, get and put
+throughput and lock contention between processes, and writes the results as
+JSON.  With --compare, each result is also printed as a ratio to the same
+benchmark in an earlier results file.
+"""
+
+import argparse
+import cPickle
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+import yaml
+
+from butler import Butler
+from configCache import configCache
+from dbLock import createLock
+from mapper import Mapper
+
+RAW_TEMPLATE = ("v{visit}-f{filter}/snap{snap}/ccd{sensor}/"
+        "raw-v{visit}-f{filter}-E{snap:03d}-S{sensor}-C{channel}.fits")
+OUTPUT_TEMPLATE = "calexp/v{visit}-f{filter}/calexp-v{visit}-S{sensor}.pickle"
+FILTERS = "gri"
+
+class BlobStorage(object):
+    """Storage for the synthetic repositories: raw files are read as bytes
+    and outputs are pickled."""
+
+    @staticmethod
+    def get(url, dataId, predecessor):
+        with open(url, "rb") as f:
+            return f.read()
+
+    @staticmethod
+    def getPickle(url, dataId, predecessor):
+        with open(url, "rb") as f:
+            return cPickle.load(f)
+
+    @staticmethod
+    def put(obj, url, dataId):
+        directory = os.path.dirname(url)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+        with open(url, "wb") as f:
+            cPickle.dump(obj, f, cPickle.HIGHEST_PROTOCOL)
+
+def rawDataIds(visits, snaps, sensors, channels):
+    """Return the dataIds of a synthetic raw repository."""
+    return [dict(visit=visit, filter=FILTERS[visit % len(FILTERS)],
+        snap=snap, sensor=sensor, channel=channel)
+        for visit in xrange(visits) for snap in xrange(snaps)
+        for sensor in xrange(sensors) for channel in xrange(channels)]
+
+def makeRepos(root, visits, snaps, sensors, channels, depth, fileSize):
+    """Generate a raw repository under root with one file of fileSize bytes
+    per dataId, and a chain of depth rerun repositories each having the
+    previous one as parent.  Returns the list of repository paths, raw
+    repository first."""
+    storage = __name__ if __name__ != "__main__" else "benchButler"
+    classes = dict(
+        blob=dict(readers=[storage + ".BlobStorage.get"],
+            writers=[storage + ".BlobStorage.put"]),
+        pickle=dict(readers=[storage + ".BlobStorage.getPickle"],
+            writers=[storage + ".BlobStorage.put"]))
+    rawPath = os.path.join(root, "raw")
+    data = b"\0" * fileSize
+    for dataId in rawDataIds(visits, snaps, sensors, channels):
+        path = os.path.join(rawPath, RAW_TEMPLATE.format(**dataId))
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, "wb") as f:
+            f.write(data)
+    _writeConfig(rawPath, dict(mapper="mapper.Mapper", classes=classes,
+        datasets=dict(raw=dict(datasetClass="blob",
+            urls=["file:" + RAW_TEMPLATE]))))
+    paths = [rawPath]
+    for i in xrange(depth):
+        path = os.path.join(root, "rerun{}".format(i))
+        os.makedirs(path)
+        config = dict(parents=[paths[-1]], datasets={})
+        if i == depth - 1:
+            config["datasets"]["calexp"] = dict(datasetClass="pickle",
+                    urls=["file:" + OUTPUT_TEMPLATE])
+        _writeConfig(path, config)
+        paths.append(path)
+    return paths
+
+###############################################################################
+
+def benchStartup(paths, repeat):
+    """Construct a Butler on the top of the chain, without the mapper cache
+    and with and without the configuration cache, then with the mapper
+    cache, unpickle it and open it from a registry snapshot."""
+    def construct():
+        Mapper._mapperCache.clear()
+        Butler(paths[-1], readOnly=True)
+    results = [_time("startup.cold", construct, repeat)]
+    directory = configCache.directory
+    configCache.directory = None
+    try:
+        results.append(_time("startup.parse", construct, repeat))
+    finally:
+        configCache.directory = directory
+    butler = Butler(paths[-1], readOnly=True)
+    results.append(_time("startup.cached",
+        lambda: Butler(paths[-1], readOnly=True), repeat))
+    state = cPickle.dumps(butler, cPickle.HIGHEST_PROTOCOL)
+    result = _time("startup.unpickle", lambda: cPickle.loads(state), repeat)
+    result["bytes"] = len(state)
+    results.append(result)
+    path = butler.mapper.exportSnapshot()
+    results.append(_time("startup.snapshot",
+        lambda: Butler(paths[-1], snapshot=path), repeat))
+    return results
+
+def benchMap(paths, dataIds, repeat):
+    """Map complete dataIds through the chain, one at a time and in one
+    batch."""
+    butler = Butler(paths[-1], readOnly=True)
+    mapper = butler.mapper
+    requests = [("raw", dataId) for dataId in dataIds]
+    return [
+        _time("map.single", lambda: [mapper.map("raw", dataId.copy(), False)
+            for dataId in dataIds], repeat, len(dataIds)),
+        _time("map.many", lambda: mapper.mapMany(
+            [(datasetType, dataId.copy())
+                for datasetType, dataId in requests], False),
+            repeat, len(dataIds))]
+
+def benchEnumerate(paths, visits, repeat):
+    """Enumerate the raws matching partial dataIds, through the file index
+    and after ingest through the registry."""
+    butler = Butler(paths[0])
+    results = []
+    for label in ("files", "registry"):
+        if label == "registry":
+            butler.ingest("raw", [dataId for dataId, path, size, mtime in
+                butler.mapper._getFileIndex().find("raw", {})])
+        results.append(_time("enumerate.{}.visit".format(label),
+            lambda: [butler.getRefSet("raw", visit=visit)
+                for visit in xrange(visits)], repeat, visits))
+        results.append(_time("enumerate.{}.all".format(label),
+            lambda: butler.getRefSet("raw"), repeat))
+    return results
+
+def benchGet(paths, dataIds, repeat):
+    """Read raws one at a time and in batches."""
+    butler = Butler(paths[0])
+    requests = [("raw", dataId) for dataId in dataIds]
+    return [
+        _time("get.single", lambda: [butler.get("raw", dataId)
+            for dataId in dataIds], repeat, len(dataIds)),
+        _time("get.many", lambda: butler.getMany(requests), repeat,
+            len(dataIds))]
+
+def benchPut(paths, visits, sensors, repeat):
+    """Write new outputs one at a time, in batches and through the
+    write-behind queue, and rewrite existing ones with the same content."""
+    butler = Butler(paths[-1])
+    dataIds = [dict(visit=visit, filter=FILTERS[visit % len(FILTERS)],
+        sensor=sensor) for visit in xrange(visits)
+        for sensor in xrange(sensors)]
+    counter = [0]
+    def putSingle():
+        counter[0] += 1
+        for dataId in dataIds:
+            butler.put(dataId, "calexp", dataId, visit=dataId["visit"] +
+                    counter[0] * visits)
+    def putMany():
+        counter[0] += 1
+        butler.putMany([(dataId, "calexp", dict(dataId,
+            visit=dataId["visit"] + counter[0] * visits))
+            for dataId in dataIds])
+    behind = Butler(paths[-1], writeBehind=len(dataIds))
+    def putBehind():
+        counter[0] += 1
+        for dataId in dataIds:
+            behind.put(dataId, "calexp", dataId, visit=dataId["visit"] +
+                    counter[0] * visits)
+        behind.flush()
+    results = [_time("put.single", putSingle, repeat, len(dataIds)),
+            _time("put.many", putMany, repeat, len(dataIds)),
+            _time("put.writeBehind", putBehind, repeat, len(dataIds))]
+    visit = counter[0] * visits
+    results.append(_time("put.existing", lambda: [butler.put(dataId,
+        "calexp", dataId, visit=dataId["visit"] + visit)
+        for dataId in dataIds], repeat, len(dataIds)))
+    return results
+
+def benchLocks(paths, processes, iterations, kinds, backend):
+    """Acquire and release locks on a few kinds from several processes at
+    once; returns the overall lock operations per second."""
+    registryPath = os.path.join(paths[-1], "_butler.sqlite3")
+    start = time.time()
+    workers = [multiprocessing.Process(target=_lockWorker,
+        args=(registryPath, backend, iterations, kinds, i))
+        for i in xrange(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    count = processes * iterations
+    return [dict(name="lock.{}.{}procs".format(backend, processes),
+        count=count, seconds=elapsed, perSecond=count / elapsed,
+        failures=sum(1 for worker in workers if worker.exitcode != 0))]
+
+###############################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--visits", type=int, default=20)
+    parser.add_argument("--snaps", type=int, default=2)
+    parser.add_argument("--sensors", type=int, default=9)
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--depth", type=int, default=3,
+            help="number of rerun repositories chained on the raws")
+    parser.add_argument("--file-size", type=int, default=1024)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--lock-iterations", type=int, default=200)
+    parser.add_argument("--lock-backend", default="sqlite")
+    parser.add_argument("--root", help="directory for the synthetic "
+            "repositories (default: a temporary one, removed afterwards)")
+    parser.add_argument("--output", help="JSON results file")
+    parser.add_argument("--compare", help="earlier JSON results file")
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix="benchButler")
+    try:
+        paths = makeRepos(root, args.visits, args.snaps, args.sensors,
+                args.channels, args.depth, args.file_size)
+        dataIds = rawDataIds(args.visits, args.snaps, args.sensors,
+                args.channels)
+        results = []
+        results.extend(benchStartup(paths, args.repeat))
+        results.extend(benchMap(paths, dataIds, args.repeat))
+        results.extend(benchEnumerate(paths, args.visits, args.repeat))
+        results.extend(benchGet(paths, dataIds, args.repeat))
+        results.extend(benchPut(paths, args.visits, args.sensors,
+            args.repeat))
+        results.extend(benchLocks(paths, args.processes,
+            args.lock_iterations, 4, args.lock_backend))
+    finally:
+        if args.root is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = dict(commit=_gitCommit(), python=platform.python_version(),
+            platform=platform.platform(), time=time.time(),
+            parameters=dict((key, value)
+                for key, value in vars(args).iteritems()
+                if key not in ("output", "compare", "root")),
+            results=results)
+    previous = {}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = dict((result["name"], result)
+                    for result in json.load(f)["results"])
+    for result in results:
+        line = "{name:30s} {count:8d} {seconds:10.4f}s {perSecond:12.1f}/s"
+        if result["name"] in previous:
+            line += "  x{:.2f}".format(result["perSecond"] /
+                    previous[result["name"]]["perSecond"])
+        print line.format(**result)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+def _time(name, func, repeat, count=1):
+    # The best of repeat runs.
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    best = max(best, 1e-9)
+    return dict(name=name, count=count, seconds=best, perSecond=count / best)
+
+def _lockWorker(registryPath, backend, iterations, kinds, seed):
+    lock = createLock(registryPath, backend, timeout=60.0)
+    for i in xrange(iterations):
+        with lock.lock("bench{}".format((seed + i) % kinds)):
+            pass
+
+def _writeConfig(repoPath, config):
+    if not os.path.isdir(repoPath):
+        os.makedirs(repoPath)
+    with open(os.path.join(repoPath, "_butler.yaml"), "w") as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
+
+def _gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,226 @@
+import array
+import collections
+import mmap
+import sys
+
+import storage
+
+_blockSize = 2880
+_cardSize = 80
+_typeCodes = {8: "B", 16: "h", 32: "i", -32: "f", -64: "d"}
+_bitpix = {"B": 8, "h": 16, "i": 32, "l": 32, "f": -32, "d": -64}
+_structural = ("SIMPLE", "BITPIX", "NAXIS", "NAXIS1", "NAXIS2", "EXTEND",
+        "END")
+
 class Exposure(object):
-    def __init__(self, path):
+    """An exposure: a FITS header and a 2-d image, given as a list of rows
+    of pixel values.
+
+    An Exposure read by ExposureFits.get is a lazy handle on its file: the
+    file is mapped into memory when the header or image is first used, and
+    only the pages holding the header and the rows of the bounding box
+    (x0, y0, x1, y1), half-open, are read.  A file at a remote URL is read
+    with range requests: one for the header and one for the span of rows
+    of the bounding box."""
+
+    def __init__(self, path=None, header=None, image=None, bbox=None):
         self.path = path
+        self.bbox = bbox
+        self._header = header
+        self._image = image
+        self._map = None
+        self._dataOffset = None
 
     def __str__(self):
         return "Exposure({})".format(self.path)
 
+    @property
+    def header(self):
+        if self._header is None:
+            if self.path is None:
+                self._header = collections.OrderedDict()
+            else:
+                self._open()
+        return self._header
+
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = self._readImage()
+        return self._image
+
+    def getDimensions(self):
+        """Return the (width, height) of the image in the file."""
+        header = self.header
+        if header.get("NAXIS", 0) == 0:
+            return 0, 0
+        return header["NAXIS1"], header["NAXIS2"]
+
+    def close(self):
+        """Release the memory map of the file; the header and any rows
+        already read stay available."""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    # For pickling: the header and image are read so that the pickle does
+    # not depend on the file.
+    def __getstate__(self):
+        return dict(path=self.path, bbox=self.bbox, header=self.header,
+                image=self.image)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _open(self):
+        if not storage.isLocal(self.path):
+            with storage.openUrl(self.path) as f:
+                self._header, self._dataOffset = _readHeader(
+                        _HeaderReader(f), self.path)
+            return
+        with open(self.path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._header, self._dataOffset = _readHeader(self._map, self.path)
+
+    def _readImage(self):
+        if self._dataOffset is None:
+            if self.path is None:
+                return []
+            self._open()
+        header = self._header
+        width, height = self.getDimensions()
+        x0, y0, x1, y1 = self.bbox or (0, 0, width, height)
+        if not (0 <= x0 <= x1 <= width and 0 <= y0 <= y1 <= height):
+            raise RuntimeError("Bounding box {} outside the {}x{} image "
+                    "of {}".format(self.bbox, width, height, self.path))
+        typeCode = _typeCodes[header["BITPIX"]]
+        pixelSize = abs(header["BITPIX"]) // 8
+        rows = []
+        if y0 == y1:
+            return rows
+        data, base = self._map, 0
+        if data is None:
+            base = self._dataOffset + (y0 * width + x0) * pixelSize
+            end = self._dataOffset + ((y1 - 1) * width + x1) * pixelSize
+            data = storage.getBackend(self.path).read(self.path, base,
+                    end - base)
+        for y in xrange(y0, y1):
+            start = self._dataOffset + (y * width + x0) * pixelSize - base
+            row = array.array(typeCode)
+            row.fromstring(data[start:start + (x1 - x0) * pixelSize])
+            if sys.byteorder == "little" and pixelSize > 1:
+                row.byteswap()
+            rows.append(row)
+        return rows
+
 class ExposureFits(object):
+    """Storage of Exposures as single-HDU FITS files.
+
+    get recognizes two read parameters among the keys of the dataId, which
+    may be given as keyword arguments of Butler.get: headerOnly, to return
+    only the header as an ordered dict, and bbox, an (x0, y0, x1, y1)
+    half-open pixel range, to return an Exposure of that part of the
+    image."""
+
     @staticmethod
     def get(url, dataId, predecessor):
-        return Exposure(url)
+        if dataId.get("headerOnly"):
+            with storage.openUrl(url) as f:
+                return _readHeader(_HeaderReader(f), url)[0]
+        return Exposure(url, bbox=dataId.get("bbox"))
+
+    @staticmethod
+    def put(obj, url, dataId):
+        image = obj.image
+        header = collections.OrderedDict(obj.header or {})
+        bitpix = None
+        if len(image) > 0:
+            bitpix = _bitpix.get(getattr(image[0], "typecode", None))
+            if bitpix is None:
+                bitpix = -64 if any(isinstance(value, float)
+                        for row in image for value in row) else 32
+        cards = [("SIMPLE", True), ("BITPIX", bitpix or 8),
+                ("NAXIS", 2 if bitpix else 0)]
+        if bitpix:
+            cards.extend([("NAXIS1", len(image[0])),
+                ("NAXIS2", len(image))])
+        cards.extend((key, value) for key, value in header.iteritems()
+                if key not in _structural)
+        data = "".join(_formatCard(key, value) for key, value in cards)
+        data = [_pad(data + "END".ljust(_cardSize), " ")]
+        if bitpix:
+            rows = []
+            for row in image:
+                row = array.array(_typeCodes[bitpix], row)
+                if sys.byteorder == "little" and row.itemsize > 1:
+                    row.byteswap()
+                rows.append(row.tostring())
+            data.append(_pad("".join(rows), "\0"))
+        storage.getBackend(url).write(url, "".join(data))
+
+class _HeaderReader(object):
+    # Reads the blocks of a file holding the header, for header-only and
+    # remote reads.
+
+    def __init__(self, f):
+        self.f = f
+        self.data = ""
+
+    def __getslice__(self, start, end):
+        while len(self.data) < end:
+            block = self.f.read(_blockSize)
+            if not block:
+                break
+            self.data += block
+        return self.data[start:end]
+
+def _readHeader(data, path):
+    # Parse the header cards at the start of data, a memory map or a
+    # _HeaderReader.  Returns the header as an ordered dict and the offset
+    # of the data unit.
+    header = collections.OrderedDict()
+    offset = 0
+    while True:
+        card = data[offset:offset + _cardSize]
+        if len(card) < _cardSize:
+            raise RuntimeError("No END card in FITS header of {}".format(
+                path))
+        offset += _cardSize
+        key = card[:8].rstrip()
+        if key == "END":
+            break
+        if card[8:10] == "= ":
+            header[key] = _parseValue(card[10:])
+    return header, (offset + _blockSize - 1) // _blockSize * _blockSize
+
+def _parseValue(text):
+    text = text.strip()
+    if text.startswith("'"):
+        end = 1
+        while True:
+            end = text.find("'", end)
+            if end < 0 or text[end + 1:end + 2] != "'":
+                break
+            end += 2
+        return text[1:end].replace("''", "'").rstrip()
+    text = text.split("/", 1)[0].strip()
+    if text in ("T", "F"):
+        return text == "T"
+    for valueType in (int, float):
+        try:
+            return valueType(text)
+        except ValueError:
+            pass
+    return text
+
+def _formatCard(key, value):
+    if isinstance(value, bool):
+        text = ("T" if value else "F").rjust(20)
+    elif isinstance(value, (int, long, float)):
+        text = repr(value).rjust(20)
+    else:
+        text = "'{}'".format(str(value).replace("'", "''").ljust(8))
+    return "{:8s}= {}".format(key[:8], text)[:_cardSize].ljust(_cardSize)
+
+def _pad(data, fill):
+    return data + fill * (-len(data) % _blockSize)
@@ -0,0 +1,109 @@
+import os
+import threading
+
+from butler import Butler
+
+class AsyncButler(Butler):
+    """A Butler whose gets and puts can be issued without waiting for them.
+
+    aget, aput and agetRefSet submit the corresponding Butler call to an
+    executor and immediately return its pending result, an object with the
+    interface of multiprocessing.pool.AsyncResult (get, wait, ready,
+    successful).  The executor is any object with that pool's apply_async
+    method; by default it is the Butler's own thread pool.  All calls share
+    the Butler's mapper, and storage reads and writes against each
+    repository are limited to a number of concurrent operations so that
+    hundreds of requests can be in flight without overwhelming slow
+    storage."""
+
+    def __init__(self, outputRepo, inputRepos=None, executor=None,
+            maxConcurrency=None, repoLimits=None, **kwArgs):
+        """Construct an AsyncButler.  maxConcurrency is the default limit on
+        concurrent storage operations per repository and repoLimits an
+        optional dict of limits keyed by repository path.  maxConcurrency
+        defaults to maxThreads, the size of the Butler's thread pool; when
+        only maxConcurrency is given and there is no executor, the pool is
+        sized from it instead."""
+
+        if executor is None and maxConcurrency is not None:
+            kwArgs.setdefault("maxThreads", maxConcurrency)
+        Butler.__init__(self, outputRepo, inputRepos, **kwArgs)
+        if maxConcurrency is None:
+            maxConcurrency = self.maxThreads
+        self.executor = executor
+        self.maxConcurrency = maxConcurrency
+        self.repoLimits = repoLimits or {}
+        self._semaphores = None
+
+    # For pickling
+    def __getstate__(self):
+        state = Butler.__getstate__(self)
+        state['executor'] = None
+        state['_semaphores'] = None
+        return state
+
+    def aget(self, datasetType, dataId={}, **kwArgs):
+        """Start retrieving a dataset; return its pending result."""
+
+        return self._submit(self.get, (datasetType, dataId), kwArgs)
+
+    def aput(self, obj, datasetType, dataId={}, **kwArgs):
+        """Start persisting a dataset; return its pending result."""
+
+        return self._submit(self.put, (obj, datasetType, dataId), kwArgs)
+
+    def agetRefSet(self, datasetType, partialDataId={}, **kwArgs):
+        """Start listing the references to datasets matching a partial data
+        id; return the pending list."""
+
+        return self._submit(self.getRefSet, (datasetType, partialDataId),
+                kwArgs)
+
+###############################################################################
+
+    def _submit(self, func, args, kwArgs):
+        executor = self.executor
+        if executor is None:
+            executor = self._getPool()
+        return executor.apply_async(func, args, kwArgs)
+
+    def _read(self, locationList):
+        with self._getSemaphore(locationList):
+            return Butler._read(self, locationList)
+
+    def _write(self, obj, locationList):
+        with self._getSemaphore(locationList):
+            Butler._write(self, obj, locationList)
+
+    def _getSemaphore(self, locationList):
+        if self._semaphores is None:
+            with self._lazyLock:
+                if self._semaphores is None:
+                    semaphores = []
+                    for repoPath in _repoPaths(self.mapper):
+                        limit = self.repoLimits.get(repoPath,
+                                self.maxConcurrency)
+                        semaphores.append((repoPath,
+                            threading.BoundedSemaphore(limit)))
+                    # Longest paths first so nested repositories match
+                    # before their ancestors.
+                    semaphores.sort(key=lambda item: -len(item[0]))
+                    self._default = threading.BoundedSemaphore(
+                            self.maxConcurrency)
+                    self._semaphores = semaphores
+        url = locationList[0].url if len(locationList) > 0 else ""
+        for repoPath, semaphore in self._semaphores:
+            if url.startswith(repoPath + os.sep) or url == repoPath:
+                return semaphore
+        return self._default
+
+def _repoPaths(mapper, seen=None):
+    if seen is None:
+        seen = set()
+    repoPath = mapper.config["repoPath"]
+    if repoPath not in seen:
+        seen.add(repoPath)
+        yield repoPath
+    for parent in mapper.parents:
+        for path in _repoPaths(parent, seen):
+            yield path
@@ -1,9 +1,19 @@
 import logging as log
 import os
+import threading
+from multiprocessing.pool import ThreadPool
 
+from butlerLocation import locationSize
+from checksum import fileChecksum, locationChecksums, objectChecksum
+from dataIdSet import DataIdSet
 from dataRef import DataRef
-from dbLock import DbLock
+from dbLock import createLock
+from instrumentation import count, timer
 from mapper import Mapper
+from objectCache import ObjectCache
+from prefetch import PrefetchIterator
+from provenance import createProvenanceSink
+from writeBehind import WriteBehindQueue
 
 # One butler per task
 # One mapper per repo, customized for camera
@@ -39,56 +49,230 @@ class Butler(object):
     attached; they are searched for datasets that are not found in the output
     repository.  The input repositories may themselves have other input
     repositories attached, forming a directed graph.  This graph is searched
-    depth-first.
+    depth-first.  When the output repository's configuration sets
+    searchThreads above one, the repositories are queried concurrently on
+    that many threads and their answers taken in the same depth-first order.
+    The answers of each repository to existence checks are cached for
+    existenceCacheMaxAge seconds (by default fileIndexMaxAge, 60), and Bloom
+    filters of the datasets of its input repositories until their
+    registries are written.
 
     Each repository contains a configuration file defining the dataset types
     contained in it.
     """
 
-    def __init__(self, outputRepo, inputRepos=None):
+    def __init__(self, outputRepo, inputRepos=None, maxThreads=8,
+            provenance=None, cache=None, readOnly=False, snapshot=None,
+            writeBehind=0):
         """Construct a Butler to manage an output (read/write) repository,
-        attaching zero or more input (read-only) repositories."""
-
-        self.mapper = Mapper.create(outputRepo, inputRepos)
+        attaching zero or more input (read-only) repositories.
+
+        maxThreads bounds the thread pool used by getMany and putMany to run
+        storage readers and writers for independent datasets concurrently.
+
+        provenance is the sink that records gets and puts.  By default it is
+        created on first use from the provenance section of the output
+        repository's configuration.  It writes to the registry through one
+        sink shared by the Butlers of the registry, and a readOnly Butler
+        discards the records.
+
+        cache is an optional ObjectCache of retrieved datasets.  The cache
+        entry of a dataset class in the mapper configuration selects whether
+        its datasets are cached (true, the default, or false) or gives a
+        policy such as {maxObjectBytes: N}.
+
+        With readOnly, constructing the Butler does not write the mapper
+        configurations to the repositories' registries.  A pickled Butler
+        carries its resolved mappers and is unpickled without reading or
+        writing any repository.
+
+        snapshot is the path of a snapshot written by Mapper.exportSnapshot.
+        While it is current, the mappers are loaded from it and their
+        registries are read from it, shared through memory mapping by all
+        processes opening it, and datasets cannot be put; once a registry
+        has been written, the repositories are read as usual.  A Butler
+        given a snapshot is always readOnly.
+
+        With writeBehind above zero, put and putMany queue up to that many
+        datasets for a background thread to write in batches, and return at
+        once; objects must not be modified once put.  flush, or leaving a
+        with block on the Butler, waits for the queued datasets to be
+        written, and an error writing them is raised by the next put or
+        flush.  A get of a dataset still queued waits for it."""
+
+        readOnly = readOnly or snapshot is not None
+        self.mapper = None
+        if snapshot is not None:
+            self.mapper = Mapper.openSnapshot(snapshot)
+        if self.mapper is None:
+            self.mapper = Mapper.create(outputRepo, inputRepos, readOnly)
+        self.readOnly = readOnly
         self.registryPath = self.mapper.registryPath
-        self.provenance = []
+        self.provenance = provenance
+        self.cache = cache
+        self.aliases = {}
+        self.maxThreads = maxThreads
+        self.writeBehind = writeBehind
+        self._pool = None
+        self._writeQueue = None
+        self._dbLocks = threading.local()
+        self._openLocks = []
+        self._lazyLock = threading.Lock()
+
+    # For pickling
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_writeQueue'] = None
+        state['provenance'] = None
+        if self.cache is not None:
+            state['cache'] = ObjectCache(self.cache.maxBytes)
+        del state['_dbLocks']
+        del state['_openLocks']
+        del state['_lazyLock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._dbLocks = threading.local()
+        self._openLocks = []
+        self._lazyLock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        try:
+            if excType is None:
+                self.flush()
+            elif self._writeQueue is not None:
+                self._writeQueue.queue.join()
+        finally:
+            self.close()
 
     def get(self, datasetType, dataId={}, **kwArgs):
         """Retrieve a dataset."""
 
         datasetType = self._handleAlias(datasetType)
-        dataId = self._makeDataId(dataId, **kwArgs)
-        locationList = []
-        locationList = self.mapper.map(datasetType, dataId, False)
-        if len(locationList) == 0:
-            _fatal(RuntimeError,
-                    "Unrecognized dataset type {}".format(datasetType))
-        obj = None
-        for location in locationList:
-            obj = location.get(obj)
-        self.recordProvenance("get", datasetType, dataId, locationList)
-        return obj
+        with timer("butler.get", datasetType):
+            dataId = self._makeDataId(dataId, **kwArgs)
+            if self._writeQueue is not None and self._writeQueue.isPending(
+                    self._lockKind(datasetType, dataId)):
+                self._writeQueue.flush()
+            locationList = self.mapper.map(datasetType, dataId, False)
+            if len(locationList) == 0:
+                _fatal(RuntimeError,
+                        "Unrecognized dataset type {}".format(datasetType))
+            obj = self._load(datasetType, locationList)
+            self.recordProvenance("get", datasetType, dataId, locationList)
+            return obj
 
     def put(self, obj, datasetType, dataId={}, **kwArgs):
         """Persist a dataset."""
 
         datasetType = self._handleAlias(datasetType)
-        dataId = self._makeDataId(dataId, **kwArgs)
-        locationList = self.mapper.map(datasetType, dataId, True)
-        if len(locationList) == 0:
-            _fatal(RuntimeError,
-                    "Unrecognized dataset type {}".format(datasetType))
-        with self._lock(datasetType, dataId):
-            if self.mapper.datasetExists(datasetType, dataId):
-                if self.get(datasetType, dataId) == obj:
+        with timer("butler.put", datasetType):
+            dataId = self._makeDataId(dataId, **kwArgs)
+            self._checkWritable()
+            if self.writeBehind > 0:
+                self._getWriteQueue().put((obj, datasetType, dataId),
+                        self._lockKind(datasetType, dataId))
+                return
+            locationList = self.mapper.map(datasetType, dataId, True)
+            if len(locationList) == 0:
+                _fatal(RuntimeError,
+                        "Unrecognized dataset type {}".format(datasetType))
+            checksum = self._contentChecksum(obj, datasetType)
+            with self._lock(datasetType, dataId):
+                if self.mapper.datasetExists(datasetType, dataId):
+                    self._checkExisting(obj, checksum, datasetType, dataId,
+                            locationList)
                     return
-                _fatal(RuntimeError, "Attempt to overwrite dataset "
-                        "at {} (type={}, dataId={}) "
-                        "with different content: {}".format(
-                            location, datasetType, dataId, obj))
-            for location in locationList:
-                location.put(obj)
-            self.recordProvenance("put", datasetType, dataId, locationList)
+                self._timedWrite(datasetType, obj, locationList)
+                self._record(checksum, datasetType, dataId, locationList)
+
+    def getMany(self, requests):
+        """Retrieve a batch of datasets.
+
+        requests is a sequence of (datasetType, dataId) pairs.  All locations
+        are resolved in one pass through the mapper before any data is read,
+        and the readers for independent datasets run concurrently.  Returns
+        the list of objects in the same order as the requests."""
+
+        requests = [(self._handleAlias(datasetType), self._makeDataId(dataId))
+                for datasetType, dataId in requests]
+        locationLists = self.mapper.mapMany(requests, False)
+        for (datasetType, dataId), locationList in zip(
+                requests, locationLists):
+            if len(locationList) == 0:
+                _fatal(RuntimeError,
+                        "Unrecognized dataset type {}".format(datasetType))
+        objs = self._getPool().map(lambda args: self._load(*args),
+                zip([datasetType for datasetType, dataId in requests],
+                    locationLists))
+        for (datasetType, dataId), locationList in zip(
+                requests, locationLists):
+            self.recordProvenance("get", datasetType, dataId, locationList)
+        return objs
+
+    def putMany(self, items):
+        """Persist a batch of datasets.
+
+        items is a sequence of (obj, datasetType, dataId) triples.  All
+        locations are resolved in one pass through the mapper, the write
+        locks for every dataset are taken in a single transaction, and the
+        writers for independent datasets run concurrently."""
+
+        items = [(obj, self._handleAlias(datasetType),
+            self._makeDataId(dataId)) for obj, datasetType, dataId in items]
+        self._checkWritable()
+        if self.writeBehind > 0:
+            for obj, datasetType, dataId in items:
+                self._getWriteQueue().put((obj, datasetType, dataId),
+                        self._lockKind(datasetType, dataId))
+            return
+        self._putBatch(items)
+
+    def flush(self):
+        """Wait until the datasets queued by put and putMany in write-behind
+        mode are written, raising the first error writing any of them."""
+
+        if self._writeQueue is not None:
+            self._writeQueue.flush()
+
+    def close(self):
+        """Close the locks created by the threads using this Butler,
+        stopping their heartbeat threads.  Locks are created again as
+        needed if the Butler is used afterwards."""
+
+        with self._lazyLock:
+            openLocks, self._openLocks = self._openLocks, []
+            self._dbLocks = threading.local()
+        for dbLock in openLocks:
+            dbLock.close()
+
+    def ingest(self, datasetType, dataIds):
+        """Register existing datasets of a given type in the output
+        repository's registry in a single transaction."""
+
+        datasetType = self._handleAlias(datasetType)
+        self.mapper.ingestDatasets(datasetType, dataIds)
+
+    def verify(self, datasetType=None):
+        """Check the files of the datasets written to the output repository,
+        of all dataset types or only the given one, against the checksums
+        recorded when they were put.  Returns the list of (datasetType,
+        url, problem) for each missing or modified file."""
+
+        if datasetType is not None:
+            datasetType = self._handleAlias(datasetType)
+        files = [(recordType, url, digest, size)
+                for recordType, key, fileList in
+                self.mapper.getFileChecksums(datasetType)
+                for url, digest, size in fileList]
+        return [problem for problem in
+                self._getPool().map(lambda args: _verifyFile(*args), files)
+                if problem is not None]
 
     def getKeys(self, datasetType=None):
         """Return the list of keys understood by the Butler for a given
@@ -103,20 +287,57 @@ class Butler(object):
         return self.mapper.getDatasetTypes()
 
     def createDatasetType(self, datasetType, datasetClass, **kwargs):
-        """Create a new dataset type based on an existing dataset class."""
+        """Create a new dataset type based on an existing dataset class.
+        A read-only Butler cannot create dataset types: its mapper is shared
+        with the other Butlers of the repository in this process."""
 
         datasetType = self._handleAlias(datasetType)
-        return self.mapper.createDatasetType(datasetType, datasetClass, **kwargs)
-
-    def getRefSet(self, datasetType, partialDataId={}, **kwargs):
+        if self.readOnly:
+            _fatal(RuntimeError, "Cannot create dataset type {} with a "
+                    "read-only Butler of {}".format(datasetType,
+                        self.mapper.source))
+        result = self.mapper.createDatasetType(datasetType, datasetClass,
+                **kwargs)
+        self.mapper.writeConfig()
+        return result
+
+    def getRefSet(self, datasetType, partialDataId={}, **kwArgs):
         """Return the list of references to datasets of a given dataset type
         that match a partial data id."""
 
+        return list(self.iterRefSet(datasetType, partialDataId, **kwArgs))
+
+    def iterRefSet(self, datasetType, partialDataId={}, orderBy=None,
+            limit=None, after=None, **kwArgs):
+        """Iterate over references to datasets of a given dataset type that
+        match a partial data id, as they are found.  orderBy is a list of
+        keys to order by, limit bounds the number of references, and after
+        is a reference returned earlier to resume after, so that large
+        result sets can be read a page at a time."""
+
+        datasetType = self._handleAlias(datasetType)
+        partialDataId = self._makeDataId(partialDataId, **kwArgs)
+        for dataId in self.mapper.iterDatasets(datasetType, partialDataId,
+                orderBy, limit, after):
+            yield DataRef(self, dataId)
+
+    def getDataIdSet(self, datasetType, partialDataId={}, orderBy=None,
+            **kwArgs):
+        """Return the DataIdSet of the datasets of a given dataset type that
+        match a partial data id: the same dataIds as getRefSet, held as
+        columns, for enumerations too large for a dict per dataset."""
+
         datasetType = self._handleAlias(datasetType)
         partialDataId = self._makeDataId(partialDataId, **kwArgs)
-        return [DataRef(self, dataId)
-                for dataId in
-                self.mapper.listDatasets(self, datasetType, partialDataId)]
+        return DataIdSet.fromDataIds(self.mapper.iterDatasets(datasetType,
+            partialDataId, orderBy), butler=self)
+
+    def prefetch(self, datasetType, refSet, depth=4, maxBytes=None):
+        """Iterate over (dataRef, obj) pairs for the references in refSet,
+        reading up to depth datasets (and at most about maxBytes) ahead of
+        the consumer in the background."""
+
+        return PrefetchIterator(self, datasetType, refSet, depth, maxBytes)
 
     def defineAlias(self, alias, datasetType):
         """Define a dataset type alias.  This dataset type can be used in any
@@ -131,10 +352,15 @@ class Butler(object):
     def recordProvenance(self, op, datasetType, dataId, locationList):
         """Record provenance information."""
 
-        log.info("Provenance: {} {} {} {}".format(
-            op, datasetType, dataId, locationList))
-        self.provenance.append((op, datasetType, dataId, [repr(location) for
-            location in locationList]))
+        log.info("Provenance: %s %s %s %s",
+                op, datasetType, dataId, locationList)
+        if self.provenance is None:
+            with self._lazyLock:
+                if self.provenance is None:
+                    self.provenance = createProvenanceSink(
+                            self.mapper.config.get("provenance", {}),
+                            self.registryPath, self.readOnly)
+        self.provenance.record(op, datasetType, dataId)
 
 
 ###############################################################################
@@ -153,11 +379,171 @@ class Butler(object):
             return self.aliases[alias]
         return datasetType
 
+    def _checkWritable(self):
+        # Refuse a put before any file is written if the registry cannot
+        # record it.
+        if self.mapper.snapshot is not None:
+            _fatal(RuntimeError, "Cannot put datasets with a Butler reading "
+                    "the registry snapshot {}".format(
+                        self.mapper.snapshot.path))
+
+    def _putBatch(self, items):
+        locationLists = self.mapper.mapMany(
+                [(datasetType, dataId) for obj, datasetType, dataId in items],
+                True)
+        for (obj, datasetType, dataId), locationList in zip(
+                items, locationLists):
+            if len(locationList) == 0:
+                _fatal(RuntimeError,
+                        "Unrecognized dataset type {}".format(datasetType))
+        checksums = self._getPool().map(lambda item:
+                self._contentChecksum(item[0], item[1]), items)
+        kinds = [self._lockKind(datasetType, dataId)
+                for obj, datasetType, dataId in items]
+        with self._getDbLock().lockMany(kinds):
+            existing = set()
+            for i, (obj, datasetType, dataId) in enumerate(items):
+                if self.mapper.datasetExists(datasetType, dataId):
+                    self._checkExisting(obj, checksums[i], datasetType,
+                            dataId, locationLists[i])
+                    existing.add(i)
+            pending = [i for i in xrange(len(items)) if i not in existing]
+            self._getPool().map(lambda i: self._timedWrite(items[i][1],
+                items[i][0], locationLists[i]), pending)
+            self._recordMany([(checksums[i], items[i][1], items[i][2],
+                locationLists[i]) for i in pending])
+
+    def _load(self, datasetType, locationList):
+        if self.cache is None:
+            return self._timedRead(datasetType, locationList)
+        policy = self.mapper.getCachePolicy(datasetType)
+        if policy is None:
+            return self._timedRead(datasetType, locationList)
+        key = ObjectCache.makeKey(locationList)
+        found, obj = self.cache.get(key)
+        if found:
+            count("butler.cacheHit", datasetType)
+        else:
+            obj = self._timedRead(datasetType, locationList)
+            self.cache.put(key, obj, locationSize(locationList),
+                    policy.get("maxObjectBytes"))
+        return obj
+
+    def _timedRead(self, datasetType, locationList):
+        with timer("storage.read", datasetType):
+            return self._read(locationList)
+
+    def _timedWrite(self, datasetType, obj, locationList):
+        with timer("storage.write", datasetType):
+            self._write(obj, locationList)
+
+    def _contentChecksum(self, obj, datasetType):
+        # The (checksum, size) of the pickle of an object, or (None, None)
+        # if its dataset type is configured not to record them.
+        if not self.mapper.usesContentChecksum(datasetType):
+            return None, None
+        return objectChecksum(obj)
+
+    def _checkExisting(self, obj, checksum, datasetType, dataId,
+            locationList):
+        # An existing dataset whose recorded checksum matches is the same
+        # dataset and is not read back; without a recorded checksum, or if
+        # the checksum differs (pickling is not canonical for every object),
+        # fall back to comparing with the stored object.
+        stored = self.mapper.getDatasetChecksum(datasetType, dataId)
+        if checksum[0] is not None and stored is not None and \
+                stored[0] == checksum[0]:
+            count("butler.putUnchanged", datasetType)
+            return
+        count("butler.putReadBack", datasetType)
+        if self.get(datasetType, dataId) == obj:
+            if checksum[0] is not None and stored is None:
+                self.mapper.recordDataset(datasetType, dataId,
+                        checksum[0], checksum[1],
+                        locationChecksums(locationList))
+            return
+        _fatal(RuntimeError, "Attempt to overwrite dataset "
+                "at {} (type={}, dataId={}) "
+                "with different content: {}".format(
+                    locationList, datasetType, dataId, obj))
+
+    def _record(self, checksum, datasetType, dataId, locationList):
+        self._recordMany([(checksum, datasetType, dataId, locationList)])
+
+    def _recordMany(self, records):
+        # The datasets of each type are recorded in one transaction, with
+        # the checksums of their files, hashed concurrently.
+        byType = {}
+        locationLists = [record[3] for record in records]
+        fileLists = self._getPool().map(locationChecksums, locationLists) \
+                if len(records) > 1 else map(locationChecksums, locationLists)
+        for (checksum, datasetType, dataId, locationList), files in zip(
+                records, fileLists):
+            self._invalidate(locationList)
+            byType.setdefault(datasetType, []).append((dataId, checksum[0],
+                checksum[1], files))
+        for datasetType, entries in byType.iteritems():
+            self.mapper.recordDatasets(datasetType, entries)
+        for checksum, datasetType, dataId, locationList in records:
+            self.recordProvenance("put", datasetType, dataId, locationList)
+
+    def _invalidate(self, locationList):
+        if self.cache is not None:
+            self.cache.invalidate(location.url for location in locationList)
+
+    def _read(self, locationList):
+        obj = None
+        for location in locationList:
+            obj = location.get(obj)
+        return obj
+
+    def _write(self, obj, locationList):
+        for location in locationList:
+            location.put(obj)
+
+    def _getPool(self):
+        if self._pool is None:
+            with self._lazyLock:
+                if self._pool is None:
+                    self._pool = ThreadPool(self.maxThreads)
+        return self._pool
+
+    def _getWriteQueue(self):
+        if self._writeQueue is None:
+            with self._lazyLock:
+                if self._writeQueue is None:
+                    self._writeQueue = WriteBehindQueue(self,
+                            self.writeBehind)
+        return self._writeQueue
+
+    def _getDbLock(self):
+        # Lock ownership is per thread, so each thread has its own lock.
+        dbLock = getattr(self._dbLocks, "dbLock", None)
+        if dbLock is None:
+            dbLock = createLock(self.registryPath,
+                    self.mapper.config.get("lockBackend", "sqlite"))
+            with self._lazyLock:
+                self._dbLocks.dbLock = dbLock
+                self._openLocks.append(dbLock)
+        return dbLock
+
+    def _lockKind(self, datasetType, dataId):
+        return datasetType + ":" + repr(sorted(dataId.items()))
+
     def _lock(self, datasetType, dataId):
-        return DbLock(self.registryPath).lock(datasetType + ":" + repr(dataId))
+        return self._getDbLock().lock(self._lockKind(datasetType, dataId))
 
 ###############################################################################
 
+def _verifyFile(datasetType, url, digest, size):
+    try:
+        actual = fileChecksum(url)
+    except IOError:
+        return datasetType, url, "missing"
+    if actual != (digest, size):
+        return datasetType, url, "checksum mismatch"
+    return None
+
 def _fatal(exception, message):
     log.fatal(message)
     raise exception(message)
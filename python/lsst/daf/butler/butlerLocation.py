@@ -1,27 +1,72 @@
 import importlib
+import os
+import threading
+import urlparse
+
+# Per-process registry of storage callables, keyed by the readers/writers
+# entry ("module.Class.method") they were resolved from.
+_storageCache = {}
+_storageCacheLock = threading.Lock()
+
+def resolveStorage(storage):
+    """Return the callable for a storage entry of the form
+    "module.Class.method", importing and looking it up only the first time
+    it is used in this process."""
+
+    try:
+        return _storageCache[storage]
+    except KeyError:
+        pass
+    components = storage.rsplit(".", 2)
+    if len(components) < 3:
+        raise RuntimeError("No module or class for "
+                "storage {}".format(storage))
+    module = importlib.import_module(components[0])
+    if not hasattr(module, components[1]):
+        raise RuntimeError("No such class {} for storage {}".format(
+            components[1], storage))
+    cls = getattr(module, components[1])
+    if not hasattr(cls, components[2]):
+        raise RuntimeError("No such method {} for storage {}".format(
+            components[2], storage))
+    with _storageCacheLock:
+        return _storageCache.setdefault(storage, getattr(cls, components[2]))
 
 class ButlerLocation(object):
+    __slots__ = ("url", "storage", "dataId")
+
     def __init__(self, path, storage, dataId):
-        """Create a ButlerLocation object."""
+        """Create a ButlerLocation object.  storage is either a resolved
+        storage callable or a "module.Class.method" entry to resolve."""
 
         self.url = path
-        components = storage.rsplit(".", 2)
-        if len(components) < 3:
-            raise RuntimeError("No module or class for "
-                    "storage {}".format(storage))
-        module = importlib.import_module(components[0])
-        if not hasattr(module, components[1]):
-            raise RuntimeError("No such class {} for storage {}".format(
-                components[1], storage))
-        cls = getattr(module, components[1])
-        if not hasattr(cls, components[2]):
-            raise RuntimeError("No such method {} for storage {}".format(
-                components[2], storage))
-        self.storage = getattr(cls, components[2])
+        if isinstance(storage, basestring):
+            storage = resolveStorage(storage)
+        self.storage = storage
         self.dataId = dataId
 
+    def __repr__(self):
+        return "ButlerLocation({!r}, {}.{}, {!r})".format(self.url,
+                getattr(self.storage, "__module__", None),
+                getattr(self.storage, "__name__", None), self.dataId)
+
     def get(self, predecessor):
         return self.storage(self.url, self.dataId, predecessor)
 
     def put(self, obj):
         return self.storage(obj, self.url, self.dataId)
+
+def locationSize(locationList):
+    """Return the total size in bytes of the local files of a list of
+    locations; other locations count as empty."""
+
+    size = 0
+    for location in locationList:
+        parseResult = urlparse.urlparse(location.url, scheme="file")
+        if parseResult.scheme != "file":
+            continue
+        try:
+            size += os.path.getsize(parseResult.path)
+        except OSError:
+            pass
+    return size
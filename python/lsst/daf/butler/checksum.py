@@ -0,0 +1,54 @@
+import cPickle
+import hashlib
+import urlparse
+
+_chunkSize = 1 << 20
+
+class _HashWriter(object):
+    """A file-like object that hashes what is written to it."""
+
+    def __init__(self):
+        self.hash = hashlib.sha1()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+
+def objectChecksum(obj):
+    """Return the hex digest and size of the pickle stream of an object,
+    computed without holding the whole stream in memory."""
+
+    writer = _HashWriter()
+    cPickle.Pickler(writer, cPickle.HIGHEST_PROTOCOL).dump(obj)
+    return writer.hash.hexdigest(), writer.size
+
+def fileChecksum(path):
+    """Return the hex digest and size of a file, read in chunks."""
+
+    fileHash = hashlib.sha1()
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(_chunkSize)
+            if not data:
+                break
+            fileHash.update(data)
+            size += len(data)
+    return fileHash.hexdigest(), size
+
+def locationChecksums(locationList):
+    """Return a list of [url, digest, size] for the local files of a list of
+    locations."""
+
+    result = []
+    for location in locationList:
+        parseResult = urlparse.urlparse(location.url, scheme="file")
+        if parseResult.scheme != "file":
+            continue
+        try:
+            digest, size = fileChecksum(parseResult.path)
+        except IOError:
+            continue
+        result.append([location.url, digest, size])
+    return result
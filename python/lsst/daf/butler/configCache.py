@@ -0,0 +1,91 @@
+import cPickle
+import errno
+import hashlib
+import os
+import tempfile
+
+from instrumentation import count
+
+class ConfigCache(object):
+    """A cache of parsed repository configurations, stored as pickles in a
+    directory, one per source file and reader.
+
+    An entry is used only while its source file, and the write-ahead log
+    beside it for a registry, have the same inode, size and mtime as when
+    the entry was written, so that a configuration is parsed again only
+    after it changes.  A directory of None disables the cache; entries
+    that cannot be written are skipped."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def load(self, path, reader):
+        """Return reader(path), the parsed configuration of a file, from the
+        cache when the file has not changed since it was cached.  The
+        result is a new object at each call and may be modified."""
+
+        if self.directory is None:
+            return reader(path)
+        absPath = os.path.abspath(path)
+        try:
+            signature = _signature(absPath)
+        except OSError:
+            return reader(path)
+        name = "{}.{}".format(absPath, reader.__name__)
+        cachePath = os.path.join(self.directory,
+                hashlib.sha1(name).hexdigest() + ".pickle")
+        try:
+            with open(cachePath, "rb") as f:
+                entry = cPickle.load(f)
+            if entry["name"] == name and entry["signature"] == signature:
+                count("configCache.hit")
+                return entry["value"]
+        except Exception:
+            # Missing, partly written or from another version.
+            pass
+        count("configCache.miss")
+        value = reader(path)
+        self._store(cachePath, dict(name=name, signature=signature,
+            value=value))
+        return value
+
+    def _store(self, cachePath, entry):
+        try:
+            if not os.path.isdir(self.directory):
+                try:
+                    os.makedirs(self.directory)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            fd, tempPath = tempfile.mkstemp(dir=self.directory,
+                    prefix=".config")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+                os.rename(tempPath, cachePath)
+            except:
+                os.remove(tempPath)
+                raise
+        except (IOError, OSError, cPickle.PicklingError):
+            pass
+
+def _signature(path):
+    signature = []
+    for filePath in (path, path + "-wal"):
+        try:
+            st = os.stat(filePath)
+        except OSError:
+            if filePath == path:
+                raise
+            continue
+        signature.append((st.st_ino, st.st_size, st.st_mtime))
+    return signature
+
+# The configuration cache of this process, in DAF_BUTLER_CONFIG_CACHE or by
+# default in ~/.cache/daf_butler/config; an empty DAF_BUTLER_CONFIG_CACHE
+# disables it.
+_directory = os.environ.get("DAF_BUTLER_CONFIG_CACHE")
+if _directory is None:
+    _directory = os.path.join(os.path.expanduser("~"), ".cache",
+            "daf_butler", "config")
+configCache = ConfigCache(_directory or None)
@@ -0,0 +1,256 @@
+import array
+import itertools
+
+from dataRef import DataRef
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class DataIdSet(object):
+    """A sequence of dataIds with the same keys, held as one typed column
+    per key rather than one dict per dataId.
+
+    Columns of integers or floats are NumPy arrays when NumPy is available
+    and arrays otherwise; other columns are NumPy arrays or lists.
+    Filtering, grouping and set operations work on the columns and return
+    new DataIdSets, and DataRefs are created only for the dataIds that are
+    indexed or iterated over."""
+
+    def __init__(self, columns, length=None, butler=None):
+        """Create a DataIdSet from a dict mapping each key to its column.
+        length is needed only when there are no keys."""
+
+        lengths = set(len(column) for column in columns.itervalues())
+        if len(lengths) > 1:
+            raise RuntimeError("Columns of different lengths {} for a "
+                    "DataIdSet of keys {}".format(sorted(lengths),
+                        sorted(columns)))
+        self.columns = columns
+        self.keys = sorted(columns)
+        self.butler = butler
+        self._length = lengths.pop() if len(lengths) > 0 else (length or 0)
+
+    @staticmethod
+    def fromDataIds(dataIds, keys=None, butler=None):
+        """Return the DataIdSet of an iterable of dataIds, consumed one at a
+        time.  keys defaults to the keys of the first dataId; a dataId
+        without one of the keys has None for it."""
+
+        values = None
+        length = 0
+        for dataId in dataIds:
+            if values is None:
+                values = dict((key, []) for key in
+                        (dataId.keys() if keys is None else keys))
+            for key, column in values.iteritems():
+                column.append(dataId.get(key))
+            length += 1
+        if values is None:
+            values = dict((key, []) for key in keys or [])
+        return DataIdSet(dict((key, _makeColumn(column))
+            for key, column in values.iteritems()), length, butler)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for i in xrange(self._length):
+            yield self[i]
+
+    def __getitem__(self, index):
+        """Return the DataRef, or dataId without a Butler, at an index, or
+        the DataIdSet of a slice."""
+
+        if isinstance(index, slice):
+            return self.take(range(*index.indices(self._length)))
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("DataIdSet index out of range")
+        dataId = dict((key, _item(column[index]))
+                for key, column in self.columns.iteritems())
+        return DataRef(self.butler, dataId) if self.butler is not None \
+                else dataId
+
+    def __repr__(self):
+        return "DataIdSet({} dataIds of {})".format(self._length, self.keys)
+
+    def column(self, key):
+        """Return the column of a key."""
+        return self.columns[key]
+
+    def toDataIds(self):
+        """Return the dataIds as a list of dicts."""
+        columns = [(key, _toList(column))
+                for key, column in self.columns.iteritems()]
+        return [dict((key, column[i]) for key, column in columns)
+                for i in xrange(self._length)]
+
+    def take(self, indices):
+        """Return the DataIdSet of the dataIds at a sequence of indices."""
+        if numpy is not None:
+            indices = numpy.asarray(indices, dtype=numpy.intp)
+        return DataIdSet(dict((key, _take(column, indices))
+            for key, column in self.columns.iteritems()),
+            len(indices), self.butler)
+
+    def filter(self, mask):
+        """Return the DataIdSet of the dataIds where a sequence of booleans,
+        such as the result of a comparison of NumPy columns, is true."""
+        if numpy is not None:
+            return self.take(numpy.flatnonzero(numpy.asarray(mask,
+                dtype=bool)))
+        return self.take([i for i, selected in enumerate(mask) if selected])
+
+    def where(self, **conditions):
+        """Return the DataIdSet of the dataIds whose values equal the given
+        values, or are among them for lists, tuples and sets, as in
+        where(filter="r", visit=[1, 2])."""
+
+        mask = None
+        for key, value in conditions.iteritems():
+            column = self.columns[key]
+            multiple = isinstance(value, (list, tuple, set, frozenset))
+            if numpy is not None:
+                if multiple:
+                    keyMask = numpy.in1d(column, list(value))
+                else:
+                    keyMask = numpy.asarray(column == value, dtype=bool)
+                    if keyMask.shape != (self._length,):
+                        # A value not comparable with the column's type.
+                        keyMask = numpy.zeros(self._length, dtype=bool)
+                mask = keyMask if mask is None else mask & keyMask
+            else:
+                if multiple:
+                    value = set(value)
+                    keyMask = [v in value for v in column]
+                else:
+                    keyMask = [v == value for v in column]
+                mask = keyMask if mask is None else \
+                        [a and b for a, b in itertools.izip(mask, keyMask)]
+        if mask is None:
+            return self
+        return self.filter(mask)
+
+    def groupBy(self, *keys):
+        """Return a list of (values, DataIdSet) pairs, one for each distinct
+        tuple of values of the given keys, sorted by values."""
+
+        if self._length == 0:
+            return []
+        if numpy is not None and all(self.columns[key].dtype != object
+                for key in keys):
+            columns = [self.columns[key] for key in keys]
+            order = numpy.lexsort(columns[::-1]) if len(columns) > 0 \
+                    else numpy.arange(self._length)
+            changed = numpy.zeros(self._length, dtype=bool)
+            changed[0] = True
+            for column in columns:
+                sortedColumn = column[order]
+                changed[1:] |= sortedColumn[1:] != sortedColumn[:-1]
+            starts = numpy.flatnonzero(changed).tolist() + [self._length]
+            return [(tuple(_item(column[order[start]])
+                for column in columns), self.take(order[start:end]))
+                for start, end in zip(starts[:-1], starts[1:])]
+        groups = {}
+        for i, values in enumerate(self._rows(keys)):
+            groups.setdefault(values, []).append(i)
+        return [(values, self.take(groups[values]))
+                for values in sorted(groups)]
+
+    def project(self, *keys):
+        """Return the DataIdSet of the distinct dataIds of a subset of the
+        keys, sorted."""
+
+        return DataIdSet.fromDataIds((dict(zip(keys, values))
+            for values, group in self.groupBy(*keys)), keys, self.butler)
+
+    def unique(self):
+        """Return the DataIdSet of the distinct dataIds, sorted."""
+        return self.project(*self.keys)
+
+    def intersection(self, other):
+        """Return the DataIdSet of the dataIds whose values of the keys
+        shared with other, which may be of another dataset type, are those
+        of a dataId of other."""
+        return self._match(other, True)
+
+    def difference(self, other):
+        """Return the DataIdSet of the dataIds whose values of the keys
+        shared with other match none of its dataIds."""
+        return self._match(other, False)
+
+    def union(self, other):
+        """Return the DataIdSet of the distinct dataIds of this set and of
+        other, which must have the same keys, sorted."""
+
+        if self.keys != other.keys:
+            raise RuntimeError("Cannot take the union of DataIdSets of "
+                    "keys {} and {}".format(self.keys, other.keys))
+        return DataIdSet(dict((key, _concatenate(column, other.columns[key]))
+            for key, column in self.columns.iteritems()),
+            self._length + len(other), self.butler).unique()
+
+    def _match(self, other, keep):
+        keys = [key for key in self.keys if key in other.columns]
+        found = set(other._rows(keys))
+        return self.filter([(values in found) == keep
+            for values in self._rows(keys)])
+
+    def _rows(self, keys):
+        # The tuples of values of keys, one per dataId.
+        columns = [_toList(self.columns[key]) for key in keys]
+        if len(columns) == 0:
+            return [()] * self._length
+        return zip(*columns)
+
+def _makeColumn(values):
+    # A typed column: integers and floats in arrays, others in NumPy
+    # arrays of strings or objects, or lists.
+    if all(isinstance(v, (int, long)) and not isinstance(v, bool)
+            for v in values):
+        typeCode = "l"
+    elif all(isinstance(v, (int, long, float)) and not isinstance(v, bool)
+            for v in values):
+        typeCode = "d"
+    else:
+        typeCode = None
+    if numpy is not None:
+        if typeCode is not None:
+            return numpy.array(values,
+                    dtype=numpy.int64 if typeCode == "l" else numpy.float64)
+        if len(values) > 0 and all(isinstance(v, basestring)
+                for v in values):
+            return numpy.array(values)
+        column = numpy.empty(len(values), dtype=object)
+        column[:] = values
+        return column
+    if typeCode is not None:
+        return array.array(typeCode, values)
+    return values
+
+def _take(column, indices):
+    if numpy is not None:
+        return column[indices]
+    if isinstance(column, array.array):
+        return array.array(column.typecode, (column[i] for i in indices))
+    return [column[i] for i in indices]
+
+def _concatenate(column, other):
+    if numpy is not None:
+        return _makeColumn(_toList(column) + _toList(other)) \
+                if column.dtype != other.dtype else \
+                numpy.concatenate([column, other])
+    if isinstance(column, array.array) and isinstance(other, array.array) \
+            and column.typecode == other.typecode:
+        return column + other
+    return _makeColumn(_toList(column) + _toList(other))
+
+def _toList(column):
+    return column.tolist() if hasattr(column, "tolist") else list(column)
+
+def _item(value):
+    # A plain Python value for a NumPy scalar.
+    return value.item() if hasattr(value, "item") else value
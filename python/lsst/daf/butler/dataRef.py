@@ -1,4 +1,16 @@
 class DataRef(dict):
-    def __init__(self, butler, **kwargs):
-        super(DataId, self).__init__(**kwargs)
+    """A dataId bound to a Butler.  As a dict, get and the other dict
+    methods read its keys; its datasets are read and written with
+    getDataset and putDataset."""
+
+    def __init__(self, butler, dataId=None, **kwargs):
+        super(DataRef, self).__init__(dataId or {}, **kwargs)
         self.butler = butler
+
+    def getDataset(self, datasetType, **kwArgs):
+        """Retrieve the dataset of a given type for this data id."""
+        return self.butler.get(datasetType, self, **kwArgs)
+
+    def putDataset(self, obj, datasetType, **kwArgs):
+        """Persist a dataset of a given type for this data id."""
+        return self.butler.put(obj, datasetType, self, **kwArgs)
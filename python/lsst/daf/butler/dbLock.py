@@ -1,64 +1,442 @@
+import atexit
 import contextlib
+import errno
+import logging as log
 import os
+import random
 import socket
 import sqlite3
+import threading
+import time
+import weakref
+import zlib
+
+from instrumentation import count, timer
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    TimeoutError
+except NameError:
+    class TimeoutError(RuntimeError):
+        pass
+
+# Per-process condition variables, keyed by lock database or lock file path,
+# used to wake waiters in this process as soon as a lock is released instead
+# of at their next poll.
+_conditions = {}
+_conditionsLock = threading.Lock()
+
+# The DbLocks of this process, closed at exit so that no heartbeat thread is
+# left running while the interpreter shuts down.
+_liveLocks = weakref.WeakSet()
+_liveLocksLock = threading.Lock()
+
+def _getCondition(path):
+    with _conditionsLock:
+        if path not in _conditions:
+            _conditions[path] = threading.Condition()
+        return _conditions[path]
+
+def _pidAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
 
 class DbLock(object):
-    
-    def __init__(self, db, timeout=5.0):
+    """Named locks shared by all processes using a repository registry.
+
+    A lock is a row of the _lock table.  Each row carries a lease that the
+    owning process renews from a heartbeat thread; rows whose lease has
+    expired, or whose owner was a process on this host that no longer
+    exists, are reclaimed by the next process that wants the lock.  Waiters
+    in the same process are woken as soon as a lock is released; waiters in
+    other processes poll with an exponential backoff starting at a
+    millisecond, so there is no fixed sleep quantum."""
+
+    def __init__(self, db, timeout=5.0, leaseTime=30.0, maxPoll=0.05):
+        if isinstance(db, basestring):
+            self.path = db
+            db = sqlite3.connect(db, timeout=timeout, isolation_level=None,
+                    check_same_thread=False)
+        else:
+            self.path = repr(db)
         self.db = db
         self.timeout = timeout
+        self.leaseTime = leaseTime
+        self.maxPoll = maxPoll
         db.execute("CREATE TABLE IF NOT EXISTS _lock"
-                "(kind STRING PRIMARY KEY, owner STRING);")
-        host = socket.getfqdn()
-        pid = os.getpid()
+                "(kind STRING PRIMARY KEY, owner STRING, "
+                "host STRING, pid INTEGER, expires REAL);")
+        columns = set(row[1] for row in db.execute("PRAGMA table_info(_lock)"))
+        for column, columnType in (("host", "STRING"), ("pid", "INTEGER"),
+                ("expires", "REAL")):
+            if column not in columns:
+                db.execute("ALTER TABLE _lock ADD COLUMN {} {}".format(
+                    column, columnType))
+        self.host = socket.getfqdn()
+        self.pid = os.getpid()
         thread = threading.currentThread().ident
-        self.ownerId = "host {} pid {} thread {}".format(host, pid, thread)
+        self.ownerId = "host {} pid {} thread {}".format(
+                self.host, self.pid, thread)
         self.owned = set()
+        self.condition = _getCondition(self.path)
+        self._dbLock = threading.RLock()
+        self._heartbeat = None
+        self._heartbeatEvent = threading.Event()
+        self._closed = False
+        with _liveLocksLock:
+            _liveLocks.add(self)
 
     def _tryLock(self, kind):
-        try:
-            self.db.execute("INSERT OR ABORT INTO _lock VALUES (?, ?)",
-                    (kind, self.ownerId))
-            self.owned.add(kind)
-            return True
-        except sqlite3.IntegrityError:
-            return False
+        return self._tryLockMany([kind])
+
+    def _tryLockMany(self, kinds):
+        expires = time.time() + self.leaseTime
+        with self._dbLock:
+            try:
+                self.db.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError:
+                return False
+            try:
+                self.db.executemany("INSERT OR ABORT INTO _lock "
+                        "(kind, owner, host, pid, expires) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        [(kind, self.ownerId, self.host, self.pid, expires)
+                            for kind in kinds])
+            except sqlite3.IntegrityError:
+                self.db.execute("ROLLBACK")
+                return False
+            self.db.execute("COMMIT")
+            self.owned.update(kinds)
+            self._startHeartbeat()
+        return True
+
+    def _reclaimStale(self, kinds):
+        """Delete the rows of locks among kinds whose lease has expired or
+        whose owner is a dead process on this host.  Returns True if any
+        row was reclaimed."""
+        now = time.time()
+        reclaimed = False
+        with self._dbLock:
+            for kind in kinds:
+                cur = self.db.execute("SELECT owner, host, pid, expires "
+                        "FROM _lock WHERE kind = ?", (kind,))
+                result = cur.fetchone()
+                if result is None:
+                    reclaimed = True
+                    continue
+                owner, host, pid, expires = result
+                if (expires is not None and expires >= now) and \
+                        (host != self.host or pid is None or _pidAlive(pid)):
+                    continue
+                cur = self.db.execute("DELETE FROM _lock WHERE kind = ? "
+                        "AND owner = ? AND expires IS ?",
+                        (kind, owner, expires))
+                if cur.rowcount > 0:
+                    reclaimed = True
+        return reclaimed
+
+    def _wait(self, kinds, tryLock):
+        with timer("lock.acquire"):
+            if self._poll(kinds, tryLock):
+                return
+        holders = []
+        with self._dbLock:
+            for kind in kinds:
+                result = self.db.execute("SELECT owner FROM _lock "
+                        "WHERE kind = ?", (kind,)).fetchone()
+                if result is not None:
+                    holders.append("{} held by {}".format(kind, result[0]))
+        raise TimeoutError("{} could not acquire lock of kind {}".format(
+            self.ownerId, ", ".join(holders) or ", ".join(kinds)))
+
+    def _poll(self, kinds, tryLock):
+        startTime = time.time()
+        delay = 0.001
+        while True:
+            if tryLock():
+                return True
+            if self._reclaimStale(kinds) and tryLock():
+                return True
+            count("lock.retry")
+            remaining = self.timeout - (time.time() - startTime)
+            if remaining <= 0:
+                return False
+            with self.condition:
+                self.condition.wait(min(delay * (0.5 + random.random()),
+                    remaining))
+            delay = min(delay * 2, self.maxPoll)
 
     def acquire(self, kind):
         if kind in self.owned:
             return
-        startTime = time.time()
-        while time.time ()- startTime < self.timeout:
-            if self._tryLock(kind):
-                return
-            time.sleep(0.5)
-        cur = self.db.cursor()
-        cur.execute("SELECT owner FROM _lock WHERE kind = ?", (kind,))
-        result = cur.fetchall()
-        if len(result) == 0 and self._tryLock(kind):
+        self._wait([kind], lambda: self._tryLock(kind))
+
+    def acquireMany(self, kinds):
+        """Acquire locks of several kinds atomically in one transaction:
+        either all of them are taken or none are."""
+        kinds = sorted(set(kinds).difference(self.owned))
+        if len(kinds) == 0:
+            return
+        self._wait(kinds, lambda: self._tryLockMany(kinds))
+
+    def release(self, kind):
+        self.releaseMany([kind])
+
+    def releaseMany(self, kinds):
+        """Release locks of several kinds in one transaction."""
+        kinds = sorted(set(kinds))
+        for kind in kinds:
+            if kind not in self.owned:
+                raise RuntimeError(
+                        "Trying to release unowned lock of kind {}".format(
+                            kind))
+        with self._dbLock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for kind in kinds:
+                    cur = self.db.execute("SELECT owner FROM _lock "
+                            "WHERE kind = ?", (kind,))
+                    result = cur.fetchall()
+                    if len(result) == 0 or result[0][0] != self.ownerId:
+                        raise RuntimeError(
+                                "{} tried to release lock of kind {} "
+                                "held by another owner {}".format(
+                                    self.ownerId, kind,
+                                    result[0][0] if result else None))
+                self.db.executemany("DELETE FROM _lock WHERE kind = ? "
+                        "AND owner = ?", [(kind, self.ownerId)
+                            for kind in kinds])
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            self.owned.difference_update(kinds)
+            if len(self.owned) == 0:
+                self._heartbeatEvent.set()
+        with self.condition:
+            self.condition.notify_all()
+
+    def _startHeartbeat(self):
+        # Called with self._dbLock held.
+        if self._heartbeat is not None:
+            return
+        self._heartbeatEvent.clear()
+        self._heartbeat = threading.Thread(target=self._renewLeases,
+                name="DbLock heartbeat")
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+
+    def _renewLeases(self):
+        # Runs while locks are held; exits as soon as the last one is
+        # released or the lock is closed.  A release of the last lock
+        # followed by a new acquisition before this thread woke leaves the
+        # event set: it is cleared so that the thread goes back to renewing
+        # at the lease interval.  A renewal that fails, typically because
+        # the database is busy, is retried at the next tick.
+        try:
+            while True:
+                woken = self._heartbeatEvent.wait(self.leaseTime / 3.0)
+                with self._dbLock:
+                    if self._closed or len(self.owned) == 0:
+                        self._heartbeat = None
+                        return
+                    if woken:
+                        self._heartbeatEvent.clear()
+                        continue
+                    count("lock.renew")
+                    try:
+                        self.db.execute("UPDATE _lock SET expires = ? "
+                                "WHERE owner = ?",
+                                (time.time() + self.leaseTime, self.ownerId))
+                    except sqlite3.OperationalError as e:
+                        count("lock.renewFailed")
+                        log.warning("Failed to renew the leases of %s: %s",
+                                self.ownerId, e)
+        finally:
+            with self._dbLock:
+                if self._heartbeat is threading.currentThread():
+                    self._heartbeat = None
+
+    def close(self):
+        """Stop renewing the leases of the locks held, waiting for the
+        heartbeat thread to exit."""
+        with self._dbLock:
+            self._closed = True
+            self._heartbeatEvent.set()
+            heartbeat = self._heartbeat
+        if heartbeat is not None and \
+                heartbeat is not threading.currentThread():
+            heartbeat.join()
+
+    @contextlib.contextmanager
+    def lock(self, kind):
+        self.acquire(kind)
+        try:
+            yield
+        finally:
+            self.release(kind)
+
+    @contextlib.contextmanager
+    def lockMany(self, kinds):
+        kinds = set(kinds).difference(self.owned)
+        self.acquireMany(kinds)
+        try:
+            yield
+        finally:
+            self.releaseMany(kinds)
+
+# Per-process state of fcntl lock files: the open file descriptor (closing
+# any descriptor of a file drops all of the process's locks on it) and the
+# number of holders of each locked byte in this process.
+_lockFiles = {}
+
+class FcntlLock(object):
+    """Named locks for single-host deployments using fcntl byte-range locks.
+
+    Each lock kind maps to one byte of a lock file.  The kernel drops the
+    locks of a process when it dies, so stale locks cannot occur, and taking
+    or testing a lock is a system call rather than a database transaction.
+    Threads of one process are serialized by the kinds they hold in memory,
+    since fcntl locks are owned by processes."""
+
+    def __init__(self, path, timeout=5.0, maxPoll=0.05):
+        if fcntl is None:
+            raise RuntimeError("fcntl locks are not available on this "
+                    "platform")
+        self.path = path
+        self.timeout = timeout
+        self.maxPoll = maxPoll
+        self.owned = set()
+        self.condition = _getCondition(path)
+        with self.condition:
+            if path not in _lockFiles:
+                _lockFiles[path] = dict(
+                        fd=os.open(path, os.O_RDWR | os.O_CREAT, 0o666),
+                        kinds=set(), bytes={})
+            self._state = _lockFiles[path]
+
+    def _offset(self, kind):
+        return zlib.crc32(kind) & 0x7fffffff
+
+    def _tryLockMany(self, kinds):
+        # Called with self.condition held.
+        state = self._state
+        if not state["kinds"].isdisjoint(kinds):
+            return False
+        taken = []
+        try:
+            for offset in sorted(set(self._offset(kind) for kind in kinds)):
+                if offset not in state["bytes"]:
+                    try:
+                        fcntl.lockf(state["fd"],
+                                fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+                    except IOError as e:
+                        if e.errno in (errno.EACCES, errno.EAGAIN):
+                            return False
+                        raise
+                    state["bytes"][offset] = 0
+                state["bytes"][offset] += 1
+                taken.append(offset)
+            # Keep the bytes on success; give them back on failure.
+            taken = []
+        finally:
+            self._releaseOffsets(taken)
+        state["kinds"].update(kinds)
+        self.owned.update(kinds)
+        return True
+
+    def _releaseOffsets(self, offsets):
+        state = self._state
+        for offset in offsets:
+            state["bytes"][offset] -= 1
+            if state["bytes"][offset] == 0:
+                del state["bytes"][offset]
+                fcntl.lockf(state["fd"], fcntl.LOCK_UN, 1, offset)
+
+    def acquireMany(self, kinds):
+        kinds = sorted(set(kinds).difference(self.owned))
+        if len(kinds) == 0:
             return
-        raise TimeoutError(
-                "{} could not acquire lock of kind {} held by {}".format(
-                    self.ownerId, kind, result[0][0]))
+        with timer("lock.acquire"):
+            self._acquireMany(kinds)
+
+    def _acquireMany(self, kinds):
+        startTime = time.time()
+        delay = 0.001
+        with self.condition:
+            while True:
+                if self._tryLockMany(kinds):
+                    return
+                count("lock.retry")
+                remaining = self.timeout - (time.time() - startTime)
+                if remaining <= 0:
+                    raise TimeoutError("pid {} could not acquire lock of "
+                            "kind {} in {}".format(os.getpid(),
+                                ", ".join(kinds), self.path))
+                self.condition.wait(min(delay * (0.5 + random.random()),
+                    remaining))
+                delay = min(delay * 2, self.maxPoll)
+
+    def acquire(self, kind):
+        self.acquireMany([kind])
+
+    def releaseMany(self, kinds):
+        kinds = set(kinds)
+        for kind in kinds:
+            if kind not in self.owned:
+                raise RuntimeError(
+                        "Trying to release unowned lock of kind {}".format(
+                            kind))
+        with self.condition:
+            self._releaseOffsets([self._offset(kind) for kind in kinds])
+            self._state["kinds"].difference_update(kinds)
+            self.owned.difference_update(kinds)
+            self.condition.notify_all()
 
     def release(self, kind):
-        if kind not in self.owned:
-            raise RuntimeError(
-                    "Trying to release unowned lock of kind {}".format(kind))
-        cur = self.db.cursor()
-        cur.execute("SELECT owner FROM _lock WHERE kind = ?", (kind,))
-        result = cur.fetchall()
-        if result[0][0] != self.ownerId:
-            raise RuntimeError(
-                    "{} tried to release lock of kind {}"
-                    "held by another owner {}".format(
-                        self.ownerId, kind, result[0][0]))
-        self.db.execute("DELETE FROM _lock WHERE kind = ?", (kind,))
-        self.owned.remove(kind)
+        self.releaseMany([kind])
+
+    def close(self):
+        pass
 
     @contextlib.contextmanager
     def lock(self, kind):
         self.acquire(kind)
-        yield
-        self.release(kind)
+        try:
+            yield
+        finally:
+            self.release(kind)
+
+    @contextlib.contextmanager
+    def lockMany(self, kinds):
+        kinds = set(kinds).difference(self.owned)
+        self.acquireMany(kinds)
+        try:
+            yield
+        finally:
+            self.releaseMany(kinds)
+
+def _closeLocks():
+    with _liveLocksLock:
+        locks = list(_liveLocks)
+    for dbLock in locks:
+        dbLock.close()
+
+atexit.register(_closeLocks)
+
+def createLock(registryPath, backend="sqlite", timeout=5.0):
+    """Create the lock of a repository for a given backend: "sqlite" for
+    leased rows in the registry, "fcntl" for byte-range locks on a lock file
+    beside it."""
+    if backend == "sqlite":
+        return DbLock(registryPath, timeout)
+    if backend == "fcntl":
+        return FcntlLock(os.path.splitext(registryPath)[0] + ".lock", timeout)
+    raise ValueError("Unknown lock backend {}".format(backend))
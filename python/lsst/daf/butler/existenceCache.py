@@ -0,0 +1,133 @@
+import hashlib
+import math
+import struct
+import threading
+import time
+
+class BloomFilter(object):
+    """A Bloom filter of string keys: a key that was added is always found,
+    and one that was not is found with probability about errorRate while
+    at most capacity keys have been added."""
+
+    def __init__(self, capacity, errorRate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(int(math.ceil(-capacity * math.log(errorRate) /
+            math.log(2) ** 2)), 64)
+        self.hashes = max(int(round(float(self.size) / capacity *
+            math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                for position in self._positions(key))
+
+    def _positions(self, key):
+        # Double hashing on the two halves of an MD5 digest.
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        first, second = struct.unpack("<QQ", hashlib.md5(key).digest())
+        second |= 1
+        return [(first + i * second) % self.size
+                for i in xrange(self.hashes)]
+
+class ExistenceCache(object):
+    """Known existence of the datasets of one repository, by dataset type
+    and dataset key.
+
+    Results of existence checks, positive and negative, are kept, and a
+    Bloom filter of the keys of all datasets of a type can be set so that
+    keys not in it are known not to exist without a probe.  Datasets
+    recorded through the repository's mapper are added to both.  The
+    results are dropped every maxAge seconds, to see datasets written by
+    other processes, and when there are more than maxEntries of them.  A
+    filter set with the registry generation it was built at is kept until
+    generation(), checked every maxAge seconds, returns another value;
+    other filters are dropped with the results."""
+
+    def __init__(self, maxAge=60.0, maxEntries=100000, generation=None):
+        self.maxAge = maxAge
+        self.maxEntries = maxEntries
+        self.generation = generation
+        self.results = {}
+        self.filters = {}
+        self.filterGenerations = {}
+        self.recordCount = 0
+        self._created = time.time()
+        self._lock = threading.Lock()
+
+    def lookup(self, datasetType, key):
+        """Return whether a dataset exists, or None if it is not known."""
+        with self._lock:
+            self._expire()
+            exists = self.results.get((datasetType, key))
+            if exists is not None:
+                return exists
+            bloomFilter = self.filters.get(datasetType)
+            if bloomFilter is not None and key not in bloomFilter:
+                return False
+            return None
+
+    def store(self, datasetType, key, exists):
+        with self._lock:
+            if len(self.results) >= self.maxEntries:
+                self.results.clear()
+            self.results[(datasetType, key)] = exists
+
+    def hasFilter(self, datasetType):
+        """Return whether a filter was set, or found impossible to build,
+        for a dataset type."""
+        with self._lock:
+            self._expire()
+            return datasetType in self.filters
+
+    def setFilter(self, datasetType, keys, recordCount, generation=None):
+        """Set the filter of a dataset type from the keys of all its
+        datasets, or None if they cannot all be keyed.  recordCount is the
+        value of the recordCount attribute before the keys were read: the
+        filter is not set if datasets were recorded since then.  generation
+        is the registry generation read before the keys, if they came from
+        the registry."""
+        bloomFilter = None
+        if keys is not None:
+            # Room for datasets recorded later.
+            bloomFilter = BloomFilter(2 * len(keys) + 1024)
+            for key in keys:
+                bloomFilter.add(key)
+        with self._lock:
+            if recordCount == self.recordCount:
+                self.filters[datasetType] = bloomFilter
+                self.filterGenerations[datasetType] = generation
+
+    def recorded(self, datasetType, keys):
+        """Note that datasets of a type were written."""
+        with self._lock:
+            self.recordCount += 1
+            bloomFilter = self.filters.get(datasetType)
+            for key in keys:
+                self.results[(datasetType, key)] = True
+                if bloomFilter is not None:
+                    bloomFilter.add(key)
+
+    def clear(self):
+        with self._lock:
+            self.results.clear()
+            self.filters.clear()
+            self.filterGenerations.clear()
+            self._created = time.time()
+
+    def _expire(self):
+        if time.time() - self._created >= self.maxAge:
+            self.results.clear()
+            current = None
+            if self.generation is not None and any(generation is not None
+                    for generation in self.filterGenerations.itervalues()):
+                current = self.generation()
+            for datasetType, generation in self.filterGenerations.items():
+                if generation is None or generation != current:
+                    del self.filters[datasetType]
+                    del self.filterGenerations[datasetType]
+            self._created = time.time()
@@ -0,0 +1,392 @@
+import errno
+import hashlib
+import json
+import os
+import sqlite3
+import stat
+import threading
+import time
+
+from instrumentation import timer
+import storage
+
+# Maximum number of values bound in one IN clause.
+_maxInValues = 500
+
+# The directory of the indexes of repositories that cannot be written, in
+# DAF_BUTLER_INDEX_CACHE or by default in ~/.cache/daf_butler/index; an
+# empty DAF_BUTLER_INDEX_CACHE keeps them in memory.
+_cacheDirectory = os.environ.get("DAF_BUTLER_INDEX_CACHE")
+if _cacheDirectory is None:
+    _cacheDirectory = os.path.join(os.path.expanduser("~"), ".cache",
+            "daf_butler", "index")
+_cacheDirectory = _cacheDirectory or None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+class FileIndex(object):
+    """A persistent index of the dataset files in a repository.
+
+    The index records (datasetType, dataId, relative path, size, mtime) for
+    every file in the repository that matches one of the dataset types' URL
+    templates.  It is stored in _butler_index.sqlite3 beside the repository's
+    _butler.sqlite3 and is built by walking only the directories below each
+    template's glob prefix.  Later refreshes list a directory again only if
+    its mtime has changed, so an unchanged repository costs one stat per
+    directory rather than a full glob per query.  The index of a repository
+    that cannot be written is kept in the user's cache directory instead,
+    or in memory if that cannot be written either.
+
+    Templates of other schemes with a storage backend that can list
+    directories, such as http, are indexed by listing the directories below
+    their glob prefixes through the backend.  Their paths in the index are
+    full URLs, and as remote directories have no mtime, they are listed
+    again at each refresh."""
+
+    def __init__(self, repoPath, templates, maxAge=60.0):
+        """Open or create the index of repoPath for templates, a dict
+        mapping dataset types to lists of UrlTemplates.  The index is
+        refreshed before a query when it is older than maxAge seconds."""
+
+        self.repoPath = repoPath
+        self.templates = dict((datasetType, [t for t in templateList
+            if t.scheme == "file" or _canList(t.scheme)])
+            for datasetType, templateList in templates.iteritems())
+        self.maxAge = maxAge
+        self.lastRefresh = None
+        self._lock = threading.RLock()
+        self.indexPath, self.db = _openIndex(repoPath)
+
+        # Throw the index away if the templates it was built from changed.
+        signature = json.dumps(sorted(
+            (datasetType, [t.template for t in templateList])
+            for datasetType, templateList in self.templates.iteritems()))
+        cur = self.db.execute("SELECT templates FROM _indexConfig")
+        result = cur.fetchall()
+        if len(result) != 1 or result[0][0] != signature:
+            self.db.execute("DELETE FROM _indexConfig")
+            self.db.execute("DELETE FROM _dirs")
+            self.db.execute("DELETE FROM _files")
+            self.db.execute("INSERT INTO _indexConfig VALUES (?)",
+                    (signature,))
+        self.db.commit()
+
+    def refresh(self, force=False):
+        """Bring the index up to date with the filesystem if it is older than
+        maxAge seconds or if force is set."""
+
+        with self._lock:
+            if not force and self.lastRefresh is not None and \
+                    time.time() - self.lastRefresh < self.maxAge:
+                return
+            self.lastRefresh = time.time()
+            with timer("fileIndex.refresh"):
+                roots = set()
+                for templateList in self.templates.itervalues():
+                    for template in templateList:
+                        prefix = _prefix(template)
+                        if len(template.keys) == 0:
+                            self._indexFile(prefix + template.path)
+                        else:
+                            roots.add(prefix +
+                                    template.globPrefix.rstrip("/"))
+                # Nested prefixes are covered by the walk of their ancestor.
+                for root in sorted(roots):
+                    if not any(root.startswith(other + "/") or
+                            (other == "" and root != "" and
+                                storage.isLocal(root)) for other in roots):
+                        self._walk(root)
+                self.db.commit()
+
+    def find(self, datasetType, dataId):
+        """Return the list of (dataId, path, size, mtime) tuples of indexed
+        files of a dataset type matching a partial dataId."""
+
+        with self._lock:
+            self.refresh()
+            results = []
+            with timer("fileIndex.find", datasetType):
+                for template in self.templates.get(datasetType, []):
+                    cur = self.db.execute("SELECT path, dataId, size, mtime "
+                            "FROM _files WHERE datasetType = ? "
+                            "AND path GLOB ?",
+                            (datasetType, _prefix(template) +
+                                template.globPattern(dataId)))
+                    for path, foundDataId, size, mtime in cur:
+                        foundDataId = json.loads(foundDataId)
+                        if not template.matches(foundDataId, dataId):
+                            continue
+                        newDataId = dataId.copy()
+                        newDataId.update(foundDataId)
+                        results.append((newDataId, path, size, mtime))
+            return results
+
+    def iterFind(self, datasetType, dataId, after=None, pageSize=1000):
+        """Yield the dataIds of indexed files of a dataset type matching a
+        partial dataId, in order of the paths of its first template.  Rows
+        are read a page at a time, and the index is not locked while the
+        caller consumes a page.  after is a dataId previously returned, to
+        resume enumeration after it."""
+
+        templates = self.templates.get(datasetType, [])
+        if len(templates) == 0:
+            return
+        template = templates[0]
+        with self._lock:
+            self.refresh()
+        last = self.sortKey(datasetType, after)[0] \
+                if after is not None else None
+        pattern = _prefix(template) + template.globPattern(dataId)
+        while True:
+            query = "SELECT path, dataId FROM _files " \
+                    "WHERE datasetType = ? AND path GLOB ?"
+            values = [datasetType, pattern]
+            if last is not None:
+                query += " AND path > ?"
+                values.append(last)
+            with self._lock:
+                rows = self.db.execute(query + " ORDER BY path LIMIT ?",
+                        values + [pageSize]).fetchall()
+            for path, foundDataId in rows:
+                foundDataId = json.loads(foundDataId)
+                if template.matches(foundDataId, dataId):
+                    newDataId = dataId.copy()
+                    newDataId.update(foundDataId)
+                    yield newDataId
+            if len(rows) < pageSize:
+                return
+            last = rows[-1][0]
+
+    def sortKey(self, datasetType, dataId):
+        """Return the tuple by which iterFind orders a complete dataId."""
+
+        template = self.templates[datasetType][0]
+        return (_prefix(template) + template.formatPath(dataId),)
+
+    def existsMany(self, datasetType, dataIds):
+        """Return, for each of a list of complete dataIds, whether the file
+        of its dataset type's first template is indexed, checking them in
+        batches."""
+
+        templates = self.templates.get(datasetType, [])
+        if len(templates) == 0:
+            return [False] * len(dataIds)
+        paths = [_prefix(templates[0]) + templates[0].formatPath(dataId)
+                for dataId in dataIds]
+        found = set()
+        with self._lock:
+            self.refresh()
+            for i in xrange(0, len(paths), _maxInValues):
+                chunk = paths[i:i + _maxInValues]
+                found.update(row[0] for row in self.db.execute(
+                    "SELECT path FROM _files WHERE datasetType = ? "
+                    "AND path IN ({})".format(", ".join("?" * len(chunk))),
+                    [datasetType] + chunk).fetchall())
+        return [path in found for path in paths]
+
+    def exists(self, datasetType, dataId):
+        """Return whether a file of a dataset type exists for dataId."""
+
+        with self._lock:
+            self.refresh()
+            for template in self.templates.get(datasetType, []):
+                try:
+                    path = _prefix(template) + template.formatPath(dataId)
+                except KeyError:
+                    if len(self.find(datasetType, dataId)) > 0:
+                        return True
+                    continue
+                cur = self.db.execute("SELECT 1 FROM _files "
+                        "WHERE datasetType = ? AND path = ?",
+                        (datasetType, path))
+                if len(cur.fetchall()) > 0:
+                    return True
+            return False
+
+    def add(self, datasetType, dataId):
+        """Record the files of a dataset that was just written."""
+
+        self.addMany(datasetType, [dataId])
+
+    def addMany(self, datasetType, dataIds):
+        """Record the files of many datasets of one type that were just
+        written, in a single transaction."""
+
+        with self._lock:
+            for dataId in dataIds:
+                for template in self.templates.get(datasetType, []):
+                    self._indexFile(_prefix(template) +
+                            template.formatPath(dataId))
+            self.db.commit()
+
+    def _indexFile(self, path):
+        if not storage.isLocal(path):
+            size = storage.getBackend(path).size(path)
+            if size is not None:
+                self._addFiles(path.rsplit("/", 1)[0], [(path, size, None)])
+            return
+        try:
+            st = os.stat(os.path.join(self.repoPath, path))
+        except OSError:
+            return
+        self._addFiles(os.path.dirname(path),
+                [(path, st.st_size, st.st_mtime)])
+
+    def _addFiles(self, dirPath, files):
+        rows = []
+        for path, size, mtime in files:
+            for datasetType, templateList in self.templates.iteritems():
+                for template in templateList:
+                    prefix = _prefix(template)
+                    if not path.startswith(prefix + template.globPrefix):
+                        continue
+                    dataId = template.parse(path[len(prefix):])
+                    if dataId is not None:
+                        rows.append((datasetType, path, dirPath,
+                            json.dumps(dataId, sort_keys=True), size, mtime))
+        self.db.executemany("INSERT OR REPLACE INTO _files "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def _walk(self, root):
+        if not storage.isLocal(root):
+            self._walkRemote(root)
+            return
+        pending = [root]
+        while len(pending) > 0:
+            dirPath = pending.pop()
+            fullPath = os.path.join(self.repoPath, dirPath)
+            try:
+                mtime = os.stat(fullPath).st_mtime
+            except OSError:
+                self._forgetDir(dirPath)
+                continue
+            cur = self.db.execute("SELECT mtime, subdirs FROM _dirs "
+                    "WHERE path = ?", (dirPath,))
+            rows = cur.fetchall()
+            result = rows[0] if len(rows) > 0 else None
+            if result is not None and result[0] == mtime:
+                subdirs = json.loads(result[1])
+            else:
+                subdirs, files = _listDir(fullPath)
+                subdirs = [os.path.join(dirPath, name) for name in subdirs]
+                if result is not None:
+                    oldSubdirs = set(json.loads(result[1]))
+                    for gone in oldSubdirs.difference(subdirs):
+                        self._forgetDir(gone)
+                self.db.execute("DELETE FROM _files WHERE dir = ?",
+                        (dirPath,))
+                self._addFiles(dirPath, [(os.path.join(dirPath, name),
+                    size, fileMtime) for name, size, fileMtime in files])
+                self.db.execute("INSERT OR REPLACE INTO _dirs "
+                        "VALUES (?, ?, ?)",
+                        (dirPath, mtime, json.dumps(subdirs)))
+            pending.extend(subdirs)
+
+    def _walkRemote(self, root):
+        backend = storage.getBackend(root)
+        self._forgetDir(root)
+        pending = [root]
+        while len(pending) > 0:
+            dirPath = pending.pop()
+            try:
+                subdirs, files = backend.listDir(dirPath + "/")
+            except IOError:
+                continue
+            self._addFiles(dirPath, [(dirPath + "/" + name, size, mtime)
+                for name, size, mtime in files])
+            pending.extend(dirPath + "/" + name for name in subdirs)
+
+    def _forgetDir(self, dirPath):
+        self.db.execute("DELETE FROM _files WHERE dir = ? OR dir GLOB ?",
+                (dirPath, dirPath + "/*"))
+        self.db.execute("DELETE FROM _dirs WHERE path = ? OR path GLOB ?",
+                (dirPath, dirPath + "/*"))
+
+def _openIndex(repoPath):
+    # Return the path and connection of the index of a repository, in it or
+    # in the cache directory if it can be written there, or in memory.
+    candidates = [os.path.join(repoPath, "_butler_index.sqlite3")]
+    if _cacheDirectory is not None:
+        candidates.append(os.path.join(_cacheDirectory, hashlib.sha1(
+            os.path.abspath(repoPath)).hexdigest() + ".sqlite3"))
+    for indexPath in candidates:
+        try:
+            directory = os.path.dirname(indexPath)
+            if indexPath is not candidates[0] and \
+                    not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            if not os.access(directory or ".", os.W_OK) or (
+                    os.path.exists(indexPath) and
+                    not os.access(indexPath, os.W_OK)):
+                continue
+            return indexPath, _connect(indexPath)
+        except (OSError, sqlite3.Error):
+            continue
+    return ":memory:", _connect(":memory:")
+
+def _connect(indexPath):
+    # Open an index with a write-ahead log and a busy timeout, as the
+    # registry is, so that readers do not block the process refreshing it.
+    db = sqlite3.connect(indexPath, timeout=5.0, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("CREATE TABLE IF NOT EXISTS _indexConfig (templates TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS _dirs "
+            "(path TEXT PRIMARY KEY, mtime REAL, subdirs TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS _files "
+            "(datasetType TEXT, path TEXT, dir TEXT, dataId TEXT, "
+            "size INTEGER, mtime REAL, PRIMARY KEY (datasetType, path))")
+    db.execute("CREATE INDEX IF NOT EXISTS _filesDir ON _files (dir)")
+    db.commit()
+    return db
+
+def _prefix(template):
+    # The prefix of the indexed paths of a template: none for local files,
+    # the scheme for others, whose paths are full URLs.
+    return "" if template.scheme == "file" else template.scheme + ":"
+
+def _canList(scheme):
+    try:
+        return hasattr(storage.getBackend(scheme + ":"), "listDir")
+    except RuntimeError:
+        return False
+
+def _listDir(path):
+    """Return the subdirectory names and the (name, size, mtime) of the
+    regular files in a directory, skipping hidden and butler-internal
+    entries."""
+
+    subdirs = []
+    files = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.name.startswith((".", "_")):
+                continue
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            elif entry.is_file():
+                st = entry.stat()
+                files.append((entry.name, st.st_size, st.st_mtime))
+        return subdirs, files
+    for name in os.listdir(path):
+        if name.startswith((".", "_")):
+            continue
+        try:
+            st = os.stat(os.path.join(path, name))
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            subdirs.append(name)
+        elif stat.S_ISREG(st.st_mode):
+            files.append((name, st.st_size, st.st_mtime))
+    return subdirs, files
@@ -0,0 +1,201 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+# A monotonic clock where the platform provides one.
+_clock = getattr(time, "monotonic", None) or \
+        (time.clock if sys.platform == "win32" else time.time)
+
+# Upper bounds, in seconds, of the histogram buckets: powers of two from
+# one microsecond to about 70 minutes, then everything longer.
+_bucketBounds = [2.0 ** i * 1e-6 for i in xrange(33)]
+
+class Histogram(object):
+    """Count, total, extremes and power-of-two buckets of durations."""
+
+    __slots__ = ("count", "total", "min", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(_bucketBounds) + 1)
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+        micros = int(duration * 1e6)
+        self.buckets[min(micros.bit_length(), len(_bucketBounds))] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                if self.min is None or value < self.min:
+                    self.min = value
+                if self.max is None or value > self.max:
+                    self.max = value
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+
+    def toDict(self):
+        """Return the histogram as a JSON-serializable dict; buckets maps
+        the upper bound of each non-empty bucket to its count."""
+        buckets = {}
+        for i, n in enumerate(self.buckets):
+            if n > 0:
+                bound = _bucketBounds[i] if i < len(_bucketBounds) else "inf"
+                buckets[repr(bound)] = n
+        return dict(count=self.count, total=self.total, min=self.min,
+                max=self.max,
+                mean=self.total / self.count if self.count else None,
+                buckets=buckets)
+
+class Instrumentation(object):
+    """Timers and counters of the butler's phases, aggregated per phase and
+    dataset type.
+
+    Timers record durations on a monotonic clock into histograms; counters
+    count events.  While disabled, timer() returns a shared no-op context
+    manager and count() returns immediately, so instrumented code pays one
+    attribute test per call."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.timers = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._dumpPath = None
+
+    def enable(self, dumpPath=None):
+        """Start recording; with dumpPath, write a snapshot as JSON to that
+        path when the process exits."""
+        self.enabled = True
+        if dumpPath is not None:
+            if self._dumpPath is None:
+                atexit.register(self._dumpAtExit)
+            self._dumpPath = dumpPath
+
+    def disable(self):
+        self.enabled = False
+
+    def timer(self, phase, datasetType=None):
+        """Return a context manager timing a phase for a dataset type."""
+        if not self.enabled:
+            return _nullTimer
+        return _Timer(self, (phase, datasetType))
+
+    def count(self, name, datasetType=None, n=1):
+        """Add n to a counter for a dataset type."""
+        if not self.enabled:
+            return
+        key = (name, datasetType)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def record(self, phase, datasetType, duration):
+        key = (phase, datasetType)
+        with self._lock:
+            histogram = self.timers.get(key)
+            if histogram is None:
+                histogram = self.timers[key] = Histogram()
+            histogram.add(duration)
+
+    def snapshot(self, reset=False):
+        """Return the timers and counters recorded so far as a dict:
+
+            {"timers": {phase: {datasetType: histogram dict}},
+             "counters": {name: {datasetType: count}}}
+
+        Each phase and counter also has a "*" entry aggregating all dataset
+        types; entries not tied to a dataset type are under "-"."""
+        with self._lock:
+            timers = self.timers
+            counters = self.counters
+            if reset:
+                self.timers = {}
+                self.counters = {}
+            else:
+                timers = dict((key, _copyHistogram(histogram))
+                        for key, histogram in timers.iteritems())
+                counters = counters.copy()
+        result = dict(timers={}, counters={})
+        for (phase, datasetType), histogram in timers.iteritems():
+            entries = result["timers"].setdefault(phase, {})
+            entries[datasetType or "-"] = histogram.toDict()
+            total = entries.get("*")
+            if total is None:
+                total = entries["*"] = Histogram()
+            total.merge(histogram)
+        for entries in result["timers"].itervalues():
+            entries["*"] = entries["*"].toDict()
+        for (name, datasetType), n in counters.iteritems():
+            entries = result["counters"].setdefault(name, {})
+            entries[datasetType or "-"] = n
+            entries["*"] = entries.get("*", 0) + n
+        return result
+
+    def reset(self):
+        with self._lock:
+            self.timers = {}
+            self.counters = {}
+
+    def dump(self, path):
+        """Write a snapshot as JSON to path."""
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+
+    def _dumpAtExit(self):
+        if self._dumpPath is not None:
+            self.dump(self._dumpPath.format(pid=os.getpid()))
+
+class _Timer(object):
+    __slots__ = ("instrumentation", "key", "start")
+
+    def __init__(self, instrumentation, key):
+        self.instrumentation = instrumentation
+        self.key = key
+
+    def __enter__(self):
+        self.start = _clock()
+        return self
+
+    def __exit__(self, *args):
+        self.instrumentation.record(self.key[0], self.key[1],
+                _clock() - self.start)
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_nullTimer = _NullTimer()
+
+def _copyHistogram(histogram):
+    result = Histogram()
+    result.merge(histogram)
+    return result
+
+# The instrumentation of this process.  Setting DAF_BUTLER_INSTRUMENTATION
+# enables it; a value other than "1" is the path, which may contain {pid},
+# of the snapshot written at exit.
+instrumentation = Instrumentation()
+timer = instrumentation.timer
+count = instrumentation.count
+
+_environment = os.environ.get("DAF_BUTLER_INSTRUMENTATION")
+if _environment:
+    instrumentation.enable(None if _environment == "1" else _environment)
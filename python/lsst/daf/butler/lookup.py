@@ -0,0 +1,258 @@
+import bisect
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_betweenPattern = re.compile(r"^\s*(\w+)\.(\w+)\s+BETWEEN\s+(\w+)\.(\w+)"
+        r"\s+AND\s+(\w+)\.(\w+)\s*$", re.IGNORECASE)
+_defaultPattern = re.compile(r"^\s*(MAX|MIN)\(\s*(?:column\s*=\s*(\w+)|"
+        r"(file))\s*\)\s*$", re.IGNORECASE)
+
+class IntervalLookup(object):
+    """A parsed lookup that resolves its outputs keys from the rows of an
+    interval dataset type whose validity range contains a point value of
+    another dataset type, as in
+
+        outputs: ['date']
+        join: ['raw']
+        where: 'raw.taiObs BETWEEN flat.validStart AND flat.validEnd'
+    """
+
+    def __init__(self, lookupConfig):
+        where = lookupConfig.get("where", "")
+        match = _betweenPattern.match(where)
+        if match is None or match.group(3) != match.group(5):
+            raise RuntimeError("Unsupported lookup condition {!r}: expected "
+                    "'type.column BETWEEN type.start AND type.end'".format(
+                        where))
+        (self.pointType, self.pointColumn, self.intervalType,
+                self.startColumn, _, self.endColumn) = match.groups()
+        self.outputs = list(lookupConfig.get("outputs", []))
+
+class Default(object):
+    """A parsed default expression for a dataId key, MAX or MIN of either a
+    column of the candidate datasets (MAX(column=version)) or of the key
+    itself over the existing files (MAX(file))."""
+
+    def __init__(self, key, expression):
+        match = _defaultPattern.match(str(expression))
+        if match is None:
+            raise RuntimeError("Unsupported default {!r} for key {}".format(
+                expression, key))
+        self.key = key
+        self.choose = max if match.group(1).upper() == "MAX" else min
+        self.column = match.group(2) or key
+        self.fromFiles = match.group(3) is not None
+
+    def reduce(self, rows):
+        """Return the rows with the chosen value of the column."""
+        rows = [row for row in rows if row.get(self.column) is not None]
+        if len(rows) == 0:
+            return rows
+        chosen = self.choose(row[self.column] for row in rows)
+        return [row for row in rows if row[self.column] == chosen]
+
+class IntervalIndex(object):
+    """Rows with closed [start, end] validity ranges, sorted by start so
+    that the rows containing each of many points are found with a binary
+    search, a single vectorized one when NumPy is available."""
+
+    def __init__(self, rows, startColumn, endColumn):
+        rows = [row for row in rows if row.get(startColumn) is not None
+                and row.get(endColumn) is not None]
+        rows.sort(key=lambda row: row[startColumn])
+        self.rows = rows
+        self.starts = [row[startColumn] for row in rows]
+        self.ends = [row[endColumn] for row in rows]
+        # maxEnds[i] is the latest end of rows[:i + 1]: a backward scan for
+        # the ranges containing a point stops once it falls below the point.
+        self.maxEnds = []
+        for end in self.ends:
+            self.maxEnds.append(end if len(self.maxEnds) == 0
+                    else max(end, self.maxEnds[-1]))
+        self.disjoint = all(self.ends[i] < self.starts[i + 1]
+                for i in xrange(len(rows) - 1))
+
+    def findMany(self, points):
+        """Return, for each point, the list of rows whose range contains
+        it."""
+        if len(self.rows) == 0:
+            return [[] for point in points]
+        if numpy is not None:
+            positions = numpy.searchsorted(numpy.asarray(self.starts),
+                    numpy.asarray(points), side="right") - 1
+            if self.disjoint:
+                # At most one range can contain each point.
+                ends = numpy.asarray(self.ends)
+                hits = positions >= 0
+                hits[hits] = ends[positions[hits]] >= \
+                        numpy.asarray(points)[hits]
+                return [[self.rows[position]] if hit else []
+                        for position, hit in
+                        zip(positions.tolist(), hits.tolist())]
+            positions = positions.tolist()
+        else:
+            positions = [bisect.bisect_right(self.starts, point) - 1
+                    for point in points]
+        results = []
+        for point, position in zip(points, positions):
+            found = []
+            i = position
+            while i >= 0 and self.maxEnds[i] >= point:
+                if self.ends[i] >= point:
+                    found.append(self.rows[i])
+                if self.disjoint:
+                    break
+                i -= 1
+            results.append(found)
+        return results
+
+def resolveLookups(mapper, datasetType, dataIds, lookupConfigs, defaults):
+    """Resolve the missing keys of a batch of dataIds of one dataset type.
+
+    Each lookup reads the point and interval datasets it joins once for the
+    whole batch, and finds the containing ranges of all points of a group of
+    dataIds sharing the same other keys in one search.  defaults maps keys
+    to Default expressions: those on columns of the interval rows choose
+    among the ranges found, and the others are evaluated once per batch
+    over the existing datasets.  Returns, for each dataId, the list of
+    candidate dataIds; a dataId that cannot be resolved is its own single
+    candidate."""
+
+    candidates = [[dataId.copy()] for dataId in dataIds]
+    for lookupConfig in lookupConfigs:
+        lookup = IntervalLookup(lookupConfig)
+        candidates = _applyLookup(mapper, datasetType, lookup, candidates,
+                defaults if lookup.intervalType == datasetType else {})
+    return _applyDefaults(mapper, datasetType, candidates, defaults)
+
+###############################################################################
+
+def _applyLookup(mapper, datasetType, lookup, candidates, defaults):
+    pending = [(i, dataId) for i, dataIds in enumerate(candidates)
+            for dataId in dataIds
+            if not all(key in dataId for key in lookup.outputs)]
+    if len(pending) == 0:
+        return candidates
+    pendingIds = [dataId for i, dataId in pending]
+
+    # Point values, from the dataIds themselves or their joined datasets.
+    points = [dataId.get(lookup.pointColumn) for dataId in pendingIds]
+    missing = [dataId for dataId, point in zip(pendingIds, points)
+            if point is None]
+    if len(missing) > 0:
+        pointRows = _Rows(mapper.searchRows(lookup.pointType,
+            [lookup.pointColumn], missing),
+            mapper.getKeys(lookup.pointType, required=True))
+        for j, dataId in enumerate(pendingIds):
+            if points[j] is None:
+                values = set(row.get(lookup.pointColumn)
+                        for row in pointRows.matching(dataId, ()))
+                values.discard(None)
+                if len(values) == 1:
+                    points[j] = values.pop()
+
+    # Group the points by the interval keys they constrain, and search
+    # each group's ranges once.
+    columns = [lookup.startColumn, lookup.endColumn]
+    metadata = mapper.getMetadataColumns(lookup.intervalType)
+    columns.extend(default.column for default in defaults.itervalues()
+            if not default.fromFiles and default.column in metadata and
+            default.column not in columns)
+    intervalKeys = mapper.getKeys(lookup.intervalType, required=True)
+    intervalRows = _Rows(mapper.searchRows(lookup.intervalType, columns,
+        pendingIds), intervalKeys)
+    groups = {}
+    for j, dataId in enumerate(pendingIds):
+        if points[j] is not None:
+            group = intervalRows.groupKey(dataId, lookup.outputs)
+            groups.setdefault(group, []).append(j)
+    found = [[] for dataId in pendingIds]
+    for group, members in groups.iteritems():
+        index = IntervalIndex(intervalRows.group(group),
+                lookup.startColumn, lookup.endColumn)
+        for j, rows in zip(members,
+                index.findMany([points[j] for j in members])):
+            found[j] = rows
+
+    newCandidates = [[] for dataIds in candidates]
+    pendingSet = set(id(dataId) for dataId in pendingIds)
+    for i, dataIds in enumerate(candidates):
+        for dataId in dataIds:
+            if id(dataId) not in pendingSet:
+                newCandidates[i].append(dataId)
+    for (i, dataId), rows in zip(pending, found):
+        keys = list(lookup.outputs)
+        for key, default in defaults.iteritems():
+            if key not in dataId and not default.fromFiles and \
+                    len(rows) > 0 and default.column in rows[0]:
+                rows = default.reduce(rows)
+                keys.append(key)
+        resolved = _distinct(dataId, rows, keys)
+        newCandidates[i].extend(resolved if len(resolved) > 0 else [dataId])
+    return newCandidates
+
+def _applyDefaults(mapper, datasetType, candidates, defaults):
+    for key, default in defaults.iteritems():
+        pending = [dataId for dataIds in candidates for dataId in dataIds
+                if key not in dataId]
+        if len(pending) == 0:
+            continue
+        columns = []
+        if not default.fromFiles and \
+                default.column in mapper.getMetadataColumns(datasetType):
+            columns.append(default.column)
+        rows = _Rows(mapper.searchRows(datasetType, columns, pending,
+            default.fromFiles), mapper.getKeys(datasetType, required=True))
+        chosen = {}
+        for dataId in pending:
+            group = rows.groupKey(dataId, (key,))
+            if group not in chosen:
+                chosen[group] = set(row.get(key)
+                        for row in default.reduce(rows.group(group)))
+                chosen[group].discard(None)
+            if len(chosen[group]) == 1:
+                dataId[key] = next(iter(chosen[group]))
+    return candidates
+
+def _distinct(dataId, rows, keys):
+    results = []
+    seen = set()
+    for row in rows:
+        values = tuple(row.get(key) for key in keys)
+        if values not in seen:
+            seen.add(values)
+            newDataId = dataId.copy()
+            newDataId.update(zip(keys, values))
+            results.append(newDataId)
+    return results
+
+class _Rows(object):
+    # The rows of a dataset type, grouped by the values of the keys that a
+    # dataId constrains.  Each set of keys is grouped on in a single pass.
+
+    def __init__(self, rows, keys):
+        self.rows = rows
+        self.keys = sorted(keys)
+        self.groupings = {}
+
+    def groupKey(self, dataId, exclude):
+        keys = tuple(key for key in self.keys
+                if key in dataId and key not in exclude)
+        return keys, tuple(str(dataId[key]) for key in keys)
+
+    def group(self, groupKey):
+        keys, values = groupKey
+        if keys not in self.groupings:
+            grouping = {}
+            for row in self.rows:
+                grouping.setdefault(tuple(str(row.get(key)) for key in keys),
+                        []).append(row)
+            self.groupings[keys] = grouping
+        return self.groupings[keys].get(values, [])
+
+    def matching(self, dataId, exclude):
+        return self.group(self.groupKey(dataId, exclude))
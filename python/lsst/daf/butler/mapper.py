@@ -1,19 +1,47 @@
+import copy
+import cPickle
+import heapq
 import importlib
+import itertools
 import logging as log
 import os
-import re
 import sqlite3
+import threading
 import urlparse
-import yaml
+from multiprocessing.pool import ThreadPool
 
-from butlerLocation import ButlerLocation
+from butlerLocation import ButlerLocation, resolveStorage
+from configCache import configCache
+from existenceCache import ExistenceCache
+from fileIndex import FileIndex
+from instrumentation import count, timer
+from lookup import Default, resolveLookups
+from registry import Registry, bumpGeneration
+from snapshot import Snapshot, writeSnapshot
+from urlTemplate import UrlTemplate
+
+# Incremented whenever a dataset type is created in any mapper, so that the
+# flattened indexes of all mappers are rebuilt before their next lookup.
+_generationLock = threading.Lock()
+
+# Thread pools, by size, shared by all mappers searching their input
+# repositories concurrently.
+_searchPools = {}
+_searchPoolLock = threading.Lock()
 
 class Mapper(object):
 
     _mapperCache = {}
+    _generation = 0
 
     @staticmethod
-    def create(repoUrl, inputRepos=None):
+    def create(repoUrl, inputRepos=None, readOnly=False):
+        """Return the mapper for a repository, constructing it and its
+        parents the first time.  Unless readOnly is true, the configuration
+        of each mapper in the graph is written to its registry if it has
+        changed, and the repository's registry is opened for writing; the
+        registries of mappers only ever created readOnly, such as those of
+        input repositories, are opened read-only."""
         if repoUrl not in Mapper._mapperCache or inputRepos is not None:
             parseResult = urlparse.urlparse(repoUrl, scheme="file")
             if parseResult.scheme == "file":
@@ -23,7 +51,7 @@ class Mapper(object):
             else:
                 _fatal(ValueError, "Unknown scheme {} for "
                         "repository URL {}".format(parseResult.scheme, repoUrl)) 
-            if 'parent' not in config:
+            if 'parents' not in config:
                 config['parents'] = []
             if inputRepos is not None:
                 for parent in inputRepos:
@@ -32,7 +60,27 @@ class Mapper(object):
 
             Mapper._mapperCache[repoUrl] = Mapper._createFromConfig(
                     config, repoUrl)
-        return Mapper._mapperCache[repoUrl]
+        mapper = Mapper._mapperCache[repoUrl]
+        if not readOnly:
+            mapper._writeConfigs(set())
+            mapper._setWritable()
+        return mapper
+
+    @staticmethod
+    def openSnapshot(path):
+        """Return the mapper graph of a snapshot written by exportSnapshot,
+        whose registries answer queries from the memory-mapped snapshot, or
+        None if any of its registries has been written since the snapshot
+        was exported."""
+        snapshot = Snapshot(path)
+        if not snapshot.isCurrent():
+            return None
+        mapper = snapshot.loadMapper()
+        for repository in _repositories(mapper, set()):
+            repository.snapshot = snapshot.getRegistry(
+                    repository.config["repoPath"],
+                    repository._allTemplates())
+        return mapper
 
     @staticmethod
     def _createFromConfig(config, source):
@@ -40,7 +88,7 @@ class Mapper(object):
             mapperClassName = config['mapper']
         elif len(config['parents']) > 0:
             mapperClassName = Mapper.create(
-                    config['parents'][0]).config['mapper']
+                    config['parents'][0], readOnly=True).config['mapper']
         else:
             raise RuntimeError("No mapper class in mapper configuration "
                     "from {}".format(source))
@@ -56,11 +104,19 @@ class Mapper(object):
         return cls(config, source)
 
     def __init__(self, config, source):
-        self.pickleArgs = (config, source)
         self.config = config
         self.source = source
         self.keyCache = {True: {}, False: {}}
-        self.parents = [Mapper.create(parent) for parent in config['parents']]
+        self.templates = {}
+        self.fileIndex = None
+        self.registry = None
+        self.writable = False
+        self.snapshot = None
+        self.existenceCache = None
+        self._lock = threading.RLock()
+        self._writtenConfig = None
+        self.parents = [Mapper.create(parent, readOnly=True)
+                for parent in config['parents']]
         self.registryPath = os.path.join(config['repoPath'], "_butler.sqlite3")
         if 'mapper' not in self.config:
             self.config['mapper'] = type(self).__module__ + "." + type(self).__name__
@@ -68,36 +124,57 @@ class Mapper(object):
         if "datasets" not in self.config:
             self.config["datasets"] = {}
         for datasetType in self.config["datasets"].keys():
-            datasetConfig = self.config["datasets"][datasetType]
-            if "datasetClass" not in datasetConfig:
-                raise RuntimeError("No dataset class configured for "
-                        "dataset type {} in mapper "
-                        "from {}".format(datasetType, source))
-            datasetClass = self.config["datasets"][datasetType]["datasetClass"]
-            if not self.hasConfig('classes', datasetClass):
-                raise RuntimeError("Unknown dataset class {} for "
-                        "dataset type {} in mapper "
-                        "from {}".format(datasetClass, datasetType, source))
-            if "urls" not in datasetConfig:
-                raise RuntimeError("No URL templates configured for "
-                        "dataset type {} in mapper "
-                        "from {}".format(datasetType, source))
+            self.templates[datasetType] = self._parseTemplates(datasetType,
+                    self.config["datasets"][datasetType])
+        self._index = ({}, {})
+        self._indexGeneration = None
+        self._buildIndex()
+
+        if self.config.get("validateStorages", False):
+            self.validateStorages()
 
         if "registryUrl" not in self.config:
             self.config["registryUrl"] = os.path.join(
                     self.config["repoPath"], "_butler.sqlite3")
-        try:
-            conn = sqlite3.connect(self.config["registryUrl"])
-            conn.execute("CREATE TABLE IF NOT EXISTS _config (yaml TEXT)")
-            conn.execute("DELETE FROM _config")
+
+    def writeConfig(self):
+        """Write this mapper's configuration to its registry unless the
+        registry already holds the same configuration.  The configuration
+        in the registry is read through the configuration cache, so that an
+        unchanged configuration is neither dumped nor written."""
+        registryUrl = self.config["registryUrl"]
+        with self._lock:
+            if self.config == self._writtenConfig:
+                return
+            if os.path.exists(registryUrl):
+                stored, error = configCache.load(registryUrl,
+                        _loadSqliteConfig)
+                if stored == self.config:
+                    self._writtenConfig = stored
+                    return
+            import yaml
             yamlConfig = yaml.dump(self.config)
-            conn.execute("INSERT INTO _config (yaml) VALUES (?)", [yamlConfig])
-            conn.commit()
-        finally:
-            conn.close()
+            conn = sqlite3.connect(registryUrl)
+            try:
+                conn.execute("CREATE TABLE IF NOT EXISTS _config (yaml TEXT)")
+                result = conn.execute("SELECT yaml FROM _config").fetchall()
+                if result != [(yamlConfig,)]:
+                    bumpGeneration(conn)
+                    conn.execute("DELETE FROM _config")
+                    conn.execute("INSERT INTO _config (yaml) VALUES (?)",
+                            [yamlConfig])
+                    conn.commit()
+            finally:
+                conn.close()
+            self._writtenConfig = copy.deepcopy(self.config)
 
     def hasConfig(self, *args):
         """Search the mapper's config and its parents' configs for keys."""
+        if len(args) == 2 and args[0] in ("datasets", "classes"):
+            datasetIndex, classIndex = self._getIndex()
+            if args[0] == "datasets":
+                return args[1] in datasetIndex
+            return args[1] in classIndex
         config = self.config
         found = True
         for key in args:
@@ -113,15 +190,116 @@ class Mapper(object):
                 return True
         return False
 
-    # For pickling
+    def validateStorages(self):
+        """Resolve every reader and writer of this mapper's dataset classes,
+        raising a RuntimeError that lists all entries that cannot be
+        resolved."""
+        errors = []
+        classes = self.config.get("classes", {})
+        for datasetClass, classConfig in classes.items():
+            for storage in classConfig.get("readers", []) + \
+                    classConfig.get("writers", []):
+                try:
+                    resolveStorage(storage)
+                except (ImportError, RuntimeError) as e:
+                    errors.append("{} ({}): {}".format(
+                        storage, datasetClass, e))
+        if len(errors) > 0:
+            raise RuntimeError("Unresolvable storages in mapper "
+                    "from {}: {}".format(self.source, "; ".join(errors)))
+
+    # For pickling: the resolved mapper graph is carried as is, so that
+    # unpickling touches neither the filesystem nor the registry.
     def __getstate__(self):
-        return self.pickleArgs
+        state = self.__dict__.copy()
+        state['fileIndex'] = None
+        state['registry'] = None
+        state['snapshot'] = None
+        state['existenceCache'] = None
+        state['_index'] = ({}, {})
+        state['_indexGeneration'] = None
+        del state['_lock']
+        return state
 
     def __setstate__(self, state):
-        self.__init__(state[0], state[1])
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def exportSnapshot(self, path=None):
+        """Write a read-only snapshot of this mapper graph and of the
+        registries of its repositories, by default to _butler.snapshot in
+        this repository, for worker processes to open with openSnapshot.
+        Returns the path of the snapshot."""
+        if path is None:
+            path = os.path.join(self.config["repoPath"], "_butler.snapshot")
+        writeSnapshot(path, cPickle.dumps(self, cPickle.HIGHEST_PROTOCOL),
+                [(repository.config["repoPath"],
+                    repository.config["registryUrl"],
+                    repository._getRegistry())
+                    for repository in _repositories(self, set())])
+        return path
+
+    def _writeConfigs(self, seen):
+        if id(self) in seen:
+            return
+        seen.add(id(self))
+        self.writeConfig()
+        for parent in self.parents:
+            parent._writeConfigs(seen)
 
 
     def map(self, datasetType, dataId, forWrite):
+        with timer("mapper.map", datasetType):
+            return self._mapResolved(datasetType, dataId, forWrite,
+                    self._resolveStorages(datasetType, forWrite))
+
+    def mapMany(self, requests, forWrite):
+        """Map a sequence of (datasetType, dataId) pairs in one pass, resolving
+        the configuration and storages of each dataset type only once."""
+        with timer("mapper.mapMany"):
+            return self._mapMany(requests, forWrite)
+
+    def _mapMany(self, requests, forWrite):
+        resolved = {}
+        pending = {}
+        for i, (datasetType, dataId) in enumerate(requests):
+            if datasetType not in resolved:
+                resolved[datasetType] = self._resolveStorages(
+                        datasetType, forWrite)
+            if self._needsLookup(datasetType, dataId):
+                pending.setdefault(datasetType, []).append(i)
+        # Lookups are resolved for all dataIds of a dataset type at once.
+        for datasetType, indexes in pending.items():
+            self._resolveLookups(datasetType,
+                    [requests[i][1] for i in indexes])
+        # The repositories holding complete dataIds are also found for all
+        # dataIds of a dataset type at once.
+        owners = {}
+        if not forWrite:
+            complete = {}
+            for i, (datasetType, dataId) in enumerate(requests):
+                if self.getKeys(datasetType, required=True).issubset(dataId):
+                    complete.setdefault(datasetType, []).append(i)
+            for datasetType, indexes in complete.iteritems():
+                repositories = self._searchOrder(datasetType)
+                if len(repositories) > 1:
+                    owners.update(zip(indexes, self._locateMany(datasetType,
+                        [requests[i][1] for i in indexes], repositories)))
+        locationLists = []
+        for i, (datasetType, dataId) in enumerate(requests):
+            owner = owners.get(i)
+            if owner is None:
+                locationLists.append(self._mapResolved(datasetType, dataId,
+                    forWrite, resolved[datasetType]))
+                continue
+            key = datasetType if owner is self else (id(owner), datasetType)
+            if key not in resolved:
+                resolved[key] = owner._resolveStorages(datasetType, forWrite)
+            locationLists.append(owner._locations(datasetType, dataId,
+                resolved[key]))
+        return locationLists
+
+    def _resolveStorages(self, datasetType, forWrite):
         datasetConfig, datasetClass, classConfig, urlTemplates = \
                 self._parseDatasetConfig(datasetType)
 
@@ -141,35 +319,27 @@ class Mapper(object):
         if len(storages) != len(urlTemplates):
             raise RuntimeError("URL templates don't match storages "
                     "for dataset type {}".format(datasetType))
+        storages = [resolveStorage(storage) for storage in storages]
+        return datasetConfig, storages, urlTemplates
 
-        neededKeys = self.getKeys(datasetType, required=True)
-        neededKeys.difference_update(dataId.keys())
-
-        if len(neededKeys) != 0 and "lookups" in datasetConfig:
-            newIds = self.doLookup(neededKeys, dataId,
-                    datasetConfig["lookups"])
-            neededKeys.difference_update(newIds.keys())
-            dataId.update(newIds)
-
-        if len(neededKeys) != 0:
-            dataIdList = ()
-            if not forWrite:
-                dataIdList = self.listDatasets(datasetType, dataId)
-            if len(dataIdList) > 1:
-                raise RuntimeError("Found multiple ({}) matches "
-                        "in repository for dataset type {} "
-                        "and dataId {}: dataIds {}".format(
-                            len(dataIdList), datasetType, dataId, dataIdList))
-            if len(dataIdList) == 0:
-                raise RuntimeError("Unable to determine required "
-                        "data identifiers {} for dataset type {} "
-                        " and dataId {}".format(
-                            neededKeys, datasetType, dataId))
-            dataId = dataIdList[0]
+    def _mapResolved(self, datasetType, dataId, forWrite, resolved):
+        if self._needsLookup(datasetType, dataId):
+            self._resolveLookups(datasetType, [dataId])
+        owner, dataId = self._locate(datasetType, dataId, forWrite)
+        if owner is not self:
+            resolved = owner._resolveStorages(datasetType, forWrite)
+        return owner._locations(datasetType, dataId, resolved)
 
+    def _locations(self, datasetType, dataId, resolved):
+        datasetConfig, storages, urlTemplates = resolved
         urls = []
-        for template in urlTemplates:
-            urls.append(template.format(**dataId))
+        with timer("mapper.format", datasetType):
+            for template in urlTemplates:
+                if template.scheme == "file":
+                    urls.append(os.path.join(self.config["repoPath"],
+                        template.formatPath(dataId)))
+                else:
+                    urls.append(template.format(**dataId))
 
         locations = []
         for i in xrange(len(urls)):
@@ -177,6 +347,57 @@ class Mapper(object):
 
         return locations
 
+    def _locate(self, datasetType, dataId, forWrite):
+        # Return the repository holding a dataset, searching this one and
+        # then the input repositories in order, and its complete dataId.
+        # Datasets that are not found are written to and read from this
+        # repository.
+        neededKeys = self.getKeys(datasetType, required=True)
+        neededKeys.difference_update(dataId.keys())
+        repositories = [self] if forWrite else self._searchOrder(datasetType)
+
+        if len(neededKeys) == 0:
+            if len(repositories) > 1:
+                for repository, existing in itertools.izip(repositories,
+                        self._gather(repositories, lambda repository:
+                            repository._existsCached(datasetType, [dataId],
+                                repository is not self))):
+                    if existing[0]:
+                        return repository, dataId
+            return self, dataId
+
+        if not forWrite:
+            candidates = self._candidates(datasetType, dataId)
+            for repository, dataIdList in itertools.izip(repositories,
+                    self._gather(repositories, lambda repository:
+                        list(repository._iterDatasets(datasetType,
+                            candidates, None, None, limit=2)))):
+                if len(dataIdList) > 1:
+                    raise RuntimeError("Found multiple matches "
+                            "in repository {} for dataset type {} "
+                            "and dataId {}: dataIds {}, ...".format(
+                                repository.config["repoPath"], datasetType,
+                                dataId, dataIdList))
+                if len(dataIdList) == 1:
+                    return repository, dataIdList[0]
+        raise RuntimeError("Unable to determine required "
+                "data identifiers {} for dataset type {} "
+                " and dataId {}".format(neededKeys, datasetType, dataId))
+
+    def _locateMany(self, datasetType, dataIds, repositories):
+        # Return the repository holding each of many complete dataIds.
+        owners = [None] * len(dataIds)
+        for repository, existing in itertools.izip(repositories,
+                self._gather(repositories, lambda repository:
+                    repository._existsCached(datasetType, dataIds,
+                        repository is not self))):
+            for i, exists in enumerate(existing):
+                if exists and owners[i] is None:
+                    owners[i] = repository
+            if all(owner is not None for owner in owners):
+                break
+        return [owner or self for owner in owners]
+
     def getKeys(self, datasetType=None, required=False):
         if datasetType in self.keyCache[required]:
             return self.keyCache[required][datasetType].copy()
@@ -188,10 +409,8 @@ class Mapper(object):
         else:
             datasetConfig, datasetClass, classConfig, urlTemplates = \
                     self._parseDatasetConfig(datasetType)
-            keyRegexp = re.compile(r'(?<!\{)(\{\{)*\{(\w+?)(:.*?)?\}')
             for template in urlTemplates:
-                for match in keyRegexp.finditer(template):
-                    keys.add(match.group(1))
+                keys.update(template.keys)
             if not required:
                 if "lookups" in datasetConfig:
                     for l in datasetConfig["lookups"]:
@@ -206,125 +425,542 @@ class Mapper(object):
         self.keyCache[required][datasetType] = keys.copy()
         return keys
 
+    def getCachePolicy(self, datasetType):
+        """Return the in-memory caching policy of a dataset type's class as a
+        dict, or None if its datasets must not be cached."""
+        datasetConfig, datasetClass, classConfig, urlTemplates = \
+                self._parseDatasetConfig(datasetType)
+        policy = classConfig.get("cache", True)
+        if policy is True:
+            return {}
+        if not policy:
+            return None
+        return policy
+
+    def usesContentChecksum(self, datasetType):
+        """Return whether the checksum of the pickle of each object of a
+        dataset type is recorded when it is put, so that a repeated put is
+        recognized without reading the dataset back.  A checksum entry of
+        the dataset type or of its class set to false turns this off, for
+        objects that are costly to pickle."""
+        datasetConfig, datasetClass, classConfig, urlTemplates = \
+                self._parseDatasetConfig(datasetType)
+        return bool(datasetConfig.get("checksum",
+            classConfig.get("checksum", True)))
+
     def getDatasetTypes(self):
         return self.config["datasets"].keys()
 
     def createDatasetType(self, datasetType, datasetClass, **kwArgs):
-        pass
+        """Define a new dataset type of an existing dataset class in this
+        repository.  kwArgs give the rest of its configuration and must
+        include urls."""
+        datasetConfig = dict(kwArgs, datasetClass=datasetClass)
+        with self._lock:
+            if datasetType in self.config["datasets"]:
+                raise RuntimeError("Dataset type {} already exists in mapper "
+                        "from {}".format(datasetType, self.source))
+            self.templates[datasetType] = self._parseTemplates(datasetType,
+                    datasetConfig)
+            self.config["datasets"][datasetType] = datasetConfig
+            self.keyCache = {True: {}, False: {}}
+        with _generationLock:
+            Mapper._generation += 1
 
     def listDatasets(self, datasetType, partialDataId, **kwArgs):
-        dataId = partialDataId.copy()
+        with timer("mapper.listDatasets", datasetType):
+            return list(self.iterDatasets(datasetType, partialDataId,
+                **kwArgs))
 
-        datasetConfig, datasetClass, classConfig, urlTemplates = \
-                self._parseDatasetConfig(datasetType)
+    def iterDatasets(self, datasetType, partialDataId, orderBy=None,
+            limit=None, after=None):
+        """Iterate over the dataIds of the datasets of a type matching a
+        partial dataId, as they are read a page at a time from the registry
+        or the file index.
 
-        neededKeys = self.getKeys(datasetType, required=True)
-        neededKeys.difference_update(partialDataId.keys())
+        Datasets in the registry are ordered by the keys in orderBy and then
+        by their other keys; those only in the file index are ordered by
+        path, and ordering them by keys reads them all first.  limit bounds
+        the number of dataIds returned, and after, a dataId returned
+        earlier, resumes the enumeration after it.  Complete dataIds, such
+        as those resolved by lookups, are checked for existence in
+        batches.
 
-        if len(neededKeys) != 0 and "lookups" in datasetConfig:
-            newId = self._doLookups(neededKeys, dataId,
-                    datasetConfig["lookups"])
-            neededKeys.difference_update(newId.keys())
-            dataId.update(newId)
+        With input repositories, the datasets of every repository are read
+        in the order of the keys in orderBy and then of the other keys,
+        compared as the types of the registry columns, and merged as they
+        are read; a dataset found in several repositories is returned
+        once, from the first of them in search order."""
+        dataIds = self._candidates(datasetType, partialDataId)
+        repositories = self._searchOrder(datasetType)
+        if len(repositories) <= 1:
+            return self._iterDatasets(datasetType, dataIds, orderBy, after,
+                    limit)
+        results = self._mergeDatasets(datasetType, dataIds, orderBy, after,
+                repositories)
+        if limit is not None:
+            results = itertools.islice(results, limit)
+        return results
 
-        if len(neededKeys) == 0:
-            dataIdList = [dataId]
-        elif self.hasRegistryTable(datasetType):
-            dataIdList = self._lookupByRegistry(datasetType, neededKeys,
-                    dataId, datasetConfig, classConfig)
+    def _mergeDatasets(self, datasetType, dataIds, orderBy, after,
+            repositories):
+        # Every repository is read ordered by all the keys, so that their
+        # streams are merged without reading any of them in full.
+        registry = self._getRegistry()
+        order = [key for key, keyType in
+                registry.orderColumns(datasetType, orderBy)]
+        sortKey = lambda dataId: registry.sortKey(datasetType, dataId, order)
+        streams = self._gather(repositories,
+                lambda repository: repository._iterDatasets(datasetType,
+                    dataIds, order, after))
+        afterKey = sortKey(after) if after is not None else None
+        lastKey = None
+        for key, i, dataId in heapq.merge(*[_keyed(stream, i, sortKey)
+                for i, stream in enumerate(streams)]):
+            if (afterKey is not None and key <= afterKey) or key == lastKey:
+                continue
+            lastKey = key
+            yield dataId
+
+    def _candidates(self, datasetType, partialDataId):
+        # The dataIds to search for, resolved by the lookups of the dataset
+        # type if any.
+        datasetConfig = self._parseDatasetConfig(datasetType)[0]
+        if not self.getKeys(datasetType, required=True).issubset(
+                partialDataId) and "lookups" in datasetConfig:
+            return resolveLookups(self, datasetType, [partialDataId],
+                    datasetConfig["lookups"], {})[0]
+        return [partialDataId.copy()]
+
+    def _iterDatasets(self, datasetType, dataIds, orderBy, after,
+            limit=None):
+        # The datasets of this repository only matching any of dataIds.
+        results = self._iterLocalDatasets(datasetType, dataIds, orderBy,
+                after)
+        if limit is not None:
+            results = itertools.islice(results, limit)
+        return results
+
+    def _iterLocalDatasets(self, datasetType, dataIds, orderBy, after):
+        requiredKeys = self.getKeys(datasetType, required=True)
+        if self.hasRegistryTable(datasetType):
+            source = self._getRegistry()
+            sortKey = lambda dataId: source.sortKey(datasetType, dataId,
+                    orderBy)
+            iterFind = lambda dataId: source.iterFind(datasetType, dataId,
+                    orderBy, after)
         else:
-            dataIdList = self._lookupByGlob(neededKeys, urlTemplates, dataId)
+            source = self._getFileIndex()
+            if orderBy:
+                sortKey = lambda dataId: tuple(dataId[key]
+                        for key in orderBy) + \
+                        source.sortKey(datasetType, dataId)
+                iterFind = lambda dataId: iter(sorted(
+                    source.iterFind(datasetType, dataId), key=sortKey))
+            else:
+                sortKey = lambda dataId: source.sortKey(datasetType, dataId)
+                iterFind = lambda dataId: source.iterFind(datasetType,
+                        dataId, after)
 
-        return filter(self.datasetExists, dataIdList)
+        streams = []
+        complete = [dataId for dataId in dataIds
+                if requiredKeys.issubset(dataId)]
+        if len(complete) > 0:
+            streams.append(iter(sorted((dataId for dataId, exists in
+                zip(complete, source.existsMany(datasetType, complete))
+                if exists), key=sortKey)))
+        streams.extend(iterFind(dataId) for dataId in dataIds
+                if not requiredKeys.issubset(dataId))
+
+        # The streams of several lookup candidates are merged in order,
+        # dropping duplicates.
+        afterKey = sortKey(after) if after is not None else None
+        lastKey = None
+        for key, i, dataId in heapq.merge(*[_keyed(stream, i, sortKey)
+                for i, stream in enumerate(streams)]):
+            if (afterKey is not None and key <= afterKey) or key == lastKey:
+                continue
+            lastKey = key
+            yield dataId
+
+    def getMetadataColumns(self, datasetType):
+        """Return the dict of metadata column types, by name, configured for
+        a dataset type's registry table."""
+        datasetConfig = self._parseDatasetConfig(datasetType)[0]
+        return datasetConfig.get("columns", {})
+
+    def selectRows(self, datasetType, metadataColumns, dataIds,
+            fromFiles=False):
+        """Return, as dicts, the dataIds and given metadata columns of the
+        datasets of a type in this repository that may match any of dataIds.
+        Datasets without a registry table, or all datasets when fromFiles is
+        true, are read from the file index and have no metadata."""
+        if not fromFiles and self.hasRegistryTable(datasetType):
+            return self._getRegistry().select(datasetType, metadataColumns,
+                    dataIds)
+        return [foundDataId for foundDataId, path, size, mtime in
+                self._getFileIndex().find(datasetType, {})]
+
+    def searchRows(self, datasetType, metadataColumns, dataIds,
+            fromFiles=False):
+        """Return the rows of selectRows from this repository and the input
+        repositories that define a dataset type, as lookups read the
+        datasets they join.  A dataset found in several repositories is
+        taken from the first of them in search order."""
+        repositories = self._searchOrder(datasetType)
+        if len(repositories) <= 1:
+            return self.selectRows(datasetType, metadataColumns, dataIds,
+                    fromFiles)
+        keys = sorted(self.getKeys(datasetType, required=True))
+        rows = []
+        seen = set()
+        for found in self._gather(repositories, lambda repository:
+                repository.selectRows(datasetType, metadataColumns, dataIds,
+                    fromFiles)):
+            for row in found:
+                values = tuple(str(row.get(key)) for key in keys)
+                if values not in seen:
+                    seen.add(values)
+                    rows.append(row)
+        return rows
+
+    def hasRegistryTable(self, datasetType):
+        """Return whether datasets of a given type are recorded in a registry
+        table.  Dataset types without one are served from the file index."""
+        return self._getRegistry().hasTable(datasetType)
+
+    def datasetExists(self, datasetType, dataId):
+        """Return whether a dataset of a given type exists in this
+        repository."""
+        if self.hasRegistryTable(datasetType):
+            return self._getRegistry().exists(datasetType, dataId)
+        return self._getFileIndex().exists(datasetType, dataId)
+
+    def datasetExistsMany(self, datasetType, dataIds):
+        """Return whether datasets of a given type exist in this repository,
+        for each of many complete dataIds."""
+        if self.hasRegistryTable(datasetType):
+            return self._getRegistry().existsMany(datasetType, dataIds)
+        return self._getFileIndex().existsMany(datasetType, dataIds)
+
+    def recordDataset(self, datasetType, dataId, checksum=None, size=None,
+            files=None):
+        """Record that a dataset was written to this repository, with the
+        checksum and size of its content and the [url, digest, size] of its
+        files if they are known."""
+        self.recordDatasets(datasetType, [(dataId, checksum, size, files)])
+
+    def recordDatasets(self, datasetType, records):
+        """Record many datasets of one type written to this repository,
+        given as (dataId, checksum, size, files) as for recordDataset, in
+        one transaction each for the file index, the registry and the
+        checksums."""
+        dataIds = [record[0] for record in records]
+        self._getFileIndex().addMany(datasetType, dataIds)
+        self._ensureRegistryTable(datasetType)
+        self._getRegistry().ingest(datasetType, dataIds)
+        self._recordExisting(datasetType, dataIds)
+        repoPath = self.config["repoPath"]
+        checksums = [(dataId, checksum, size,
+            [[os.path.relpath(url, repoPath), digest, fileSize]
+                for url, digest, fileSize in files or []])
+            for dataId, checksum, size, files in records
+            if checksum is not None or files]
+        if len(checksums) > 0:
+            self._getRegistry().setChecksums(datasetType, checksums)
+
+    def getDatasetChecksum(self, datasetType, dataId):
+        """Return the (checksum, size) recorded for a dataset in this
+        repository, or None."""
+        result = self._getRegistry().getChecksum(datasetType, dataId)
+        if result is None:
+            return None
+        return result[0], result[1]
+
+    def getFileChecksums(self, datasetType=None):
+        """Return the list of (datasetType, dataId key, files) recorded in
+        this repository, where files lists the [url, digest, size] of each
+        file of a dataset."""
+        repoPath = self.config["repoPath"]
+        return [(recordType, key, [[os.path.join(repoPath, path), digest,
+            size] for path, digest, size in files])
+            for recordType, key, files in
+            self._getRegistry().getFileChecksums(datasetType)]
+
+    def ingestDatasets(self, datasetType, dataIds):
+        """Record many existing datasets of one type in the registry in a
+        single transaction."""
+        self._ensureRegistryTable(datasetType)
+        self._getRegistry().ingest(datasetType, dataIds)
+        self._recordExisting(datasetType, dataIds)
 
 ###############################################################################
 
-# set(config['inputs']).isdisjoint(config['outputs'])
-
-    def _doLookups(self, neededKeys, dataId, lookupConfig):
-        keys = neededKeys.copy()
-        foundLookups = True
-        lookups = []
-        availableKeys = set(dataId.keys())
-        while len(keys) > 0 and foundLookups:
-            foundLookups = False
-            for i in xrange(len(lookupConfig)):
-                if index in lookups:
-                    continue
-                if not keys.isdisjoint(config['outputs']):
-                    keys.difference_update(config['outputs'])
-                    keys.update(
-                            set(config['inputs']).difference(availableKeys))
-                    lookups.append(i)
-                    foundLookups = True
-        lookups.reverse()
-        newId = dataId.copy()
-        for index in lookups:
-            ids = self._doLookup(neededKeys.intersection(config['outputs']),
-                    newId, lookupConfig)
-            newId.update(ids)
-        return newId
+    def _needsLookup(self, datasetType, dataId):
+        datasetConfig = self._parseDatasetConfig(datasetType)[0]
+        if "lookups" not in datasetConfig and \
+                len(self._getDefaults(datasetType)) == 0:
+            return False
+        return not self.getKeys(datasetType, required=True).issubset(dataId)
+
+    def _resolveLookups(self, datasetType, dataIds):
+        # Complete each dataId in place with the single candidate found by
+        # the lookups and defaults of its dataset type.
+        datasetConfig = self._parseDatasetConfig(datasetType)[0]
+        defaults = dict((key, Default(key, expression))
+                for key, expression in
+                self._getDefaults(datasetType).iteritems())
+        count("mapper.lookupDataIds", datasetType, len(dataIds))
+        with timer("mapper.lookup", datasetType):
+            results = resolveLookups(self, datasetType, dataIds,
+                    datasetConfig.get("lookups", []), defaults)
+        for dataId, candidates in zip(dataIds, results):
+            if len(candidates) > 1:
+                raise RuntimeError("Found multiple ({}) matches "
+                        "in lookups for dataset type {} "
+                        "and dataId {}: dataIds {}".format(len(candidates),
+                            datasetType, dataId, candidates))
+            dataId.update(candidates[0])
+
+    def _getDefaults(self, datasetType):
+        owner = self._getIndex()[0][datasetType][0]
+        return owner.config.get("defaults", {}).get(datasetType, {})
 
     def _parseDatasetConfig(self, datasetType):
-        if datasetType not in self.config["datasets"]:
-            for parent in self.parents:
-                if parent.hasConfig("datasets", datasetType):
-                    return parent._parseDatasetConfig(datasetType)
+        try:
+            entry = self._getIndex()[0][datasetType]
+        except KeyError:
             raise RuntimeError("Unknown dataset type {}".format(datasetType))
-        datasetConfig = self.config["datasets"][datasetType]
+        return entry[1:]
+
+    def _parseTemplates(self, datasetType, datasetConfig):
+        if "datasetClass" not in datasetConfig:
+            raise RuntimeError("No dataset class configured for "
+                    "dataset type {} in mapper "
+                    "from {}".format(datasetType, self.source))
         datasetClass = datasetConfig["datasetClass"]
-        classConfig = self.config["classes"][datasetClass]
-        urlTemplates = datasetConfig["urls"]
-        return datasetConfig, datasetClass, classConfig, urlTemplates
-
-    def _lookupByGlob(self, neededKeys, urlTemplates, dataId):
-        # TODO translate numbers from strings
-        keyRegexp = re.compile(
-                r'(?<!\{)(\{\{)*\{(' + "|".join(neededKeys) + r')(:.*?)?\}')
-        dataIdList = []
-        for template in urlTemplates:
-            # Escape all {key}s that we are searching for.
-            newTemplate = keyRegexp.sub(r'\1{{\2\3}}', template)
-            # Substitute for all other {key}s from the dataId.
-            newTemplate = newTemplate.format(**dataId)
-            # Now replace the {key}s we are searching for with "*".
-            globPattern = keyRegexp.sub("*", newTemplate)
-
-            parseResult = urlparse.urlparse(globPattern, scheme='file')
-            if parseResult.scheme != "file":
-                continue
+        if datasetClass not in self.config.get("classes", {}) and \
+                not any(parent.hasConfig("classes", datasetClass)
+                        for parent in self.parents):
+            raise RuntimeError("Unknown dataset class {} for "
+                    "dataset type {} in mapper "
+                    "from {}".format(datasetClass, datasetType, self.source))
+        if "urls" not in datasetConfig:
+            raise RuntimeError("No URL templates configured for "
+                    "dataset type {} in mapper "
+                    "from {}".format(datasetType, self.source))
+        return [UrlTemplate(url) for url in datasetConfig["urls"]]
+
+    def _getIndex(self):
+        if self._indexGeneration != Mapper._generation:
+            with self._lock:
+                if self._indexGeneration != Mapper._generation:
+                    self._buildIndex()
+        return self._index
+
+    def _buildIndex(self):
+        # Flatten the parent graph into one (owner, config) entry per
+        # dataset type and dataset class.  This mapper's own entries take
+        # precedence, then those of each parent in order, depth first.
+        generation = Mapper._generation
+        datasetIndex = {}
+        classIndex = {}
+        for parent in reversed(self.parents):
+            parentDatasets, parentClasses = parent._getIndex()
+            datasetIndex.update(parentDatasets)
+            classIndex.update(parentClasses)
+        for datasetClass, classConfig in \
+                self.config.get("classes", {}).iteritems():
+            classIndex[datasetClass] = (self, classConfig)
+        for datasetType, datasetConfig in self.config["datasets"].iteritems():
+            datasetClass = datasetConfig["datasetClass"]
+            datasetIndex[datasetType] = (self, datasetConfig, datasetClass,
+                    classIndex[datasetClass][1], self.templates[datasetType])
+        if set(datasetIndex) != set(self._index[0]):
+            # Dataset types were created: the key cache, file index and
+            # registry were built for the old set of templates.
+            self.keyCache = {True: {}, False: {}}
+            self.fileIndex = None
+            self.registry = None
+        self._index = (datasetIndex, classIndex)
+        self._indexGeneration = generation
+
+    def _searchOrder(self, datasetType):
+        # This repository and its input repositories, depth first, that
+        # define a dataset type.
+        return [repository for repository in _repositories(self, set())
+                if repository.hasConfig("datasets", datasetType)]
+
+    def _gather(self, repositories, func):
+        # Yield func(repository) for each repository in order.  With the
+        # searchThreads configuration key above one, all repositories are
+        # queried at once, so that a search waits for the slowest of them
+        # rather than their sum; a caller that stops at the first answer
+        # does not wait for the later ones, whose results are dropped.
+        threads = self.config.get("searchThreads", 1)
+        if threads <= 1 or len(repositories) <= 1:
+            for repository in repositories:
+                yield func(repository)
+            return
+        count("mapper.parallelSearch")
+        pool = _getSearchPool(threads)
+        results = [pool.apply_async(func, (repository,))
+                for repository in repositories]
+        for result in results:
+            yield result.get()
+
+    def _getFileIndex(self):
+        if self.fileIndex is None:
+            with self._lock:
+                if self.fileIndex is None:
+                    self.fileIndex = FileIndex(self.config["repoPath"],
+                            self._allTemplates(),
+                            self.config.get("fileIndexMaxAge", 60.0))
+        return self.fileIndex
 
-            filenames = glob.glob(os.path.join(self.repoDir, parseResult.path))
-
-            # Make a new pattern to extract the needed keys.
-            extractPattern = ""
-            lastEnd = 0
-            keyList = []
-            for match in keyRegexp.finditer(newTemplate):
-                extractPattern += re.escape(
-                        match.string[lastEnd : match.start(2) - 1])
-                extractPattern += r'(.+?)'
-                keyList.append(match.group(2))
-                lastEnd = match.end()
-            extractPattern += re.escape(newTemplate[lastEnd:]) + r'$'
-
-            # Match the new pattern against the returned filenames.
-            # Note that we may have gotten extra filenames if there were
-            # duplicate keys in the template.
-            for filename in filenames:
-                filenameOk = True
-                match = extractPattern.match(filename)
-                newDataId = dataId.copy()
-                for value, key in zip(match.groups(), keyList):
-                    if key in newDataId and newDataId[key] != value:
-                        # Supposed to repeat but didn't; skip this.
-                        filenameOk = False
-                        break
-                    newDataId[key] = value
-                if filenameOk:
-                    dataIdList.append(newDataId)
-
-        return dataIdList
+    def _getExistenceCache(self):
+        if self.existenceCache is None:
+            with self._lock:
+                if self.existenceCache is None:
+                    self.existenceCache = ExistenceCache(self.config.get(
+                        "existenceCacheMaxAge",
+                        self.config.get("fileIndexMaxAge", 60.0)),
+                        generation=lambda: self._getRegistry().getGeneration())
+        return self.existenceCache
+
+    def _existsCached(self, datasetType, dataIds, useFilter):
+        # Return whether datasets exist in this repository, for each of many
+        # complete dataIds, answering from the existence cache what it
+        # knows.  With useFilter, as when searching input repositories, a
+        # Bloom filter of the dataset type's keys is built first so that
+        # misses need no probe.  Writes check existence with
+        # datasetExists, which is never cached.
+        cache = self._getExistenceCache()
+        if cache.maxAge <= 0:
+            return self.datasetExistsMany(datasetType, dataIds)
+        if useFilter and not cache.hasFilter(datasetType):
+            recordCount = cache.recordCount
+            # A filter of the registry's keys stays valid until the
+            # registry is written; one of the file index's is only as
+            # fresh as the results.
+            generation = self._getRegistry().getGeneration() \
+                    if self.hasRegistryTable(datasetType) else None
+            with timer("mapper.buildExistenceFilter", datasetType):
+                cache.setFilter(datasetType,
+                        self._existenceKeys(datasetType), recordCount,
+                        generation)
+        keys = [self._existenceKey(datasetType, dataId) for dataId in dataIds]
+        results = [cache.lookup(datasetType, key) if key is not None
+                else None for key in keys]
+        unknown = [i for i, exists in enumerate(results) if exists is None]
+        count("mapper.existenceCacheHit", datasetType,
+                len(dataIds) - len(unknown))
+        if len(unknown) > 0:
+            found = self.datasetExistsMany(datasetType,
+                    [dataIds[i] for i in unknown])
+            for i, exists in itertools.izip(unknown, found):
+                results[i] = exists
+                if keys[i] is not None:
+                    cache.store(datasetType, keys[i], exists)
+        return results
+
+    def _existenceKey(self, datasetType, dataId):
+        # The key of a complete dataId in the existence cache: that of the
+        # registry or of the file index, or None if it has none.
+        try:
+            if self.hasRegistryTable(datasetType):
+                return self._getRegistry()._dataIdKey(datasetType, dataId)
+            return self._getFileIndex().sortKey(datasetType, dataId)[0]
+        except (KeyError, IndexError, ValueError):
+            return None
+
+    def _existenceKeys(self, datasetType):
+        # The keys of all datasets of a type, or None if some cannot be
+        # keyed and a filter of them would miss datasets.
+        if self.hasRegistryTable(datasetType):
+            registry = self._getRegistry()
+            if len(registry.getColumns(datasetType)) == 0:
+                return None
+            return [registry._dataIdKey(datasetType, row)
+                    for row in registry.select(datasetType, [], [])]
+        keys = []
+        for dataId, path, size, mtime in \
+                self._getFileIndex().find(datasetType, {}):
+            key = self._existenceKey(datasetType, dataId)
+            if key is None:
+                return None
+            keys.append(key)
+        return keys
+
+    def _recordExisting(self, datasetType, dataIds):
+        if self.existenceCache is not None:
+            self.existenceCache.recorded(datasetType,
+                    [key for key in (self._existenceKey(datasetType, dataId)
+                        for dataId in dataIds) if key is not None])
+
+    def _getRegistry(self):
+        if self.snapshot is not None:
+            return self.snapshot
+        if self.registry is None:
+            with self._lock:
+                if self.registry is None:
+                    self.registry = Registry(self.config["registryUrl"],
+                            self._allTemplates(), self._allRegistryIndexes(),
+                            self._allRegistryMetadata(),
+                            readOnly=not self.writable)
+        return self.registry
+
+    def _setWritable(self):
+        # A registry opened read-only is reopened for writing when next
+        # used.
+        with self._lock:
+            if not self.writable:
+                self.writable = True
+                self.registry = None
+
+    def _ensureRegistryTable(self, datasetType):
+        # Seed a new table with the files already present so that the
+        # registry never hides datasets that were found by the file index.
+        with self._lock:
+            if self._getRegistry().createTable(datasetType):
+                self.registry.ingest(datasetType, [foundDataId
+                    for foundDataId, path, size, mtime in
+                    self._getFileIndex().find(datasetType, {})])
+
+    def _allRegistryIndexes(self):
+        return dict((datasetType, entry[1]["registryIndexes"])
+                for datasetType, entry in self._getIndex()[0].iteritems()
+                if "registryIndexes" in entry[1])
+
+    def _allRegistryMetadata(self):
+        return dict((datasetType, entry[1]["columns"])
+                for datasetType, entry in self._getIndex()[0].iteritems()
+                if "columns" in entry[1])
+
+    def _allTemplates(self):
+        return dict((datasetType, entry[4])
+                for datasetType, entry in self._getIndex()[0].iteritems())
+
+def _repositories(mapper, seen):
+    repoPath = mapper.config["repoPath"]
+    if repoPath in seen:
+        return
+    seen.add(repoPath)
+    yield mapper
+    for parent in mapper.parents:
+        for repository in _repositories(parent, seen):
+            yield repository
+
+def _getSearchPool(threads):
+    with _searchPoolLock:
+        pool = _searchPools.get(threads)
+        if pool is None:
+            pool = _searchPools[threads] = ThreadPool(threads)
+        return pool
+
+def _keyed(stream, index, sortKey):
+    for dataId in stream:
+        yield sortKey(dataId), index, dataId
 
 def _readPathConfig(repoPath):
     if os.path.isdir(repoPath):
@@ -352,36 +988,45 @@ def _readPathConfig(repoPath):
         _fatal(RuntimeError,
                 "Nonexistent repository URL {}".format(repoPath))
 
+# Configurations are parsed through the configuration cache; yaml is imported
+# only when it misses.
 def _readYamlConfig(path):
-    with open(path) as yamlFile:
-        config = yaml.load(yamlFile)
+    config = configCache.load(path, _loadYamlConfig)
     if "repoPath" not in config:
         config["repoPath"] = os.path.dirname(path)
     return config
 
+def _loadYamlConfig(path):
+    import yaml
+    with open(path) as yamlFile:
+        return yaml.load(yamlFile)
+
 def _readSqliteConfig(path):
+    config, error = configCache.load(path, _loadSqliteConfig)
+    if error is not None:
+        _fatal(RuntimeError, error)
+    if "repoPath" not in config:
+        config["repoPath"] = os.path.dirname(path)
+    return config
+
+def _loadSqliteConfig(path):
+    # Return the configuration stored in a registry and None, or None and
+    # the reason it could not be read.
+    import yaml
+    conn = sqlite3.connect(path)
     try:
-        conn = sqlite3.connect(path)
         try:
-            cur = conn.cursor()
-            cur.execute("SELECT yaml FROM _config")
-            result = list(cur.fetchall())
-            if len(result) > 1:
-                _fatal(RuntimeError, "Too many rows ({}) in "
-                        "configuration database {}".format(len(result), path))
-            if len(result) <= 0:
-                _fatal(RuntimeError, "No data in "
-                        "configuration database {}".format(path))
-            config = yaml.load(result[0][0])
-            if "repoPath" not in config:
-                config["repoPath"] = os.path.dirname(path)
-            return config
+            result = conn.execute("SELECT yaml FROM _config").fetchall()
         except sqlite3.OperationalError as e:
-            _fatal(RuntimeError, "sqlite error in {}: {}".format(path, e))
-        finally:
-            cur.close()
+            return None, "sqlite error in {}: {}".format(path, e)
     finally:
         conn.close()
+    if len(result) > 1:
+        return None, "Too many rows ({}) in configuration database " \
+                "{}".format(len(result), path)
+    if len(result) <= 0:
+        return None, "No data in configuration database {}".format(path)
+    return yaml.load(result[0][0]), None
 
 def _generateMapperConfig(path):
     with open(path) as f:
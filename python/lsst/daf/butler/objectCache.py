@@ -0,0 +1,100 @@
+import collections
+import sys
+import threading
+
+class ObjectCache(object):
+    """An in-memory cache of retrieved datasets with least-recently-used
+    eviction under a byte budget.
+
+    Entries are keyed by the resolved location URLs and dataId of a dataset.
+    The size of an entry is the size of its files, or the shallow size of
+    the object when the dataset has no local files.  Cached objects are
+    shared by every caller that retrieves them and must not be modified."""
+
+    def __init__(self, maxBytes=1 << 30):
+        self.maxBytes = maxBytes
+        self.entries = collections.OrderedDict()
+        self.keysByUrl = {}
+        self.currentBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def makeKey(locationList):
+        return (tuple(location.url for location in locationList),
+                tuple(sorted(locationList[0].dataId.iteritems()))
+                if len(locationList) > 0 else ())
+
+    def get(self, key):
+        """Return (True, obj) for a cached key, or (False, None)."""
+
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.entries[key] = entry
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, key, obj, size=None, maxObjectBytes=None):
+        """Cache obj under key unless it is larger than maxObjectBytes or the
+        whole budget, evicting the least recently used entries to fit."""
+
+        if size is None or size == 0:
+            size = sys.getsizeof(obj)
+        if size > self.maxBytes or \
+                (maxObjectBytes is not None and size > maxObjectBytes):
+            return
+        with self._lock:
+            self._remove(key)
+            while self.currentBytes + size > self.maxBytes:
+                oldKey = next(iter(self.entries))
+                self._remove(oldKey)
+                self.evictions += 1
+            self.entries[key] = (obj, size)
+            self.currentBytes += size
+            for url in key[0]:
+                self.keysByUrl.setdefault(url, set()).add(key)
+
+    def invalidate(self, urls):
+        """Drop every entry that reads from one of urls."""
+
+        with self._lock:
+            for url in urls:
+                for key in list(self.keysByUrl.get(url, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.keysByUrl.clear()
+            self.currentBytes = 0
+
+    def stats(self):
+        """Return a dict of cache statistics."""
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(hits=self.hits, misses=self.misses,
+                    hitRate=float(self.hits) / lookups if lookups else 0.0,
+                    evictions=self.evictions,
+                    invalidations=self.invalidations,
+                    entries=len(self.entries), bytes=self.currentBytes,
+                    maxBytes=self.maxBytes)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.currentBytes -= entry[1]
+        for url in key[0]:
+            keys = self.keysByUrl.get(url)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self.keysByUrl[url]
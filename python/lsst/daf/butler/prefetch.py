@@ -0,0 +1,83 @@
+import collections
+
+from butlerLocation import locationSize
+
+class PrefetchIterator(object):
+    """Iterate over (dataRef, obj) pairs of one dataset type, reading the
+    following datasets in the background while the current one is used.
+
+    At most depth datasets are read ahead, and no new read is started while
+    the estimated size of those already in flight is at least maxBytes.
+    Sizes are estimated from the files of the mapped locations.  Closing the
+    iterator, or dropping it when the consumer stops early, stops further
+    reads; reads already started finish in the pool and are discarded."""
+
+    def __init__(self, butler, datasetType, refSet, depth=4, maxBytes=None):
+        self.butler = butler
+        self.datasetType = butler._handleAlias(datasetType)
+        self.refs = iter(refSet)
+        self.depth = depth
+        self.maxBytes = maxBytes
+        self.pending = collections.deque()
+        self.pendingBytes = 0
+        self.exhausted = False
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def next(self):
+        if self.closed:
+            raise StopIteration
+        self._fill()
+        if len(self.pending) == 0:
+            self.close()
+            raise StopIteration
+        dataRef, size, result = self.pending.popleft()
+        self.pendingBytes -= size
+        self._fill()
+        try:
+            obj = result.get()
+        except:
+            self.close()
+            raise
+        return dataRef, obj
+
+    def close(self):
+        self.closed = True
+        self.pending.clear()
+        self.pendingBytes = 0
+
+    def _fill(self):
+        while not self.exhausted and len(self.pending) < self.depth:
+            if self.maxBytes is not None and len(self.pending) > 0 and \
+                    self.pendingBytes >= self.maxBytes:
+                return
+            try:
+                dataRef = next(self.refs)
+            except StopIteration:
+                self.exhausted = True
+                return
+            dataId = self.butler._makeDataId(dataRef)
+            locationList = self.butler.mapper.map(self.datasetType, dataId,
+                    False)
+            size = locationSize(locationList)
+            result = self.butler._getPool().apply_async(self._load,
+                    (dataId, locationList))
+            self.pending.append((dataRef, size, result))
+            self.pendingBytes += size
+
+    def _load(self, dataId, locationList):
+        obj = self.butler._load(self.datasetType, locationList)
+        self.butler.recordProvenance("get", self.datasetType, dataId,
+                locationList)
+        return obj
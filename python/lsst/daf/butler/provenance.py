@@ -0,0 +1,169 @@
+import atexit
+import collections
+import json
+import logging as log
+import os
+import Queue
+import sqlite3
+import threading
+import time
+
+class ProvenanceRecord(collections.namedtuple("ProvenanceRecord",
+        ["op", "datasetType", "dataId", "timestamp"])):
+    """A compact provenance record: the operation, the interned dataset type,
+    the dataId as a sorted tuple of (key, value) pairs and the time."""
+
+    __slots__ = ()
+
+    @staticmethod
+    def make(op, datasetType, dataId):
+        return ProvenanceRecord(_intern(op), _intern(datasetType),
+                tuple(sorted(dataId.iteritems())), time.time())
+
+class MemoryProvenanceSink(object):
+    """Keep the most recent provenance records in an in-memory ring
+    buffer."""
+
+    def __init__(self, maxRecords=10000):
+        self.records = collections.deque(maxlen=maxRecords)
+
+    def record(self, op, datasetType, dataId):
+        self.records.append(ProvenanceRecord.make(op, datasetType, dataId))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+class NullProvenanceSink(object):
+    """Discard provenance records."""
+
+    def record(self, op, datasetType, dataId):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class SqliteProvenanceSink(object):
+    """Write provenance records to the _provenance table of a repository
+    registry from a background thread.
+
+    Records wait in a bounded queue, so a Butler that outpaces the database
+    blocks instead of growing without limit, and the writer commits all
+    queued records, up to batchSize, in one transaction.  Use
+    getSqliteProvenanceSink to share one sink, and its thread, among the
+    Butlers of a registry; the shared sinks still open are closed when the
+    process exits."""
+
+    def __init__(self, path, maxQueue=100000, batchSize=1000):
+        self.path = path
+        self.batchSize = batchSize
+        self.queue = Queue.Queue(maxQueue)
+        self.error = None
+        self.thread = threading.Thread(target=self._run,
+                name="provenance writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, op, datasetType, dataId):
+        self.queue.put(ProvenanceRecord.make(op, datasetType, dataId))
+
+    def flush(self):
+        """Wait until every record queued so far is committed."""
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        """Write the queued records and stop the writer thread.  A shared
+        sink is no longer returned by getSqliteProvenanceSink."""
+        with _sinkLock:
+            if _sinks.get(self.path) is self:
+                del _sinks[self.path]
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        db = sqlite3.connect(self.path)
+        db.execute("CREATE TABLE IF NOT EXISTS _provenance "
+                "(op TEXT, datasetType TEXT, dataId TEXT, timestamp REAL)")
+        db.commit()
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            while len(batch) < self.batchSize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            records = [r for r in batch if r is not None]
+            done = len(records) < len(batch)
+            # A batch that cannot be written is dropped, and its error
+            # raised by the next flush, but the writer keeps running.
+            try:
+                with db:
+                    db.executemany("INSERT INTO _provenance "
+                            "VALUES (?, ?, ?, ?)",
+                            [(r.op, r.datasetType,
+                                json.dumps(r.dataId, default=repr),
+                                r.timestamp) for r in records])
+            except Exception as e:
+                log.error("Dropped %d provenance records for %s: %s",
+                        len(records), self.path, e)
+                self.error = e
+            finally:
+                for r in batch:
+                    self.queue.task_done()
+        db.close()
+
+def _intern(name):
+    return intern(name) if isinstance(name, str) else name
+
+# The shared SqliteProvenanceSinks of this process, by registry path.
+_sinks = {}
+_sinkLock = threading.Lock()
+
+def getSqliteProvenanceSink(path, maxQueue=100000, batchSize=1000):
+    """Return the shared sink writing to the registry at path, creating it
+    with maxQueue and batchSize the first time."""
+
+    path = os.path.abspath(path)
+    with _sinkLock:
+        sink = _sinks.get(path)
+        if sink is None:
+            sink = _sinks[path] = SqliteProvenanceSink(path, maxQueue,
+                    batchSize)
+        return sink
+
+def _closeSinks():
+    for sink in _sinks.values():
+        sink.close()
+
+atexit.register(_closeSinks)
+
+def createProvenanceSink(config, registryPath, readOnly=False):
+    """Create the provenance sink described by the provenance section of a
+    repository configuration.  The default writes to the registry through
+    its shared sink, or discards the records for a read-only Butler."""
+
+    sink = config.get("sink", "none" if readOnly else "sqlite")
+    if sink == "sqlite":
+        return getSqliteProvenanceSink(registryPath,
+                config.get("maxQueue", 100000), config.get("batchSize", 1000))
+    if sink == "memory":
+        return MemoryProvenanceSink(config.get("maxRecords", 10000))
+    if sink == "none":
+        return NullProvenanceSink()
+    raise ValueError("Unknown provenance sink {}".format(sink))
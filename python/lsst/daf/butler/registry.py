@@ -0,0 +1,477 @@
+import json
+import os
+import sqlite3
+import threading
+import urllib
+
+_columnTypes = {int: "INTEGER", float: "REAL", str: "TEXT"}
+_typeNames = {"int": int, "float": float, "str": str}
+
+# Maximum number of values bound in one IN clause.
+_maxInValues = 500
+
+class Registry(object):
+    """The dataset registry of a repository.
+
+    Each dataset type has its own table in the repository's _butler.sqlite3,
+    named after the dataset type, with one column per URL template key.  The
+    primary key follows the order of the keys in the templates, so queries on
+    any leading subset of them are index lookups; further composite indexes
+    for other common partial dataIds can be configured per dataset type.  The
+    database is put in WAL mode so that readers are not blocked by writers.
+
+    A dataset type may also have metadata columns, such as observation times
+    or validity ranges, that are not part of its dataId.  They are filled
+    from the same-named entries of the dataIds recorded, and are used by
+    calibration lookups.
+
+    Every write increments a generation counter kept in the same database,
+    by which snapshots of the registry detect that they are out of date.
+
+    A read-only registry is opened without writing to the database, which
+    need not exist: a missing database is an empty registry."""
+
+    def __init__(self, path, templates, indexes=None, metadata=None,
+            readOnly=False):
+        """Open the registry at path.  templates is a dict mapping dataset
+        types to lists of UrlTemplates, indexes an optional dict mapping
+        dataset types to lists of key lists to index, and metadata an
+        optional dict mapping dataset types to dicts of metadata column
+        types ("int", "float" or "str") by name."""
+
+        self.path = path
+        self.readOnly = readOnly
+        self.templates = templates
+        self.indexes = indexes or {}
+        self.metadata = {}
+        for datasetType, columns in (metadata or {}).iteritems():
+            try:
+                self.metadata[datasetType] = sorted(
+                        (name, _typeNames[typeName])
+                        for name, typeName in columns.iteritems())
+            except KeyError as e:
+                raise RuntimeError("Unknown type {} of metadata column for "
+                        "dataset type {} in registry {}".format(
+                            e, datasetType, path))
+        self._checkedTables = set()
+        self._lock = threading.RLock()
+        self.columns = {}
+        self.tables = set()
+        if readOnly:
+            self.db = None
+            if not os.path.exists(path):
+                return
+            self.db = sqlite3.connect("file:{}?mode=ro".format(
+                urllib.pathname2url(os.path.abspath(path))),
+                check_same_thread=False)
+        else:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS _checksum "
+                    "(datasetType TEXT, dataId TEXT, checksum TEXT, "
+                    "size INTEGER, files TEXT, "
+                    "PRIMARY KEY (datasetType, dataId))")
+            self.db.commit()
+        cur = self.db.execute("SELECT name FROM sqlite_master "
+                "WHERE type = 'table' AND name NOT LIKE '\\_%' ESCAPE '\\'")
+        self.tables = set(row[0] for row in cur)
+
+    def hasTable(self, datasetType):
+        return datasetType in self.tables
+
+    def getColumns(self, datasetType):
+        """Return the list of (key, type) columns of a dataset type's
+        table."""
+
+        if datasetType not in self.columns:
+            if datasetType not in self.templates:
+                raise RuntimeError("Unknown dataset type {} in registry "
+                        "{}".format(datasetType, self.path))
+            columns = []
+            seen = set()
+            for template in self.templates[datasetType]:
+                for key in template.keys:
+                    if key not in seen:
+                        seen.add(key)
+                        columns.append((key, template.types[key]))
+            self.columns[datasetType] = columns
+        return self.columns[datasetType]
+
+    def getMetadataColumns(self, datasetType):
+        """Return the list of (name, type) metadata columns of a dataset
+        type's table."""
+
+        return self.metadata.get(datasetType, [])
+
+    def createTable(self, datasetType):
+        """Create the table of a dataset type if it does not exist yet.
+        Returns True if it was created."""
+
+        with self._lock:
+            if datasetType in self.tables:
+                return False
+            self._checkWritable()
+            columns = self.getColumns(datasetType)
+            table = _quote(datasetType)
+            if len(columns) > 0:
+                self.db.execute("CREATE TABLE IF NOT EXISTS {} ({}, "
+                        "PRIMARY KEY ({})) WITHOUT ROWID".format(table,
+                            ", ".join("{} {}".format(_quote(key),
+                                _columnTypes[keyType])
+                                for key, keyType in columns +
+                                self.getMetadataColumns(datasetType)),
+                            ", ".join(_quote(key)
+                                for key, keyType in columns)))
+            else:
+                self.db.execute("CREATE TABLE IF NOT EXISTS {} "
+                        "(present INTEGER PRIMARY KEY)".format(table))
+            for keys in self.indexes.get(datasetType, []):
+                self.db.execute("CREATE INDEX IF NOT EXISTS {} "
+                        "ON {} ({})".format(
+                            _quote("_" + datasetType + "_" + "_".join(keys)),
+                            table, ", ".join(_quote(key) for key in keys)))
+            bumpGeneration(self.db)
+            self.db.commit()
+            self.tables.add(datasetType)
+            self._checkedTables.add(datasetType)
+            return True
+
+    def insert(self, datasetType, dataId):
+        """Record a dataset, creating its dataset type's table if needed."""
+
+        self.ingest(datasetType, [dataId])
+
+    def ingest(self, datasetType, dataIds):
+        """Record many datasets of one type in a single transaction."""
+
+        with self._lock:
+            self._checkWritable()
+            self.createTable(datasetType)
+            self._addMetadataColumns(datasetType)
+            columns = self.getColumns(datasetType)
+            if len(columns) == 0:
+                names = ["present"]
+                rows = [(1,)]
+            else:
+                metadata = self.getMetadataColumns(datasetType)
+                names = [key for key, keyType in columns + metadata]
+                rows = (tuple(_coerce(dataId[key], keyType)
+                    for key, keyType in columns) +
+                    tuple(_coerce(dataId[name], nameType)
+                        if dataId.get(name) is not None else None
+                        for name, nameType in metadata)
+                    for dataId in dataIds)
+            with self.db:
+                bumpGeneration(self.db)
+                self.db.executemany("INSERT OR IGNORE INTO {} ({}) "
+                        "VALUES ({})".format(_quote(datasetType),
+                            ", ".join(_quote(name) for name in names),
+                            ", ".join("?" * len(names))), rows)
+
+    def select(self, datasetType, metadataColumns, dataIds):
+        """Return, as dicts, the dataId keys and the given metadata columns
+        of the datasets of a type that may match any of dataIds.
+
+        Only the leading key column is used to restrict the rows, in a
+        single indexed query per batch of values; callers match the rows
+        against their dataIds themselves."""
+
+        with self._lock:
+            if datasetType not in self.tables:
+                return []
+            self._addMetadataColumns(datasetType)
+            columns = self.getColumns(datasetType)
+            known = set(name for name, nameType in
+                    self.getMetadataColumns(datasetType))
+            for name in metadataColumns:
+                if name not in known:
+                    raise RuntimeError("No metadata column {} for dataset "
+                            "type {} in registry {}".format(
+                                name, datasetType, self.path))
+            if len(columns) == 0:
+                return []
+            names = [key for key, keyType in columns] + list(metadataColumns)
+            query = "SELECT {} FROM {}".format(
+                    ", ".join(_quote(name) for name in names),
+                    _quote(datasetType))
+            leading, leadingType = columns[0]
+            if len(dataIds) == 0 or \
+                    any(leading not in dataId for dataId in dataIds):
+                return [dict(zip(names, row))
+                        for row in self.db.execute(query)]
+            values = sorted(set(_coerce(dataId[leading], leadingType)
+                for dataId in dataIds))
+            rows = []
+            for i in xrange(0, len(values), _maxInValues):
+                chunk = values[i:i + _maxInValues]
+                cur = self.db.execute("{} WHERE {} IN ({})".format(query,
+                    _quote(leading), ", ".join("?" * len(chunk))), chunk)
+                rows.extend(dict(zip(names, row)) for row in cur)
+            return rows
+
+    def find(self, datasetType, dataId):
+        """Return the list of dataIds of datasets of a given type matching a
+        partial dataId."""
+
+        with self._lock:
+            if datasetType not in self.tables:
+                return []
+            columns = self.getColumns(datasetType)
+            where, values = self._where(columns, dataId)
+            if len(columns) == 0:
+                cur = self.db.execute("SELECT 1 FROM {}".format(
+                    _quote(datasetType)))
+                return [dataId.copy() for row in cur]
+            cur = self.db.execute("SELECT {} FROM {}{}".format(
+                ", ".join(_quote(key) for key, keyType in columns),
+                _quote(datasetType), where), values)
+            keys = [key for key, keyType in columns]
+            dataIdList = []
+            for row in cur:
+                newDataId = dataId.copy()
+                newDataId.update(zip(keys, row))
+                dataIdList.append(newDataId)
+            return dataIdList
+
+    def iterFind(self, datasetType, dataId, orderBy=None, after=None,
+            pageSize=1000):
+        """Yield the dataIds of datasets of a given type matching a partial
+        dataId, ordered by the keys in orderBy and then by the remaining
+        keys of the table.  Rows are read a page at a time, and the registry
+        is not locked while the caller consumes a page.  after is a dataId
+        previously returned, to resume enumeration after it."""
+
+        if datasetType not in self.tables:
+            return
+        columns = self.getColumns(datasetType)
+        if len(columns) == 0:
+            for foundDataId in self.find(datasetType, dataId):
+                yield foundDataId
+            return
+        keys = [key for key, keyType in columns]
+        order = self.orderColumns(datasetType, orderBy)
+        positions = [keys.index(key) for key, keyType in order]
+        last = self.sortKey(datasetType, after, orderBy) \
+                if after is not None else None
+        query = "SELECT {} FROM {}".format(
+                ", ".join(_quote(key) for key in keys), _quote(datasetType))
+        orderClause = " ORDER BY {} LIMIT {:d}".format(
+                ", ".join(_quote(key) for key, keyType in order), pageSize)
+        while True:
+            terms, values = [], []
+            if last is not None:
+                terms, values = _after([key for key, keyType in order], last)
+            where, values = self._where(columns, dataId, terms, values)
+            with self._lock:
+                rows = self.db.execute(query + where + orderClause,
+                        values).fetchall()
+            for row in rows:
+                newDataId = dataId.copy()
+                newDataId.update(zip(keys, row))
+                yield newDataId
+            if len(rows) < pageSize:
+                return
+            last = tuple(rows[-1][i] for i in positions)
+
+    def orderColumns(self, datasetType, orderBy=None):
+        """Return the (key, type) columns by which iterFind orders the
+        datasets of a type: those in orderBy, then the others."""
+
+        columns = self.getColumns(datasetType)
+        types = dict(columns)
+        for key in orderBy or []:
+            if key not in types:
+                raise RuntimeError("Cannot order dataset type {} by unknown "
+                        "key {}".format(datasetType, key))
+        order = [(key, types[key]) for key in orderBy or []]
+        return order + [column for column in columns
+                if column[0] not in (orderBy or [])]
+
+    def sortKey(self, datasetType, dataId, orderBy=None):
+        """Return the tuple by which iterFind orders a complete dataId."""
+
+        return tuple(_coerce(dataId[key], keyType) for key, keyType in
+                self.orderColumns(datasetType, orderBy))
+
+    def existsMany(self, datasetType, dataIds):
+        """Return, for each of a list of complete dataIds, whether a dataset
+        with that dataId is registered, checking them in batches."""
+
+        if datasetType not in self.tables:
+            return [False] * len(dataIds)
+        columns = self.getColumns(datasetType)
+        if len(columns) == 0:
+            return [self.exists(datasetType, dataId) for dataId in dataIds]
+        found = set(tuple(row[key] for key, keyType in columns)
+                for row in self.select(datasetType, [], dataIds))
+        return [tuple(_coerce(dataId[key], keyType)
+            for key, keyType in columns) in found for dataId in dataIds]
+
+    def exists(self, datasetType, dataId):
+        """Return whether a dataset matching dataId is registered."""
+
+        with self._lock:
+            if datasetType not in self.tables:
+                return False
+            where, values = self._where(self.getColumns(datasetType), dataId)
+            # Rows are fetched to completion: an unfinished statement keeps
+            # a read transaction open, and a later write on this connection
+            # would fail with "database is locked" once another connection
+            # has committed.
+            cur = self.db.execute("SELECT 1 FROM {}{} LIMIT 1".format(
+                _quote(datasetType), where), values)
+            return len(cur.fetchall()) > 0
+
+    def setChecksum(self, datasetType, dataId, checksum, size, files):
+        """Record the content checksum and size of a dataset and the
+        [path, digest, size] of each of its files."""
+
+        self.setChecksums(datasetType, [(dataId, checksum, size, files)])
+
+    def setChecksums(self, datasetType, records):
+        """Record the (dataId, checksum, size, files) of many datasets of
+        one type in a single transaction."""
+
+        with self._lock:
+            self._checkWritable()
+            with self.db:
+                bumpGeneration(self.db)
+                self.db.executemany("INSERT OR REPLACE INTO _checksum "
+                        "VALUES (?, ?, ?, ?, ?)", [(datasetType,
+                            self._dataIdKey(datasetType, dataId), checksum,
+                            size, json.dumps(files))
+                            for dataId, checksum, size, files in records])
+
+    def getChecksum(self, datasetType, dataId):
+        """Return the (checksum, size, files) recorded for a dataset, or
+        None."""
+
+        with self._lock:
+            if not self._hasChecksums():
+                return None
+            cur = self.db.execute("SELECT checksum, size, files "
+                    "FROM _checksum WHERE datasetType = ? AND dataId = ?",
+                    (datasetType, self._dataIdKey(datasetType, dataId)))
+            result = cur.fetchall()
+        if len(result) == 0:
+            return None
+        return result[0][0], result[0][1], json.loads(result[0][2])
+
+    def getFileChecksums(self, datasetType=None):
+        """Return the list of (datasetType, dataId key, files) recorded for
+        all datasets or those of one dataset type."""
+
+        with self._lock:
+            if not self._hasChecksums():
+                return []
+            if datasetType is None:
+                cur = self.db.execute("SELECT datasetType, dataId, files "
+                        "FROM _checksum")
+            else:
+                cur = self.db.execute("SELECT datasetType, dataId, files "
+                        "FROM _checksum WHERE datasetType = ?",
+                        (datasetType,))
+            return [(row[0], row[1], json.loads(row[2])) for row in cur]
+
+    def getGeneration(self):
+        """Return the generation counter of the registry."""
+
+        with self._lock:
+            if self.db is None:
+                return 0
+            return _readGeneration(self.db)
+
+    def _addMetadataColumns(self, datasetType):
+        # Tables created before a metadata column was configured get it
+        # added, once per table and registry.
+        if datasetType in self._checkedTables or \
+                datasetType not in self.tables:
+            return
+        metadata = self.getMetadataColumns(datasetType)
+        if len(metadata) > 0 and len(self.getColumns(datasetType)) > 0 and \
+                not self.readOnly:
+            existing = set(row[1] for row in self.db.execute(
+                "PRAGMA table_info({})".format(_quote(datasetType))))
+            for name, nameType in metadata:
+                if name not in existing:
+                    self.db.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                        _quote(datasetType), _quote(name),
+                        _columnTypes[nameType]))
+            self.db.commit()
+        self._checkedTables.add(datasetType)
+
+    def _checkWritable(self):
+        if self.readOnly:
+            raise RuntimeError("Registry {} is read-only".format(self.path))
+
+    def _hasChecksums(self):
+        # A read-only registry may predate the _checksum table.
+        if not self.readOnly:
+            return True
+        return self.db is not None and len(self.db.execute("SELECT 1 FROM "
+            "sqlite_master WHERE name = '_checksum'").fetchall()) > 0
+
+    def _dataIdKey(self, datasetType, dataId):
+        return json.dumps([_coerce(dataId[key], keyType)
+            for key, keyType in self.getColumns(datasetType)])
+
+    def _where(self, columns, dataId, terms=(), values=()):
+        terms = list(terms)
+        values = list(values)
+        for key, keyType in columns:
+            if key in dataId:
+                terms.append(_quote(key) + " = ?")
+                values.append(_coerce(dataId[key], keyType))
+        if len(terms) == 0:
+            return "", values
+        return " WHERE " + " AND ".join(terms), values
+
+def bumpGeneration(db):
+    """Increment the generation counter of the registry database open on
+    connection db.  Called before the other statements of a write, so that
+    the counter is updated in the same transaction."""
+
+    db.execute("CREATE TABLE IF NOT EXISTS _generation (value INTEGER)")
+    if db.execute("UPDATE _generation SET value = value + 1").rowcount == 0:
+        db.execute("INSERT INTO _generation (value) VALUES (1)")
+
+def readGeneration(path):
+    """Return the generation counter of the registry database at path, 0 if
+    it has never been written."""
+
+    if not os.path.exists(path):
+        return 0
+    db = sqlite3.connect(path)
+    try:
+        return _readGeneration(db)
+    finally:
+        db.close()
+
+def _readGeneration(db):
+    try:
+        rows = db.execute("SELECT value FROM _generation").fetchall()
+    except sqlite3.OperationalError:
+        return 0
+    return rows[0][0] if len(rows) > 0 else 0
+
+def _after(keys, last):
+    # (k1, k2, ...) > (v1, v2, ...) without row values, which older sqlite
+    # versions do not support.
+    term = _quote(keys[-1]) + " > ?"
+    values = [last[-1]]
+    for key, value in reversed(zip(keys[:-1], last[:-1])):
+        term = "{0} > ? OR ({0} = ? AND ({1}))".format(_quote(key), term)
+        values = [value, value] + values
+    return ["(" + term + ")"], values
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def _coerce(value, keyType):
+    if keyType is str:
+        return value if isinstance(value, basestring) else str(value)
+    try:
+        return keyType(value)
+    except (TypeError, ValueError):
+        return value
@@ -1,4 +1,5 @@
-from butlerLocation import ButlerLocation
+import os
+
 from mapper import Mapper
 
 class SingleFileMapper(Mapper):
@@ -6,7 +7,7 @@ class SingleFileMapper(Mapper):
         config['datasets'] = {
                 'input': {
                     'datasetClass': 'exposure',
-                    'urls': [config['singleFilePath']]
+                    'urls': [os.path.basename(config['singleFilePath'])]
                     }
                 }
         config['classes'] = {
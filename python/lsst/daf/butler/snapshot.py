@@ -0,0 +1,301 @@
+import cPickle
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from registry import Registry, _coerce, _typeNames, readGeneration
+
+# A snapshot file is the magic string and the length of a JSON header,
+# the header, then data sections at the offsets given in the header:
+#
+#     {"mapper": [offset, length],
+#      "repositories": [{"repoPath": ..., "registryUrl": ...,
+#          "generation": N, "tables": {datasetType: {"columns": [[key,
+#              type], ...], "metadata": [[name, type], ...], "count": n,
+#              "offset": offset}}}, ...]}
+#
+# The mapper section is the pickled mapper graph.  A table section is an
+# array of n + 1 little-endian 64-bit record offsets followed by n records,
+# each the registry's JSON key of a dataset, a tab and the JSON list of its
+# metadata values, sorted by key: datasets are found by binary search, and
+# those sharing a leading key value are contiguous.
+_magic = "BTLSNAP1"
+_prefix = struct.Struct("<8sQ")
+_offset = struct.Struct("<Q")
+_typeNameOf = dict((keyType, name) for name, keyType in _typeNames.iteritems())
+
+def writeSnapshot(path, mapperState, registries):
+    """Write a snapshot to path, replacing any previous one atomically.
+    mapperState is the pickled mapper graph, and registries a list of
+    (repoPath, registryUrl, Registry) of the repositories in the graph.
+    Each registry's generation is read before its tables, so a write made
+    while the snapshot is exported leaves it out of date rather than
+    missing the write."""
+
+    sections = []
+    size = [0]
+    def add(data):
+        offset = size[0]
+        sections.append(data)
+        size[0] += len(data)
+        return offset
+
+    header = dict(mapper=[add(mapperState), len(mapperState)],
+            repositories=[])
+    for repoPath, registryUrl, registry in registries:
+        generation = registry.getGeneration()
+        tables = {}
+        for datasetType in sorted(registry.tables):
+            if datasetType not in registry.templates:
+                continue
+            columns = registry.getColumns(datasetType)
+            metadata = registry.getMetadataColumns(datasetType)
+            if len(columns) == 0:
+                rows = [{}] if registry.exists(datasetType, {}) else []
+            else:
+                rows = registry.select(datasetType,
+                        [name for name, nameType in metadata], [])
+            records = sorted(registry._dataIdKey(datasetType, row) + "\t" +
+                    json.dumps([row.get(name) for name, nameType in metadata])
+                    for row in rows)
+            offsets = [0]
+            for record in records:
+                offsets.append(offsets[-1] + len(record))
+            tables[datasetType] = dict(count=len(records),
+                    columns=[[key, _typeNameOf[keyType]]
+                        for key, keyType in columns],
+                    metadata=[[name, _typeNameOf[nameType]]
+                        for name, nameType in metadata],
+                    offset=add(struct.pack("<{:d}Q".format(len(offsets)),
+                        *offsets) + "".join(records)))
+        header["repositories"].append(dict(repoPath=repoPath,
+            registryUrl=registryUrl, generation=generation, tables=tables))
+
+    headerData = json.dumps(header)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tempPath = tempfile.mkstemp(dir=directory, prefix=".snapshot")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_prefix.pack(_magic, len(headerData)))
+            f.write(headerData)
+            for data in sections:
+                f.write(data)
+        os.rename(tempPath, path)
+    except:
+        os.remove(tempPath)
+        raise
+
+class Snapshot(object):
+    """A snapshot written by writeSnapshot, mapped read-only into memory so
+    that processes opening the same file share its pages.  Only the header
+    is parsed when it is opened."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length = _prefix.unpack_from(self._map, 0)
+        if magic != _magic:
+            raise RuntimeError("Not a registry snapshot: {}".format(path))
+        self.header = json.loads(self._map[_prefix.size:
+            _prefix.size + length])
+        self._base = _prefix.size + length
+
+    def isCurrent(self):
+        """Return whether no registry in the snapshot has been written since
+        it was exported."""
+        return all(readGeneration(repository["registryUrl"]) ==
+                repository["generation"]
+                for repository in self.header["repositories"])
+
+    def loadMapper(self):
+        """Return the mapper graph of the snapshot."""
+        offset, length = self.header["mapper"]
+        start = self._base + offset
+        return cPickle.loads(self._map[start:start + length])
+
+    def getRegistry(self, repoPath, templates=None):
+        """Return the SnapshotRegistry of a repository, or None if the
+        repository is not in the snapshot.  templates maps dataset types to
+        lists of UrlTemplates, for the columns of those without a table."""
+        for repository in self.header["repositories"]:
+            if repository["repoPath"] == repoPath:
+                return SnapshotRegistry(self, repository, templates)
+        return None
+
+class SnapshotRegistry(Registry):
+    """The registry of one repository as of a snapshot.  It answers the
+    queries of a Registry from the mapped records without opening the
+    database, and cannot be written.  Checksums are not part of
+    snapshots."""
+
+    def __init__(self, snapshot, repository, templates=None):
+        self.path = snapshot.path
+        self.readOnly = True
+        self.templates = templates or {}
+        self.indexes = {}
+        self.columns = {}
+        self.metadata = {}
+        self.generation = repository["generation"]
+        self._map = snapshot._map
+        self._sections = {}
+        for datasetType, table in repository["tables"].iteritems():
+            self.columns[datasetType] = [(key, _typeNames[typeName])
+                    for key, typeName in table["columns"]]
+            self.metadata[datasetType] = [(name, _typeNames[typeName])
+                    for name, typeName in table["metadata"]]
+            self._sections[datasetType] = (snapshot._base + table["offset"],
+                    table["count"])
+        self.tables = set(self.columns)
+        self._checkedTables = set(self.tables)
+        self._lock = threading.RLock()
+
+    def createTable(self, datasetType):
+        if datasetType in self.tables:
+            return False
+        self._readOnly()
+
+    def ingest(self, datasetType, dataIds):
+        self._readOnly()
+
+    def setChecksums(self, datasetType, records):
+        self._readOnly()
+
+    def getChecksum(self, datasetType, dataId):
+        return None
+
+    def getFileChecksums(self, datasetType=None):
+        return []
+
+    def getGeneration(self):
+        return self.generation
+
+    def select(self, datasetType, metadataColumns, dataIds):
+        if datasetType not in self.tables:
+            return []
+        columns = self.getColumns(datasetType)
+        metadata = [name for name, nameType in
+                self.getMetadataColumns(datasetType)]
+        for name in metadataColumns:
+            if name not in metadata:
+                raise RuntimeError("No metadata column {} for dataset "
+                        "type {} in registry {}".format(
+                            name, datasetType, self.path))
+        if len(columns) == 0:
+            return []
+        leading = columns[0][0]
+        if len(dataIds) == 0 or \
+                any(leading not in dataId for dataId in dataIds):
+            ranges = [(0, self._sections[datasetType][1])]
+        else:
+            ranges = [self._range(datasetType, {leading: value})
+                    for value in set(dataId[leading] for dataId in dataIds)]
+        keys = [key for key, keyType in columns]
+        rows = []
+        for start, end in ranges:
+            for values, metadataValues in self._records(datasetType, start,
+                    end):
+                row = dict(zip(keys, values))
+                row.update((name, value) for name, value in
+                        zip(metadata, metadataValues)
+                        if name in metadataColumns)
+                rows.append(row)
+        return rows
+
+    def find(self, datasetType, dataId):
+        if datasetType not in self.tables:
+            return []
+        columns = self.getColumns(datasetType)
+        if len(columns) == 0:
+            return [dataId.copy()
+                    for i in xrange(self._sections[datasetType][1])]
+        keys = [key for key, keyType in columns]
+        wanted = [(i, _coerce(dataId[key], keyType))
+                for i, (key, keyType) in enumerate(columns) if key in dataId]
+        start, end = self._range(datasetType, dataId)
+        dataIdList = []
+        for values, metadataValues in self._records(datasetType, start, end):
+            if all(values[i] == value for i, value in wanted):
+                newDataId = dataId.copy()
+                newDataId.update(zip(keys, values))
+                dataIdList.append(newDataId)
+        return dataIdList
+
+    def iterFind(self, datasetType, dataId, orderBy=None, after=None,
+            pageSize=None):
+        # Records are sorted by their JSON keys rather than by value, so
+        # the matches are sorted here.
+        dataIdList = self.find(datasetType, dataId)
+        if len(self.getColumns(datasetType)) > 0:
+            dataIdList.sort(key=lambda foundDataId:
+                    self.sortKey(datasetType, foundDataId, orderBy))
+        last = self.sortKey(datasetType, after, orderBy) \
+                if after is not None else None
+        for foundDataId in dataIdList:
+            if last is None or \
+                    self.sortKey(datasetType, foundDataId, orderBy) > last:
+                yield foundDataId
+
+    def existsMany(self, datasetType, dataIds):
+        return [self.exists(datasetType, dataId) for dataId in dataIds]
+
+    def exists(self, datasetType, dataId):
+        if datasetType not in self.tables:
+            return False
+        columns = self.getColumns(datasetType)
+        if not all(key in dataId for key, keyType in columns):
+            return len(self.find(datasetType, dataId)) > 0
+        key = self._dataIdKey(datasetType, dataId)
+        i = self._bisect(datasetType, key)
+        return i < self._sections[datasetType][1] and \
+                self._key(datasetType, i) == key
+
+    def _readOnly(self):
+        raise RuntimeError("Registry snapshot {} is read-only".format(
+            self.path))
+
+    def _record(self, datasetType, i):
+        start, n = self._sections[datasetType]
+        begin, end = struct.unpack_from("<2Q", self._map,
+                start + i * _offset.size)
+        recordStart = start + (n + 1) * _offset.size
+        return self._map[recordStart + begin:recordStart + end]
+
+    def _key(self, datasetType, i):
+        return self._record(datasetType, i).split("\t", 1)[0]
+
+    def _records(self, datasetType, start, end):
+        for i in xrange(start, end):
+            key, metadata = self._record(datasetType, i).split("\t", 1)
+            yield json.loads(key), json.loads(metadata)
+
+    def _bisect(self, datasetType, key):
+        # The first record whose key is not less than key.
+        low, high = 0, self._sections[datasetType][1]
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(datasetType, middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _range(self, datasetType, dataId):
+        # The records that may match dataId: those sharing its leading key
+        # value, whose JSON keys all start with the same prefix.
+        n = self._sections[datasetType][1]
+        leading, leadingType = self.getColumns(datasetType)[0]
+        if leading not in dataId:
+            return 0, n
+        prefix = json.dumps([_coerce(dataId[leading], leadingType)])[:-1]
+        start = self._bisect(datasetType, prefix)
+        end = start
+        while end < n:
+            key = self._key(datasetType, end)
+            if not (key.startswith(prefix + ",") or key == prefix + "]"):
+                break
+            end += 1
+        return start, end
@@ -0,0 +1,338 @@
+import errno
+import httplib
+import os
+import re
+import threading
+import urllib
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+from instrumentation import count, timer
+
+class FileBackend(object):
+    """Storage of files in the local filesystem."""
+
+    def open(self, url):
+        """Return a file-like object reading url."""
+        return open(_localPath(url), "rb")
+
+    def read(self, url, start=0, size=None):
+        """Return size bytes, or all bytes, of url from offset start."""
+        with open(_localPath(url), "rb") as f:
+            f.seek(start)
+            return f.read() if size is None else f.read(size)
+
+    def write(self, url, data):
+        path = _localPath(url)
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def size(self, url):
+        """Return the size of url in bytes, or None if it does not exist."""
+        try:
+            return os.path.getsize(_localPath(url))
+        except OSError:
+            return None
+
+    def exists(self, url):
+        return os.path.exists(_localPath(url))
+
+    def listDir(self, url):
+        """Return the subdirectory names and the (name, size, mtime) of the
+        files of a directory URL."""
+        from fileIndex import _listDir
+        return _listDir(_localPath(url))
+
+class HttpBackend(object):
+    """Storage on HTTP servers.
+
+    Connections are kept alive and pooled per server, up to maxIdle idle
+    connections each, and a request on a pooled connection that the server
+    has since closed is retried once on a new one.  Partial reads are
+    byte-range requests; whole files larger than partSize are downloaded
+    as parts in parallel on a pool of threads.  Directories are listed by
+    parsing the links of the server's index page, as served by http.server
+    and most file servers.  Servers that ignore ranges are handled by
+    slicing their full responses."""
+
+    def __init__(self, secure=False, maxIdle=8, partSize=8 * 1024 * 1024,
+            threads=4, timeout=60.0):
+        self.secure = secure
+        self.maxIdle = maxIdle
+        self.partSize = partSize
+        self.threads = threads
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_idle"] = {}
+        state["_lock"] = None
+        state["_pool"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def close(self):
+        """Close the pooled connections and stop the download threads."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+            pool, self._pool = self._pool, None
+        for connections in idle.itervalues():
+            for conn in connections:
+                conn.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def open(self, url):
+        """Return a file-like object reading url with range requests."""
+        return RangeFile(self, url)
+
+    def read(self, url, start=0, size=None):
+        """Return size bytes, or all bytes, of url from offset start."""
+        if size is None:
+            if start == 0:
+                return self._readAll(url)
+            total = self.size(url)
+            if total is None:
+                raise IOError(errno.ENOENT, "No such URL", url)
+            size = max(total - start, 0)
+        if size == 0:
+            return ""
+        with timer("storage.rangeRead"):
+            status, headers, data = self._request("GET", url,
+                    {"Range": "bytes={:d}-{:d}".format(start,
+                        start + size - 1)})
+        if status == 206:
+            return data
+        if status == 200:
+            return data[start:start + size]
+        if status == 416:
+            return ""
+        raise _httpError(status, url)
+
+    def write(self, url, data):
+        status, headers, response = self._request("PUT", url, {}, data)
+        if status not in (200, 201, 204):
+            raise _httpError(status, url)
+
+    def size(self, url):
+        """Return the size of url in bytes, or None if it does not exist."""
+        status, headers, data = self._request("HEAD", url)
+        if status == 404:
+            return None
+        if status != 200:
+            raise _httpError(status, url)
+        length = headers.get("content-length")
+        return int(length) if length is not None else None
+
+    def exists(self, url):
+        return self._request("HEAD", url)[0] == 200
+
+    def listDir(self, url):
+        """Return the subdirectory names and the (name, None, None) of the
+        files linked from the index page of a directory URL, skipping
+        hidden and butler-internal entries; sizes and times are not known
+        from a listing."""
+        if not url.endswith("/"):
+            url += "/"
+        with timer("storage.list"):
+            status, headers, data = self._request("GET", url)
+        if status != 200:
+            raise _httpError(status, url)
+        subdirs = []
+        files = []
+        seen = set()
+        for link in _linkRegexp.findall(data):
+            if "://" in link or link.startswith(("/", "?", "#", "..")):
+                continue
+            name = urllib.unquote(link.split("?", 1)[0].split("#", 1)[0])
+            isDir = name.endswith("/")
+            name = name.rstrip("/")
+            if not name or "/" in name or name in seen or \
+                    name.startswith((".", "_")):
+                continue
+            seen.add(name)
+            if isDir:
+                subdirs.append(name)
+            else:
+                files.append((name, None, None))
+        return subdirs, files
+
+    def _readAll(self, url):
+        total = self.size(url) if self.threads > 1 else None
+        if total is None or total <= self.partSize:
+            with timer("storage.read"):
+                status, headers, data = self._request("GET", url)
+            if status != 200:
+                raise _httpError(status, url)
+            return data
+        starts = range(0, total, self.partSize)
+        with timer("storage.multipartRead"):
+            count("storage.parts", n=len(starts))
+            parts = self._getPool().map(lambda start: self.read(url, start,
+                min(self.partSize, total - start)), starts)
+        return "".join(parts)
+
+    def _getPool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPool(self.threads)
+        return self._pool
+
+    def _request(self, method, url, headers={}, body=None):
+        # Return the status, lower-cased headers and body of a request,
+        # returning the connection to the pool if it can be reused.
+        parseResult = urlparse.urlsplit(url)
+        server = parseResult.netloc
+        path = parseResult.path or "/"
+        if parseResult.query:
+            path += "?" + parseResult.query
+        for attempt in (0, 1):
+            conn, pooled = self._getConnection(server)
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, IOError):
+                conn.close()
+                if pooled and attempt == 0:
+                    count("storage.reconnect")
+                    continue
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(server, conn)
+            return response.status, dict(response.getheaders()), data
+
+    def _getConnection(self, server):
+        with self._lock:
+            idle = self._idle.get(server)
+            if idle:
+                return idle.pop(), True
+        count("storage.connect")
+        connectionClass = httplib.HTTPSConnection if self.secure \
+                else httplib.HTTPConnection
+        return connectionClass(server, timeout=self.timeout), False
+
+    def _release(self, server, conn):
+        with self._lock:
+            idle = self._idle.setdefault(server, [])
+            if len(idle) < self.maxIdle:
+                idle.append(conn)
+                return
+        conn.close()
+
+class RangeFile(object):
+    """A read-only file-like object on a URL of a backend, reading
+    blockSize bytes ahead with each range request."""
+
+    def __init__(self, backend, url, blockSize=64 * 1024):
+        self.backend = backend
+        self.url = url
+        self.blockSize = blockSize
+        self.position = 0
+        self._bufferStart = 0
+        self._buffer = ""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._buffer = ""
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.backend.size(self.url)
+        self.position = offset
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.backend.read(self.url, self.position)
+        else:
+            start = self.position - self._bufferStart
+            if start < 0 or start + size > len(self._buffer):
+                self._bufferStart = self.position
+                self._buffer = self.backend.read(self.url, self.position,
+                        max(size, self.blockSize))
+                start = 0
+            data = self._buffer[start:start + size]
+        self.position += len(data)
+        return data
+
+# Backends by URL scheme, created when first used.
+_backendClasses = {
+        "file": FileBackend,
+        "http": HttpBackend,
+        "https": lambda: HttpBackend(secure=True),
+}
+_backends = {}
+_backendLock = threading.Lock()
+
+def registerBackend(scheme, backend):
+    """Use backend, an object with the methods of FileBackend, for URLs of
+    a scheme."""
+    with _backendLock:
+        _backends[scheme] = backend
+
+def getBackend(url):
+    """Return the storage backend for the scheme of a URL; URLs without a
+    scheme are local paths."""
+    scheme = urlparse.urlsplit(url).scheme or "file"
+    if len(scheme) == 1:
+        # A Windows drive letter.
+        scheme = "file"
+    try:
+        return _backends[scheme]
+    except KeyError:
+        pass
+    with _backendLock:
+        if scheme not in _backends:
+            if scheme not in _backendClasses:
+                raise RuntimeError("No storage backend for scheme {} "
+                        "of URL {}".format(scheme, url))
+            _backends[scheme] = _backendClasses[scheme]()
+        return _backends[scheme]
+
+def isLocal(url):
+    """Return whether a URL is a path in the local filesystem."""
+    scheme = urlparse.urlsplit(url).scheme
+    return len(scheme) <= 1 or scheme == "file"
+
+def openUrl(url):
+    """Return a file-like object reading a URL."""
+    return getBackend(url).open(url)
+
+_linkRegexp = re.compile(r'href\s*=\s*["\']([^"\']+)["\']', re.IGNORECASE)
+
+def _localPath(url):
+    if url.startswith("file:"):
+        return urlparse.urlsplit(url).path
+    return url
+
+def _httpError(status, url):
+    if status == 404:
+        return IOError(errno.ENOENT, "No such URL", url)
+    return IOError("HTTP status {} for {}".format(status, url))
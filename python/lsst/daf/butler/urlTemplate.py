@@ -0,0 +1,160 @@
+import re
+import string
+
+# Regular expressions and converters used to parse a formatted field back
+# into a value, keyed by the presentation type of its format spec.
+_intTypes = "bdoxXn"
+_floatTypes = "eEfFgG%"
+_intPattern = r'[-+]?\d+'
+_hexPattern = r'[-+]?[0-9a-fA-F]+'
+_floatPattern = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?%?'
+_strPattern = r'[^/]+?'
+_schemeRegexp = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.-]+):')
+_fieldNameRegexp = re.compile(r'^\w+')
+_globSpecialRegexp = re.compile(r'([*?[])')
+
+class UrlTemplate(object):
+    """A dataset URL template compiled once so that it can be applied many
+    times.
+
+    The template is a Python format string with an optional scheme prefix,
+    e.g. 'file:flat/v{version}/{date}/flat-f{filter}-c{ccd}.fits'.  Format
+    specs determine the type of parsed values: '{snap:03d}' formats an int and
+    parses back to an int, fields without a spec parse back to strings."""
+
+    def __init__(self, template):
+        self.template = template
+        match = _schemeRegexp.match(template)
+        if match is not None:
+            self.scheme = match.group(1)
+            self.path = template[match.end():]
+        else:
+            self.scheme = "file"
+            self.path = template
+
+        fields = []
+        for literal, field, spec, conversion in \
+                string.Formatter().parse(self.path):
+            if field is None:
+                fields.append((literal, None, None, None))
+                continue
+            key = _fieldNameRegexp.match(field).group(0)
+            fields.append((literal, key, spec or "", conversion))
+
+        # A key may appear several times; the first typed spec determines the
+        # type of its parsed value.
+        self.keys = []
+        self.formatSpecs = {}
+        self.types = {}
+        for literal, key, spec, conversion in fields:
+            if key is None:
+                continue
+            if key not in self.formatSpecs:
+                self.keys.append(key)
+                self.formatSpecs[key] = spec
+                self.types[key] = _specType(spec)
+            elif self.types[key] is str and _specType(spec) is not str:
+                self.formatSpecs[key] = spec
+                self.types[key] = _specType(spec)
+
+        self._segments = []
+        self._groupKeys = []
+        regexp = ""
+        for literal, key, spec, conversion in fields:
+            regexp += re.escape(literal)
+            if key is None:
+                self._segments.append((literal, None, None))
+                continue
+            fieldFormat = "{" + ("!" + conversion if conversion else "") + \
+                    (":" + spec if spec else "") + "}"
+            self._segments.append((literal, key, fieldFormat))
+            fieldType = _specType(spec)
+            if fieldType is int:
+                regexp += "(" + (_hexPattern if spec[-1] in "xX"
+                        else _intPattern) + ")"
+            elif fieldType is float:
+                regexp += "(" + _floatPattern + ")"
+            else:
+                regexp += "(" + _strPattern + ")"
+            self._groupKeys.append((key, spec if fieldType is not str
+                else self.formatSpecs[key]))
+        self.regexp = re.compile(regexp + "$")
+        self.format = self.template.format
+
+        prefix = self._segments[0][0] if len(self._segments) > 0 else ""
+        if len(self._segments) == 1 and self._segments[0][1] is None:
+            self.globPrefix = prefix
+        else:
+            self.globPrefix = prefix[:prefix.rfind("/") + 1]
+
+    def __repr__(self):
+        return "UrlTemplate({!r})".format(self.template)
+
+    def __reduce__(self):
+        return (UrlTemplate, (self.template,))
+
+    def formatPath(self, dataId):
+        """Format the path portion (without scheme) of the template."""
+        return self.path.format(**dataId)
+
+    def globPattern(self, dataId):
+        """Return a glob pattern for the path portion of the template with
+        the keys present in dataId substituted and all others wildcarded."""
+        pattern = ""
+        for literal, key, fieldFormat in self._segments:
+            pattern += _globSpecialRegexp.sub(r'[\1]', literal)
+            if key is None:
+                continue
+            if key in dataId:
+                pattern += _globSpecialRegexp.sub(r'[\1]',
+                        fieldFormat.format(dataId[key]))
+            else:
+                pattern += "*"
+        return pattern
+
+    def parse(self, path):
+        """Parse a path formatted from this template back into a dataId with
+        typed values.  Returns None if the path does not match, including when
+        a key that appears more than once has inconsistent values."""
+        match = self.regexp.match(path)
+        if match is None:
+            return None
+        dataId = {}
+        for value, (key, spec) in zip(match.groups(), self._groupKeys):
+            fieldType = self.types[key]
+            try:
+                if fieldType is int:
+                    value = _parseInt(value, spec)
+                elif fieldType is float:
+                    value = float(value.rstrip("%")) / \
+                            (100.0 if value.endswith("%") else 1.0)
+            except ValueError:
+                return None
+            if key in dataId and dataId[key] != value:
+                return None
+            dataId[key] = value
+        return dataId
+
+    def matches(self, parsedDataId, dataId):
+        """Return whether every key of the template present in both dataIds
+        formats to the same string."""
+        for literal, key, fieldFormat in self._segments:
+            if key is None or key not in dataId or key not in parsedDataId:
+                continue
+            if fieldFormat.format(dataId[key]) != \
+                    fieldFormat.format(parsedDataId[key]):
+                return False
+        return True
+
+def _specType(spec):
+    if len(spec) == 0:
+        return str
+    if spec[-1] in _intTypes:
+        return int
+    if spec[-1] in _floatTypes:
+        return float
+    return str
+
+def _parseInt(value, spec):
+    base = {"b": 2, "o": 8, "x": 16, "X": 16}.get(spec[-1], 10)
+    return int(value, base)
@@ -0,0 +1,112 @@
+import atexit
+import Queue
+import sys
+import threading
+import weakref
+
+# The WriteBehindQueues of this process, whose queued puts are written before
+# it exits.  A queue only has a thread, which keeps it alive, while puts are
+# queued, so idle queues and their Butlers can be collected.
+_queues = weakref.WeakSet()
+_queuesLock = threading.Lock()
+
+def _joinQueues():
+    with _queuesLock:
+        queues = list(_queues)
+    for queue in queues:
+        queue.queue.join()
+
+atexit.register(_joinQueues)
+
+class WriteBehindQueue(object):
+    """A bounded queue of puts written by a background thread.
+
+    The thread takes all queued puts, up to batchSize, and writes them as
+    one batch with the Butler's _putBatch: their locks are taken in one
+    transaction, their files are written concurrently on the Butler's pool
+    and their registry records are committed together.  The first error
+    raised by a batch is raised again by the next put or flush; the puts
+    queued after it are still written.  The thread is started by a put to
+    an empty queue and exits once the queue is drained.  Puts still queued
+    when the process exits are written first."""
+
+    def __init__(self, butler, maxItems, batchSize=64):
+        self.butler = butler
+        self.batchSize = batchSize
+        self.queue = Queue.Queue(maxItems)
+        self.pending = {}
+        self.error = None
+        self._lock = threading.Lock()
+        self._thread = None
+        with _queuesLock:
+            _queues.add(self)
+
+    def put(self, item, kind):
+        """Queue an (obj, datasetType, dataId) put, waiting while the queue
+        is full.  kind is the put's lock kind."""
+        self.raiseError()
+        with self._lock:
+            self.pending[kind] = self.pending.get(kind, 0) + 1
+        self.queue.put((item, kind))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                        name="ButlerWriteBehind")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def isPending(self, kind):
+        """Return whether a put of a given lock kind is queued or being
+        written by another thread."""
+        return kind in self.pending and \
+                threading.current_thread() is not self._thread
+
+    def flush(self):
+        """Wait until all queued puts are written, then raise the first error
+        of any of them."""
+        self.queue.join()
+        self.raiseError()
+
+    def raiseError(self):
+        with self._lock:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def _run(self):
+        while True:
+            # A put after this check finds no thread and starts one.
+            with self._lock:
+                try:
+                    batch = [self.queue.get_nowait()]
+                except Queue.Empty:
+                    self._thread = None
+                    return
+            while len(batch) < self.batchSize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            # Repeated puts of a dataset go to separate batches, in order.
+            groups = [[]]
+            kinds = set()
+            for item, kind in batch:
+                if kind in kinds:
+                    groups.append([])
+                    kinds.clear()
+                kinds.add(kind)
+                groups[-1].append(item)
+            for items in groups:
+                try:
+                    self.butler._putBatch(items)
+                except:
+                    with self._lock:
+                        if self.error is None:
+                            self.error = sys.exc_info()
+            with self._lock:
+                for item, kind in batch:
+                    self.pending[kind] -= 1
+                    if self.pending[kind] == 0:
+                        del self.pending[kind]
+            for item in batch:
+                self.queue.task_done()
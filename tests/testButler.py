@@ -1,15 +1,97 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+# The tests run in a copy of the fixture repositories, which are written to,
+# in a temporary directory removed at exit; later temporary files go there
+# too.  Relative paths on sys.path are made absolute first.
+sys.path[:] = [os.path.abspath(path) for path in sys.path]
+workDir = tempfile.mkdtemp()
+os.makedirs(os.path.join(workDir, "tests"))
+for name in ("calib_repo", "raw_repo", "output_repo", "mapper_repo",
+        "foo-ccd3.fits"):
+    source = os.path.join("tests", name)
+    if os.path.isdir(source):
+        shutil.copytree(source, os.path.join(workDir, source))
+    else:
+        shutil.copy2(source, os.path.join(workDir, source))
+os.chdir(workDir)
+tempfile.tempdir = workDir
+os.environ["DAF_BUTLER_CONFIG_CACHE"] = os.path.join(workDir, "configCache")
+os.environ["DAF_BUTLER_INDEX_CACHE"] = os.path.join(workDir, "indexCache")
+atexit.register(shutil.rmtree, workDir, True)
+
+import asyncButler
 import butler
+import instrumentation
+import objectCache
+import provenance
 
 b = butler.Butler("tests/foo-ccd3.fits")
 im = b.get("input", ccd=3)
 print im
+ims = b.getMany([("input", dict(ccd=3)), ("input", dict(ccd=4))])
+print [str(im) for im in ims]
+b.provenance.flush()
+c = butler.Butler("tests/foo-ccd3.fits")
+c.get("input", ccd=3)
+d = butler.Butler("tests/foo-ccd3.fits", readOnly=True)
+d.get("input", ccd=3)
+print c.provenance is b.provenance, type(d.provenance).__name__
+b.provenance.close()
+print b.provenance.thread.is_alive()
+import datetime
+import sqlite3
+class Unencodable(object):
+    def __repr__(self):
+        raise ValueError("no repr")
+path = os.path.join(workDir, "provenance.sqlite3")
+sink = provenance.SqliteProvenanceSink(path)
+sink.record("get", "flat", dict(date=datetime.date(2016, 1, 1)))
+sink.flush()
+sink.record("get", "flat", dict(date=Unencodable()))
+try:
+    sink.flush()
+except ValueError as e:
+    print e
+sink.record("get", "flat", dict(visit=1))
+sink.flush()
+sink.close()
+print [row[0] for row in sqlite3.connect(path).execute(
+    "SELECT dataId FROM _provenance")]
+b = butler.Butler("tests/foo-ccd3.fits",
+        provenance=provenance.MemoryProvenanceSink(maxRecords=2))
+b.getMany([("input", dict(ccd=ccd)) for ccd in xrange(3)])
+print [record.dataId for record in b.provenance]
+instrumentation.instrumentation.enable()
+b.get("input", ccd=3)
+snapshot = instrumentation.instrumentation.snapshot(reset=True)
+instrumentation.instrumentation.disable()
+print [snapshot["timers"][phase]["input"]["count"]
+        for phase in ("butler.get", "mapper.map", "storage.read")]
+b = butler.Butler("tests/foo-ccd3.fits", cache=objectCache.ObjectCache(1000))
+for i in xrange(3):
+    b.get("input", ccd=3)
+print b.cache.stats()["hits"]
+b = asyncButler.AsyncButler("tests/foo-ccd3.fits", maxConcurrency=2)
+print [str(result.get()) for result in
+        [b.aget("input", ccd=ccd) for ccd in xrange(3)]]
+print [ref["ccd"] for ref, obj in
+        b.prefetch("input", [dict(ccd=ccd) for ccd in xrange(3)], depth=2)]
 b = butler.Butler("tests/calib_repo/_butler.yaml")
 b = butler.Butler("tests/raw_repo/_butler.yaml")
+print len(b.mapper.listDatasets("raw", dict(visit=392524, snap=1)))
 b = butler.Butler("tests/raw_repo/_butler.yaml",
         ["tests/calib_repo/_butler.yaml"])
 b = butler.Butler("tests/output_repo", [
     "tests/raw_repo/_butler.yaml",
     "tests/calib_repo/_butler.yaml"])
+b.ingest("raw", [dict(visit=1, filter="g", snap=0, sensor=0, channel=0)])
+print b.mapper.datasetExists("raw",
+        dict(visit=1, filter="g", snap=0, sensor=0, channel=0))
+print b.verify()
 
 import cPickle
 
@@ -19,3 +101,238 @@ c = cPickle.loads(s)
 s = cPickle.dumps(c)
 d = cPickle.loads(s)
 print c.mapper.config == d.mapper.config
+e = butler.Butler("tests/output_repo", readOnly=True)
+print [parent.config["repoPath"] for parent in e.mapper.parents]
+try:
+    e.createDatasetType("calexp", "exposure",
+            urls=["file:calexp/v{visit:d}-c{ccd:d}.fits"])
+except RuntimeError:
+    print "calexp" in e.getDatasetTypes()
+butler.Butler("tests/output_repo").createDatasetType("calexp", "exposure",
+        urls=["file:calexp/v{visit:d}-c{ccd:d}.fits"])
+print sorted(e.getKeys("calexp"))
+butler.Butler("tests/calib_repo/_butler.yaml").createDatasetType("bias",
+        "exposure", urls=["file:bias/{date}/bias-c{ccd:d}.fits"])
+print sorted(e.getKeys("bias"))
+b = butler.Butler("tests/raw_repo/_butler.yaml")
+b.ingest("raw", [dict(visit=visit, filter="g", snap=0, sensor=0, channel=0,
+    taiObs="2016-01-0{}T01:00".format(visit)) for visit in (1, 2, 3)])
+# The flats are in the input calib_repo: lookups read them from there.
+butler.Butler("tests/calib_repo/_butler.yaml").ingest("flat", [
+    dict(version=1, date="20160101", filter="g", ccd=3,
+        validStart="2016-01-01", validEnd="2016-01-02T12:00"),
+    dict(version=1, date="20160103", filter="g", ccd=3,
+        validStart="2016-01-02T12:01", validEnd="2016-01-31"),
+    dict(version=2, date="20160102", filter="g", ccd=3,
+        validStart="2016-01-03", validEnd="2016-01-31")])
+print [os.path.relpath(locations[0].url, "tests")
+        for locations in b.mapper.mapMany([("flat", dict(visit=visit,
+            filter="g", snap=0, sensor=0, channel=0, ccd=3))
+            for visit in (1, 2, 3)], False)]
+print len(b.mapper.listDatasets("flat", dict(visit=3, filter="g", snap=0,
+    sensor=0, channel=0, ccd=3)))
+page = list(b.iterRefSet("raw", orderBy=["visit"], limit=2))
+print [ref["visit"] for ref in page], [ref["visit"] for ref in
+        b.iterRefSet("raw", orderBy=["visit"], limit=1, after=page[-1])]
+b = butler.Butler("tests/output_repo", readOnly=True)
+# Paging across repositories, resuming after a DataRef.
+page = list(b.iterRefSet("raw", orderBy=["visit"], limit=2))
+print [ref["visit"] for ref in page], [ref["visit"] for ref in
+        b.iterRefSet("raw", orderBy=["visit"], limit=2, after=page[-1])], \
+        page[0].get("visit")
+dataId = dict(visit=392524, filter="r", snap=0, sensor=1, channel=1)
+for searchThreads in (1, 4):
+    b.mapper.config["searchThreads"] = searchThreads
+    print [b.mapper._locate("raw", dict(dataId, visit=visit),
+        False)[0].config["repoPath"] for visit in (392524, 1)], \
+            len(b.getRefSet("raw", visit=392524))
+del b.mapper.config["searchThreads"]
+path = b.mapper.exportSnapshot()
+s = butler.Butler("tests/output_repo", snapshot=path)
+print s.readOnly, len(s.getRefSet("raw", visit=392524)), \
+        s.mapper.datasetExists("raw", dict(dataId, visit=1, filter="g",
+            snap=0, sensor=0, channel=0))
+try:
+    s.put("orphan", "calexp", visit=5, ccd=3)
+except RuntimeError:
+    print os.path.exists("tests/output_repo/calexp/v5-c3.fits")
+b.ingest("raw", [dict(dataId, visit=2)])
+# Once stale, the snapshot is not used and the Butler stays read-only.
+stale = butler.Butler("tests/output_repo", snapshot=path)
+print stale.mapper is b.mapper, stale.readOnly
+import exposureFits
+path = os.path.join(tempfile.mkdtemp(), "exposure.fits")
+exposureFits.ExposureFits.put(exposureFits.Exposure(
+    header=dict(EXPTIME=15.0, FILTER="g"),
+    image=[[x + 10 * y for x in xrange(4)] for y in xrange(3)]), path, {})
+exposure = exposureFits.ExposureFits.get(path, dict(bbox=(1, 1, 3, 3)), None)
+print exposureFits.ExposureFits.get(path, dict(headerOnly=True), None), \
+        exposure.header["EXPTIME"], [list(row) for row in exposure.image], \
+        os.path.getsize(path)
+repo = tempfile.mkdtemp()
+with open(os.path.join(repo, "_butler.yaml"), "w") as f:
+    f.write("mapper: testMapper.TestMapper\ndatasets:\n  calexp:\n"
+            "    datasetClass: exposure\n"
+            "    urls: ['file:calexp/v{visit:d}.fits']\n")
+with butler.Butler(repo, writeBehind=4) as b:
+    for visit in xrange(10):
+        b.put(exposureFits.Exposure(header=dict(VISIT=visit),
+            image=[[visit]]), "calexp", visit=visit)
+    print b.get("calexp", visit=9).header["VISIT"]
+print len(b.getRefSet("calexp")), b.verify()
+instrumentation.instrumentation.enable()
+b.put(exposureFits.Exposure(header=dict(VISIT=9), image=[[9]]), "calexp",
+        visit=9)
+b.flush()
+print instrumentation.instrumentation.snapshot(reset=True)["counters"].get(
+        "butler.putUnchanged")
+instrumentation.instrumentation.disable()
+b.put(exposureFits.Exposure(header=dict(VISIT=10), image=[[10]]), "calexp",
+        visit=10)
+b.flush()
+with open(os.path.join(repo, "calexp", "v10.fits"), "r+b") as f:
+    f.seek(-1, 2)
+    last = f.read(1)
+    f.seek(-1, 2)
+    f.write(chr(ord(last) ^ 1))
+print [problem[2] for problem in b.verify()]
+b.put(exposureFits.Exposure(image=[[0]]), "calexp", visit=3)
+try:
+    b.flush()
+except RuntimeError as e:
+    print "RuntimeError"
+# A drained write-behind queue stops its thread and is collected with its
+# Butler.
+import gc
+import weakref
+c = butler.Butler(repo, writeBehind=4)
+c.put(exposureFits.Exposure(image=[[11]]), "calexp", visit=11)
+c.flush()
+queueRef = weakref.ref(c._writeQueue)
+thread = c._writeQueue._thread
+if thread is not None:
+    thread.join()
+del c, thread
+gc.collect()
+print queueRef() is None
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+import threading
+import storage
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    def translate_path(self, path):
+        return os.path.join(repo, path.split("?", 1)[0].lstrip("/"))
+    def log_message(self, *args):
+        pass
+server = Server(("127.0.0.1", 0), Handler)
+thread = threading.Thread(target=server.serve_forever)
+thread.daemon = True
+thread.start()
+url = "http://127.0.0.1:{:d}/calexp/".format(server.server_address[1])
+remote = tempfile.mkdtemp()
+with open(os.path.join(remote, "_butler.yaml"), "w") as f:
+    f.write("mapper: testMapper.TestMapper\ndatasets:\n  calexp:\n"
+            "    datasetClass: exposure\n"
+            "    urls: ['" + url + "v{visit:d}.fits']\n")
+r = butler.Butler(remote)
+backend = storage.HttpBackend(partSize=1000)
+print len(r.getRefSet("calexp")), r.get("calexp", visit=4).header["VISIT"], \
+        r.get("calexp", visit=5, headerOnly=True)["VISIT"], \
+        storage.getBackend(url).read(url + "v4.fits", 0, 6), \
+        len(backend.read(url + "v4.fits"))
+backend.close()
+storage.getBackend(url).close()
+server.shutdown()
+ids = b.getDataIdSet("calexp", orderBy=["visit"])
+odd = ids.filter([visit % 2 == 1 for visit in ids.column("visit")])
+print ids, ids[3]["visit"], [ref["visit"] for ref in odd], \
+        [ref["visit"] for ref in ids.where(visit=[2, 5, 11])], \
+        [ref["visit"] for ref in ids.difference(odd)][:3]
+raws = butler.Butler("tests/output_repo", readOnly=True).getDataIdSet("raw")
+print len(raws), [(values, len(group))
+        for values, group in raws.groupBy("visit")], \
+        raws.project("filter").toDataIds(), \
+        len(raws.union(raws)), \
+        len(raws.intersection(raws.where(visit="2").project("visit")))
+from existenceCache import BloomFilter
+bloom = BloomFilter(100)
+for i in xrange(100):
+    bloom.add(str(i))
+print all(str(i) in bloom for i in xrange(100)), \
+        sum(str(i) in bloom for i in xrange(100, 1100)) < 50
+dataId = dict(visit=392524, filter="r", snap=0, sensor=1, channel=1)
+raw = butler.Butler("tests/output_repo", readOnly=True).mapper._locate("raw",
+        dataId, False)[0]
+print [raw._existsCached("raw", [dict(dataId, visit=visit)], True)[0]
+        for visit in (392524, 7)], "raw" in raw.existenceCache.filters, \
+        raw.existenceCache.lookup("raw", raw._existenceKey("raw",
+            dict(dataId, visit=8)))
+# Expiry drops the results, and the filter once the registry is written.
+raw.existenceCache._created -= raw.existenceCache.maxAge
+print raw.existenceCache.hasFilter("raw"), len(raw.existenceCache.results)
+butler.Butler("tests/raw_repo/_butler.yaml").ingest("raw",
+        [dict(dataId, visit=9)])
+raw.existenceCache._created -= raw.existenceCache.maxAge
+print raw.existenceCache.hasFilter("raw")
+from configCache import ConfigCache
+cache = ConfigCache(tempfile.mkdtemp())
+path = os.path.join(repo, "_butler.yaml")
+reads = []
+def readConfig(path):
+    reads.append(path)
+    return dict(size=os.path.getsize(path))
+config = cache.load(path, readConfig)
+size = config.pop("size")
+print cache.load(path, readConfig) == dict(size=size), len(reads),
+with open(path, "a") as f:
+    f.write("# changed\n")
+print cache.load(path, readConfig)["size"] > size, len(reads)
+from fileIndex import FileIndex
+index = butler.Butler(repo).mapper._getFileIndex()
+print os.path.dirname(index.indexPath) == repo, \
+        index.db.execute("PRAGMA journal_mode").fetchone()[0]
+# A repository that cannot hold its index has it in the index cache.
+index = FileIndex(path, index.templates)
+print os.path.dirname(index.indexPath) == os.environ["DAF_BUTLER_INDEX_CACHE"]
+# Read-only queries leave a repository without a registry untouched, and
+# input repositories are opened read-only.
+import mapper
+def makeRepo():
+    repoPath = tempfile.mkdtemp()
+    with open(os.path.join(repoPath, "_butler.yaml"), "w") as f:
+        f.write("mapper: testMapper.TestMapper\ndatasets:\n  calexp:\n"
+                "    datasetClass: exposure\n"
+                "    urls: ['file:calexp/v{visit:d}.fits']\n")
+    return repoPath
+source = makeRepo()
+print butler.Butler(source, readOnly=True).getRefSet("calexp"), \
+        os.path.exists(os.path.join(source, "_butler.sqlite3")),
+del mapper.Mapper._mapperCache[source]
+print butler.Butler(source).getRefSet("calexp")
+e = butler.Butler(tempfile.mkdtemp(), [makeRepo()])
+print e.getRefSet("calexp"), e.mapper.parents[0]._getRegistry().readOnly
+# Integer keys of datasets merged from several repositories sort as numbers.
+source = makeRepo()
+for visit in (1, 2, 9):
+    butler.Butler(source).put(exposureFits.Exposure(image=[[visit]]),
+            "calexp", visit=visit)
+e = butler.Butler(makeRepo(), [source])
+for visit in (3, 10, 11):
+    e.put(exposureFits.Exposure(image=[[visit]]), "calexp", visit=visit)
+page = list(e.iterRefSet("calexp", orderBy=["visit"], limit=4))
+print [ref["visit"] for ref in page], [ref["visit"] for ref in
+        e.iterRefSet("calexp", orderBy=["visit"], after=page[-1])]
+# Closing a Butler stops the heartbeats of the locks its threads created.
+with e._lock("calexp", dict(visit=3)):
+    heartbeats = [t for t in threading.enumerate()
+            if t.name == "DbLock heartbeat"]
+e.close()
+print len(heartbeats) >= 1, [t for t in heartbeats if t.is_alive()]
+# The default executor of an AsyncButler is sized from its concurrency.
+print asyncButler.AsyncButler("tests/foo-ccd3.fits").maxConcurrency, \
+        asyncButler.AsyncButler("tests/foo-ccd3.fits",
+                maxConcurrency=32).maxThreads
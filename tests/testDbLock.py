@@ -0,0 +1,82 @@
+import atexit
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+import instrumentation
+from dbLock import DbLock, FcntlLock, TimeoutError
+
+tmpDir = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, tmpDir, True)
+path = os.path.join(tmpDir, "_butler.sqlite3")
+
+a = DbLock(path, timeout=2.0)
+b = DbLock(path, timeout=2.0)
+b.ownerId = "another owner"
+a.acquireMany(["x", "y"])
+threading.Timer(0.1, lambda: a.releaseMany(["x", "y"])).start()
+startTime = time.time()
+with b.lock("y"):
+    print time.time() - startTime < 0.5
+
+# A lock left behind by a process that no longer exists is reclaimed.
+pid = os.fork()
+if pid == 0:
+    os._exit(0)
+os.waitpid(pid, 0)
+a.db.execute("INSERT INTO _lock VALUES (?, ?, ?, ?, ?)",
+        ("z", "dead owner", a.host, pid, time.time() + 1000))
+with a.lock("z"):
+    print "z" in a.owned
+
+# Re-acquiring right after releasing the last lock keeps renewing leases
+# at the lease interval rather than continuously.
+c = DbLock(path, timeout=2.0, leaseTime=0.3)
+instrumentation.instrumentation.enable()
+c.acquire("w")
+c.release("w")
+c.acquire("w")
+time.sleep(0.5)
+c.release("w")
+renewals = instrumentation.instrumentation.snapshot(reset=True)[
+        "counters"].get("lock.renew", {}).get("*", 0)
+instrumentation.instrumentation.disable()
+print 1 <= renewals <= 6
+
+# A renewal failing while another connection holds the database is retried
+# at the next tick, and closing the lock stops its heartbeat.
+d = DbLock(path, timeout=0.05, leaseTime=0.3)
+d.acquire("v")
+blocker = sqlite3.connect(path, isolation_level=None)
+blocker.execute("BEGIN IMMEDIATE")
+instrumentation.instrumentation.enable()
+time.sleep(0.35)
+blocker.execute("COMMIT")
+failures = instrumentation.instrumentation.snapshot()["counters"].get(
+        "lock.renewFailed", {}).get("*", 0)
+expires = d.db.execute("SELECT expires FROM _lock WHERE kind = 'v'"
+        ).fetchone()[0]
+time.sleep(0.25)
+instrumentation.instrumentation.disable()
+print failures >= 1, d.db.execute("SELECT expires FROM _lock "
+        "WHERE kind = 'v'").fetchone()[0] > expires
+heartbeat = d._heartbeat
+d.close()
+print heartbeat.is_alive(), d._heartbeat
+d.release("v")
+
+f = FcntlLock(os.path.join(tmpDir, "_butler.lock"), timeout=0.2)
+f.acquire("x")
+pid = os.fork()
+if pid == 0:
+    g = FcntlLock(os.path.join(tmpDir, "_butler.lock"), timeout=0.2)
+    try:
+        g.acquire("x")
+        os._exit(1)
+    except TimeoutError:
+        os._exit(0)
+print os.waitpid(pid, 0)[1] == 0
+f.release("x")